@@ -2,28 +2,34 @@
 # Author: Du Mingzhe (mingzhe@nus.edu.sg)
 # Date: 2023-04-29
 
+import os
+import json
+import queue
 import utils
+import stream
+import threading
 import task
 import prompt
 import memory
+from concurrent.futures import ThreadPoolExecutor
 
 class Agent(object):
-    def __init__(self, name, personalities) -> None:
+    def __init__(self, name, personalities, long_term_memory=None, session_id=None) -> None:
         # Agent Name
         self.name = name
 
         # Personality
         self.personalities = personalities
 
-        # History
-        self.history = memory.History()
+        # History (persisted per session when HISTORY_DB_PATH is set)
+        self.history = memory.History(session_id=session_id)
 
         # Action History
         self.action_history = memory.History()
 
         # Memory
         self.short_term_memory = memory.ShortTermMemory()
-        self.long_term_memory = memory.LongTermMemory()
+        self.long_term_memory = long_term_memory if long_term_memory is not None else memory.LongTermMemory()
 
         # Current Task
         self.current_task = task.StandbyTask("welcome", {"status": "Waiting for the user input."})
@@ -33,30 +39,93 @@ class Agent(object):
 
         # Credit
         self.credit = 0
+
+        # Independent commands the planner may batch in one turn
+        self.max_batch_size = 4
+
+        # Set when the owning session goes away (e.g. socket disconnect)
+        self.cancel_event = threading.Event()
     
     def short2long(self, query, response, lt_candidates):
-        # Save <query, answer> pair
-        self.long_term_memory.add([utils.get_history_str(self.history.query(top_k=5))], [response])
+        # Save <query, answer> pair together with the promoted short-term documents in one batch
+        keys = [utils.get_history_str(self.history.query(top_k=5))]
+        values = [response]
 
         for doc in self.short_term_memory.query(query, top_k=5):
-            doc_uuid = doc.metadata["uuid"]
-            doc_key = doc.metadata["key"]
-            doc_content = doc.page_content
-
-            if doc_uuid in lt_candidates:
+            if doc.metadata["uuid"] in lt_candidates:
                 # TODO(mingzhe): Check if adding into long-term memory
+                keys += [doc.metadata["key"]]
+                values += [doc.page_content]
+
+        # Similarity Check (batched)
+        result = self.long_term_memory.add_batch(keys, values, threshold=0.1)
+        for key in result["skipped"]:
+            print(f"Alreay has the item. Skipped: {key}")
+        for doc_id in result["replaced"]:
+            print(f"Merged a near-duplicate, replaced: {doc_id}")
+
+    def parse_commands(self, next_task):
+        # Planner returns either one command or a batch: {"commands": [{"command_name", "command_args"}, ...]}
+        try:
+            commands = next_task["commands"] if "commands" in next_task else [next_task]
+            return [(command["command_name"], command["command_args"]) for command in commands[:self.max_batch_size]]
+        except Exception as e:
+            return None
+
+    def run_command(self, task_name, task_args):
+        if task_name == "search":
+            search_task = task.SearchTask("search", task_args)
+            return f"search: {task_args['query']}", search_task.execute()
+        elif task_name == "browse":
+            browse_task = task.BrowseTask("browse", dict(task_args, parallel_summary=True))
+            return f"browse: {task_args['url']}-{task_args['question']}", browse_task.execute()
+        elif task_name == "math":
+            math_task = task.MathTask("math", task_args)
+            return f"math: {task_args['question']}", math_task.execute()
+        return None
+
+    def command_key(self, task_name, task_args):
+        return json.dumps([task_name, task_args], sort_keys=True)
+
+    def run_commands(self, commands, started=None):
+        # Independent commands run concurrently; results land in short-term memory before the next planning step
+        started = started or dict()
+        futures = [started.get(self.command_key(task_name, task_args)) or command_executor.submit(self.run_command, task_name, task_args) for task_name, task_args in commands]
+        for (task_name, task_args), future in zip(commands, futures):
+            try:
+                output = future.result()
+            except Exception as e:
+                print(f"Command Error: {task_name} {task_args} -> {e}")
+                output = None
+            if output:
+                key, result = output
+                self.short_term_memory.add(key=key, value=result)
+            self.action_history.add("assistant", f"command_name: {task_name} command_args: {task_args} has been tried. Don't use this same command again.")
+
+    def plan(self, planner, streaming):
+        # Runs the planner off the generator thread: yields ("token", str) while generating, then ("result", (next_task, uuids))
+        events = queue.Queue()
+
+        def run_planner():
+            try:
+                token_callback = (lambda token: events.put(("token", token))) if streaming else None
+                events.put(("result", planner.execute(token_callback=token_callback)))
+            except Exception as e:
+                events.put(("error", e))
+
+        threading.Thread(target=run_planner, daemon=True).start()
+        while True:
+            kind, payload = events.get()
+            if kind == "error":
+                raise payload
+            yield kind, payload
+            if kind == "result":
+                break
 
-                # Similarity Check
-                if self.long_term_memory.query(doc_key, top_k=5, threshold=0.1):
-                    print("Alreay has the item. Skipped.")
-                else:
-                    self.long_term_memory.add([doc_key], [doc_content])
-
-    def receive(self, query, socket_config):
-        sio, sid = socket_config
-
-        # Add user_input into history
+    def events(self, query, streaming=True):
+        # Agent loop as an event generator: every yielded dict is one message for the client
         self.history.add("user", query)
+        self.short_term_memory.new_turn()
 
         # Long-term memory candidates (UUID)
         lt_candidates = set()
@@ -67,64 +136,86 @@ class Agent(object):
         while self.credit:
             self.credit -= 1
 
+            if self.cancel_event.is_set():
+                print("Session cancelled, stop processing.")
+                break
+
             long_term_memory = self.long_term_memory.convert(self.long_term_memory.query(query, top_k=5, threshold=0.3))
             short_term_memory = self.short_term_memory.convert_with_meta(self.short_term_memory.query(query, top_k=5))
 
             planner = task.PLANTask("planner", {
                 "fast_model": False, 
+                "parallel_summary": True,
                 "prefix_messages": prompt.get_prefix_messages(self.name, self.personalities), 
                 "query": query,
-                "history": self.history.query(top_k=5),
+                "history": self.history.recent(top_k=5),
+                "history_model": self.history.count_model,
                 "action_history": self.action_history.query(top_k=5),
                 "long_term_memory": long_term_memory,
                 "short_term_memory": short_term_memory,
             })
 
             if long_term_memory:
-                sio.emit('message', {'content': f"🧠 Retrieving knowledge from the long-term memory.", "style": "system"}, room=sid)
-
-            sio.emit('message', {'content': f"🪄 Processing...", "style": "system"}, room=sid)
-            next_task, short_term_uuids = planner.execute()
+                yield {'content': f"🧠 Retrieving knowledge from the long-term memory.", "style": "system"}
+
+            yield {'content': f"🪄 Processing...", "style": "system"}
+
+            # Stream the response text token by token, and start tools as soon as their arguments are complete
+            # Only commands the final parse can keep are started early: at most max_batch_size, none once a response streams
+            parser = stream.PlannerStreamParser()
+            started = dict()
+            responding = False
+            for kind, payload in self.plan(planner, streaming):
+                if kind == "result":
+                    next_task, short_term_uuids = payload
+                    continue
+                response_delta, streamed_commands = parser.feed(payload)
+                if response_delta:
+                    responding = True
+                    yield {'content': response_delta, "style": "partial"}
+                for task_name, task_args in streamed_commands:
+                    if task_name == "response":
+                        responding = True
+                    elif not responding and len(started) < self.max_batch_size:
+                        yield {'content': f"Action: {task_name}, Args: {task_args}", "style": "task"}
+                        started[self.command_key(task_name, task_args)] = command_executor.submit(self.run_command, task_name, task_args)
             lt_candidates.update(short_term_uuids)
 
-            try:
-                task_name = next_task["command_name"]
-                task_args = next_task["command_args"]
-            except Exception as e:
+            commands = self.parse_commands(next_task)
+            # Started commands the final parse won't run (dropped, or the turn ends with a response): withdraw them if not begun yet
+            runs = bool(commands) and not any(task_name == "response" for task_name, _ in commands)
+            kept = {self.command_key(task_name, task_args) for task_name, task_args in commands} if runs else set()
+            for key in [key for key in started if key not in kept]:
+                started.pop(key).cancel()
+
+            if not commands:
                 self.history.add("assistant", str(next_task))
-                sio.emit('message', {'content': f"🗣️ {next_task}", "style": "speak"}, room=sid)
+                yield {'content': f"🗣️ {next_task}", "style": "speak"}
                 break
 
-            if task_name == "response":
-                response = task_args['response']
-                sio.emit('message', {'content': f"🗣️ {response}", "style": "speak"}, room=sid)
+            responses = [task_args for task_name, task_args in commands if task_name == "response"]
+            if responses:
+                response = responses[0]['response']
+                yield {'content': f"🗣️ {response}", "style": "speak"}
                 self.history.add("assistant", response)
-                sio.emit('message', {'content': f"🧠 Moving short-term memory to long-term memory...", "style": "system"}, room=sid)
+                yield {'content': f"🧠 Moving short-term memory to long-term memory...", "style": "system"}
                 self.short2long(query, response, lt_candidates)
                 break
             else:
-                sio.emit('message', {'content': f"Action: {task_name}, Args: {task_args}", "style": "task"}, room=sid)
-                
-                if task_name == "search":
-                    search_task = task.SearchTask("search", task_args)
-                    result = search_task.execute()
-                    self.short_term_memory.add(key=f"search: {task_args['query']}", value=result)
-                elif task_name == "browse":
-                    browse_task = task.BrowseTask("browse", task_args)
-                    result = browse_task.execute()
-                    self.short_term_memory.add(key=f"browse: {task_args['url']}-{task_args['question']}", value=result)
-                elif task_name == "math":
-                    math_task = task.MathTask("math", task_args)
-                    result = math_task.execute()
-                    self.short_term_memory.add(key=f"math: {task_args['question']}", value=result)
-                else:
-                    pass
-
-                self.action_history.add("assistant", f"command_name: {task_name} command_args: {task_args} has been tried. Don't use this same command again.")
+                for task_name, task_args in commands:
+                    if self.command_key(task_name, task_args) not in started:
+                        yield {'content': f"Action: {task_name}, Args: {task_args}", "style": "task"}
+                self.run_commands(commands, started)
+
+    def receive(self, query, socket_config):
+        sio, sid = socket_config
+        for event in self.events(query, streaming=True):
+            sio.emit('message', event, room=sid)
 
     def execute(self, query):
         # Add user_input into history
         self.history.add("user", query)
+        self.short_term_memory.new_turn()
 
         # Long-term memory candidates (UUID)
         lt_candidates = set()
@@ -137,9 +228,11 @@ class Agent(object):
 
             planner = task.PLANTask("planner", {
                 "fast_model": False, 
+                "parallel_summary": True,
                 "prefix_messages": prompt.get_prefix_messages(self.name, self.personalities), 
                 "query": query,
-                "history": self.history.query(top_k=5),
+                "history": self.history.recent(top_k=5),
+                "history_model": self.history.count_model,
                 "action_history": self.action_history.query(top_k=5),
                 "long_term_memory": self.long_term_memory.convert(self.long_term_memory.query(query, top_k=5, threshold=0.3)),
                 "short_term_memory": self.short_term_memory.convert_with_meta(self.short_term_memory.query(query, top_k=5)),
@@ -148,33 +241,24 @@ class Agent(object):
             next_task, short_term_uuids = planner.execute()
             lt_candidates.update(short_term_uuids)
 
-            try:
-                task_name = next_task["command_name"]
-                task_args = next_task["command_args"]
-            except Exception as e:
+            commands = self.parse_commands(next_task)
+            if not commands:
                 self.history.add("assistant", str(next_task))
                 return str(next_task)
 
-            if task_name == "response":
-                response = task_args['response']
+            responses = [task_args for task_name, task_args in commands if task_name == "response"]
+            if responses:
+                response = responses[0]['response']
                 self.history.add("assistant", response)
                 self.short2long(query, response, lt_candidates)
                 return response
-            else:                
-                if task_name == "search":
-                    search_task = task.SearchTask("search", task_args)
-                    result = search_task.execute()
-                    self.short_term_memory.add(key=f"search: {task_args['query']}", value=result)
-                elif task_name == "browse":
-                    browse_task = task.BrowseTask("browse", task_args)
-                    result = browse_task.execute()
-                    self.short_term_memory.add(key=f"browse: {task_args['url']}-{task_args['question']}", value=result)
-                else:
-                    pass
-
-                self.action_history.add("assistant", f"command_name: {task_name} command_args: {task_args} has been tried. Don't use this same command again.")
+            else:
+                self.run_commands(commands)
         return "Sorry, I can't respend to it."     
 
+# Shared by all agents, bounds the number of tool calls in flight
+command_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("AGENT_COMMAND_WORKERS", 8)))
+
 if __name__ ==  "__main__":
     agent = Agent("CISCO_BOT", ["help customers solving their problems"])
 
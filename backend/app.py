@@ -12,8 +12,12 @@ import eventlet
 socketio = eventlet.import_patched("socketio")
 
 import utils
+import atexit
 import agent
 import kuibu
+import worker
+import session
+import consolidation
 
 sio = socketio.Server(cors_allowed_origins="*")
 app = socketio.WSGIApp(socketio_app=sio, static_files={
@@ -23,22 +27,42 @@ app = socketio.WSGIApp(socketio_app=sio, static_files={
     "/index.js": "../frontend/index.js",
 })
 
-bot = agent.Agent("DYNAMIND_BOT", ["help customers solving their problems"])
+envs = utils.get_envs()
+sessions = session.SessionManager("DYNAMIND_BOT", ["help customers solving their problems"], max_sessions=int(envs.get("MAX_SESSIONS", 64)), ttl=int(envs.get("SESSION_TTL", 1800)))
+sessions.start(float(envs.get("SESSION_SWEEP_INTERVAL", 60)))
 # bot = kuibu.KuiBu("DYNAMIND_BOT", ["help customers solving their problems"])
 
+# Agent turns run on real threads, progress messages are emitted back on the server loop
+emitter = worker.Emitter(sio)
+jobs = worker.JobQueue(max_workers=int(envs.get("MAX_WORKERS", 4)), max_pending=int(envs.get("MAX_PENDING_JOBS", 16)))
+# On exit, queued turns get JOB_DRAIN_TIMEOUT seconds to finish
+atexit.register(jobs.shutdown, float(envs.get("JOB_DRAIN_TIMEOUT", 30)))
+
+# Optional background consolidation of the shared long-term memory (seconds between passes, 0 = off)
+consolidator = consolidation.from_env(sessions.long_term_memory)
+if float(envs.get("LONG_TERM_CONSOLIDATE_INTERVAL", 0)) > 0:
+    consolidator.start(float(envs["LONG_TERM_CONSOLIDATE_INTERVAL"]))
+
 @sio.event
-def connect(sid, environ):
+def connect(sid, environ, auth=None):
     print('connect ', sid)
+    # The client's stable session id (kept in its localStorage) keys the persisted history across reconnects
+    sessions.bind(sid, (auth or dict()).get("session_id"))
+    emitter.start()
 
 @sio.event
 def disconnect(sid):
     print('disconnect ', sid)
+    jobs.cancel(sid)
+    sessions.close(sid)
 
 @sio.event
 def receive(sid, data):
     print("=" * 50)
     if data["token"] == utils.get_envs()["SYSTEM_TOKEN"]:
-        bot.receive(data["user_input"], socket_config=(sio, sid))
+        bot = sessions.get(sid)
+        if not jobs.submit(sid, bot.receive, data["user_input"], (emitter, sid)):
+            sio.emit('message', {'content': f"⏳ The server is busy, please try again in a moment.", "style": "system"}, room=sid)
     else:
         sio.emit('message', {'content': f"The door hasn't moved at all, did you enter the wrong token?", "style": "system"}, room=sid)
         print(f"illegal request: {data}")
@@ -0,0 +1,355 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+# Usage (from backend/): python benchmark.py <name> [options]
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from datetime import datetime, timedelta
+from termcolor import cprint
+
+def report(title, rows):
+    cprint(f"== {title} ==", color="blue")
+    for name, value in rows:
+        print(f"{name:<40} {value}")
+
+def bench_startup(args):
+    # Cold start: importing app.py through the first query served (run in a fresh process)
+    timings = list()
+    start = time.perf_counter()
+
+    import app
+    timings += [("import app", time.perf_counter() - start)]
+
+    stage = time.perf_counter()
+    bot = app.sessions.get("benchmark")
+    timings += [("create session", time.perf_counter() - stage)]
+
+    stage = time.perf_counter()
+    bot.long_term_memory.query(args.query, top_k=5, threshold=0.3)
+    timings += [("first long-term query (opens index)", time.perf_counter() - stage)]
+
+    stage = time.perf_counter()
+    bot.short_term_memory.query(args.query, top_k=5)
+    timings += [("first short-term query", time.perf_counter() - stage)]
+
+    if args.full:
+        stage = time.perf_counter()
+        bot.execute(args.query)
+        timings += [("first answer (agent.execute)", time.perf_counter() - stage)]
+
+    timings += [("total", time.perf_counter() - start)]
+    report("startup", [(name, f"{seconds * 1000:.1f} ms") for name, seconds in timings])
+
+class RandomEmbeddings(object):
+    # Synthetic unit vectors, so the benchmarks never call the embedding API
+    def __init__(self, dim, seed=0) -> None:
+        self.dim = dim
+        self.rng = np.random.default_rng(seed)
+
+    def vectors(self, count):
+        vectors = self.rng.standard_normal((count, self.dim)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def embed_query(self, text):
+        return self.vectors(1)[0]
+
+    def embed_documents(self, texts):
+        return list(self.vectors(len(texts)))
+
+def bench_short_term(args):
+    import memory
+    from langchain.schema import Document
+
+    rows = list()
+    for size in args.sizes:
+        embeddings = RandomEmbeddings(args.dim)
+        short_term_memory = memory.ShortTermMemory(capacity=size, embedding_size=args.dim, embeddings_model=embeddings)
+        vectors = embeddings.vectors(size)
+
+        # Fill to capacity, with access times spread over the last day
+        start = time.perf_counter()
+        now = datetime.now()
+        for index in range(size):
+            doc = Document(page_content=f"doc-{index}", metadata={"last_accessed_at": now - timedelta(seconds=int(index) % 86400), "uuid": str(index), "key": f"doc-{index}", "summaries": dict()})
+            short_term_memory.add_vector(doc, vectors[index])
+        fill_seconds = time.perf_counter() - start
+
+        queries = embeddings.vectors(args.queries)
+        start = time.perf_counter()
+        for query_vector in queries:
+            short_term_memory.search(query_vector, top_k=5)
+        query_seconds = (time.perf_counter() - start) / args.queries
+
+        # One add over capacity triggers a batch eviction
+        start = time.perf_counter()
+        short_term_memory.add_vector(Document(page_content="overflow", metadata={"last_accessed_at": now, "uuid": "overflow", "key": "overflow", "summaries": dict()}), vectors[0])
+        evict_seconds = time.perf_counter() - start
+
+        rows += [
+            (f"[{size}] fill (per entry)", f"{fill_seconds / size * 1e6:.1f} us"),
+            (f"[{size}] query top-5", f"{query_seconds * 1000:.2f} ms"),
+            (f"[{size}] evict {int(size * short_term_memory.evict_ratio)} + add", f"{evict_seconds * 1000:.1f} ms"),
+            (f"[{size}] entries after eviction", str(len(short_term_memory))),
+        ]
+    report(f"short-term memory (dim={args.dim})", rows)
+
+def exact_neighbours(vectors, queries, k, chunk_rows=100000):
+    # Brute-force ground truth, a chunk of rows at a time so 1M x dim never needs a full distance matrix
+    best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+    best_distances = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(vectors), chunk_rows):
+        chunk = vectors[start:start + chunk_rows]
+        distances = (chunk ** 2).sum(axis=1)[None, :] - 2 * queries @ chunk.T
+        rows = np.concatenate([best_rows, np.arange(start, start + len(chunk))[None, :].repeat(len(queries), axis=0)], axis=1)
+        distances = np.concatenate([best_distances, distances], axis=1)
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        best_rows, best_distances = np.take_along_axis(rows, top, axis=1), np.take_along_axis(distances, top, axis=1)
+    return [set(rows.tolist()) for rows in best_rows]
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def bench_ann(args):
+    import vector_store
+
+    for size in args.sizes:
+        embeddings = RandomEmbeddings(args.dim)
+        vectors = np.concatenate([embeddings.vectors(min(args.batch_size, size - start)) for start in range(0, size, args.batch_size)])
+        queries = embeddings.vectors(args.queries)
+        truth = exact_neighbours(vectors, queries, args.top_k)
+
+        rows = list()
+        for kind in args.backends:
+            directory = tempfile.mkdtemp(prefix=f"ann-{kind}-")
+            try:
+                if kind == "chroma":
+                    backends = [("chroma", vector_store.ChromaBackend(persist_directory=directory, collection_name="benchmark"))]
+                else:
+                    index_type = kind.split("-")[1]
+                    backend = vector_store.FaissBackend(directory, dim=args.dim, index_type=index_type, nlist=args.nlist)
+                    backends = [(f"{kind} {'nprobe' if index_type == 'ivf' else 'efSearch'}={value}", backend, value) for value in args.search_params]
+
+                # Incremental adds, in the batch size short2long / imports would use
+                backend = backends[0][1]
+                start = time.perf_counter()
+                for offset in range(0, size, args.batch_size):
+                    batch = vectors[offset:offset + args.batch_size]
+                    backend.add([str(offset + row) for row in range(len(batch))], batch, [f"doc-{offset + row}" for row in range(len(batch))])
+                backend.persist()
+                build_seconds = time.perf_counter() - start
+                rows += [
+                    (f"[{kind}] build", f"{build_seconds:.1f} s ({size / build_seconds:.0f} vectors/s)"),
+                    (f"[{kind}] on disk", f"{directory_size(directory) / 2 ** 20:.0f} MiB"),
+                ]
+
+                for setting in backends:
+                    name, backend = setting[0], setting[1]
+                    if len(setting) > 2:
+                        backend.nprobe = backend.ef_search = setting[2]
+                    start = time.perf_counter()
+                    hits = [backend.search([query], args.top_k)[0] for query in queries]
+                    query_seconds = (time.perf_counter() - start) / args.queries
+                    recall = np.mean([len({int(doc_id) for doc_id, _, _ in query_hits} & expected) / args.top_k for query_hits, expected in zip(hits, truth)])
+                    rows += [(f"[{name}] query top-{args.top_k}", f"{query_seconds * 1000:.2f} ms, recall {recall:.3f}")]
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+        report(f"long-term ANN backends ({size} vectors, dim={args.dim})", rows)
+
+def clustered_vectors(embeddings, count, clusters=256, noise=0.3):
+    # Unit vectors around random topics: closer to real embeddings than isotropic noise, which is PQ's worst case
+    centers = embeddings.vectors(clusters)
+    vectors = centers[embeddings.rng.integers(0, clusters, count)] + noise * embeddings.vectors(count)
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+def bench_quantization(args):
+    import quantization
+
+    embeddings = RandomEmbeddings(args.dim)
+    vectors = clustered_vectors(embeddings, args.size)
+    queries = clustered_vectors(embeddings, args.queries)
+    truth = exact_neighbours(vectors, queries, args.top_k)
+
+    codecs = [("float32 (exact)", None)] + [("float16", quantization.get_codec("float16", args.dim))]
+    codecs += [(f"pq m={subspaces}", quantization.ProductQuantizer(args.dim, subspaces=subspaces)) for subspaces in args.subspaces]
+
+    rows = list()
+    for name, codec in codecs:
+        if codec is None:
+            codes, bytes_per_vector = vectors, args.dim * 4
+        else:
+            start = time.perf_counter()
+            codec.train(vectors[:min(args.size, args.train_size)])
+            codes = np.concatenate([codec.encode(vectors[offset:offset + 10000]) for offset in range(0, args.size, 10000)])
+            rows += [(f"[{name}] train + encode", f"{time.perf_counter() - start:.1f} s")]
+            bytes_per_vector = codec.bytes_per_vector()
+        rows += [(f"[{name}] memory", f"{bytes_per_vector} B/vector, {bytes_per_vector * args.size / 2 ** 20:.1f} MiB total")]
+
+        for rerank_factor in ([1] if codec is None else [1] + args.rerank_factors):
+            recalls = list()
+            start = time.perf_counter()
+            for query, expected in zip(queries, truth):
+                if codec is None:
+                    distances = ((codes - query) ** 2).sum(axis=1)
+                else:
+                    distances = codec.squared_distances(codes, query)
+                candidates = np.argpartition(distances, args.top_k * rerank_factor - 1)[:args.top_k * rerank_factor]
+                if rerank_factor > 1:
+                    # Same re-rank as the memory stores: exact vectors for the candidates only
+                    exact = ((vectors[candidates] - query) ** 2).sum(axis=1)
+                    candidates = candidates[np.argsort(exact)[:args.top_k]]
+                recalls += [len(set(candidates[:args.top_k].tolist()) & expected) / args.top_k]
+            query_seconds = (time.perf_counter() - start) / args.queries
+            label = "codes only" if rerank_factor == 1 else f"re-rank {rerank_factor}x"
+            rows += [(f"[{name}] {label}", f"recall@{args.top_k} {np.mean(recalls):.3f}, {query_seconds * 1000:.2f} ms/query")]
+    report(f"vector quantization ({args.size} vectors, dim={args.dim})", rows)
+
+def synthetic_keys(rng, count, vocabulary):
+    # Memory-shaped keys: "search: <query>" and "browse: <url>-<question>"
+    keys = list()
+    for index in range(count):
+        words = " ".join(rng.choice(vocabulary, size=rng.integers(2, 7)))
+        keys += [f"search: {words}" if index % 2 else f"browse: https://example.com/{index}-{words}"]
+    return keys
+
+def bench_lexical(args):
+    import lexical
+
+    rng = np.random.default_rng(0)
+    vocabulary = np.array([f"w{index}" for index in range(args.vocabulary)])
+    rows = list()
+    for size in args.sizes:
+        keys = synthetic_keys(rng, size, vocabulary)
+        index = lexical.BM25Index()
+        start = time.perf_counter()
+        index.add([str(row) for row in range(size)], keys)
+        rows += [(f"[{size}] index (per key)", f"{(time.perf_counter() - start) / size * 1e6:.1f} us")]
+
+        # Query mix: stored keys verbatim, stored keys re-cased / re-punctuated, and unseen keys
+        stats = lexical.HybridStats()
+        kinds = rng.choice(["repeat", "variant", "novel"], size=args.queries, p=[args.repeat_ratio, args.variant_ratio, 1 - args.repeat_ratio - args.variant_ratio])
+        novel = synthetic_keys(rng, args.queries, vocabulary)
+        for kind, novel_key in zip(kinds, novel):
+            key = keys[rng.integers(0, size)]
+            query = key if kind == "repeat" else key.upper().replace(":", " -") if kind == "variant" else novel_key
+            start = time.perf_counter()
+            matches = index.search(query, top_k=5)
+            stats.record(bool(matches) and matches[0][2] >= args.confidence, time.perf_counter() - start)
+
+        result = stats.stats()
+        rows += [
+            (f"[{size}] embedding calls saved", f"{result['embedding_calls_saved']} / {result['lookups']} (expected ~{(args.repeat_ratio + args.variant_ratio) * 100:.0f}%)"),
+            (f"[{size}] added latency per lookup", f"{result['lexical_ms_per_lookup']:.3f} ms"),
+        ]
+
+        start = time.perf_counter()
+        index.delete([str(row) for row in range(0, size, 10)])
+        rows += [(f"[{size}] delete 10% (per key)", f"{(time.perf_counter() - start) / (size // 10 or 1) * 1e6:.1f} us")]
+    report(f"lexical (BM25) key index, confidence >= {args.confidence}", rows)
+
+def bench_minhash(args):
+    import minhash
+
+    rng = np.random.default_rng(0)
+    vocabulary = np.array([f"w{index}" for index in range(args.vocabulary)])
+    index = minhash.MinHashIndex(threshold=args.threshold)
+    documents = [list(rng.choice(vocabulary, size=args.words)) for _ in range(args.size)]
+
+    start = time.perf_counter()
+    signatures = [index.signature(" ".join(words)) for words in documents]
+    signature_seconds = (time.perf_counter() - start) / args.size
+    index.add([str(row) for row in range(args.size)], signatures)
+
+    def shingles(tokens):
+        return {" ".join(tokens[start:start + index.shingle_size]) for start in range(len(tokens) - index.shingle_size + 1)}
+
+    # Near-duplicates: stored documents with a share of their words replaced (word-level edits, as in re-fetched pages)
+    rows, detected, expected = list(), 0, 0
+    query_seconds = 0.0
+    for _ in range(args.queries):
+        row = int(rng.integers(0, args.size))
+        words = list(documents[row])
+        edits = rng.choice(len(words), size=int(len(words) * rng.uniform(0, args.max_edit_ratio)), replace=False)
+        for position in edits:
+            words[position] = rng.choice(vocabulary)
+        original, edited = shingles(documents[row]), shingles(words)
+        is_duplicate = len(original & edited) / len(original | edited) >= args.threshold
+
+        start = time.perf_counter()
+        matches = index.query(index.signature(" ".join(words)))
+        query_seconds += time.perf_counter() - start
+        expected += int(is_duplicate)
+        detected += int(is_duplicate and str(row) in {doc_id for doc_id, _ in matches})
+
+    rows += [
+        ("signature (per document)", f"{signature_seconds * 1000:.3f} ms ({args.words} words)"),
+        ("admission check (signature + LSH query)", f"{query_seconds / args.queries * 1000:.3f} ms"),
+        ("near-duplicates caught", f"{detected} / {expected} with true Jaccard >= {args.threshold}"),
+        ("LSH bands x rows", f"{index.bands} x {index.rows}"),
+    ]
+    report(f"MinHash admission ({args.size} stored documents)", rows)
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "short_term": bench_short_term,
+    "ann": bench_ann,
+    "quantization": bench_quantization,
+    "lexical": bench_lexical,
+    "minhash": bench_minhash,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DynaMind benchmarks")
+    subparsers = parser.add_subparsers(dest="name", required=True)
+
+    startup_parser = subparsers.add_parser("startup", help="cold-start latency from importing app.py to the first query")
+    startup_parser.add_argument("--query", default="What is DynaMind?")
+    startup_parser.add_argument("--full", action="store_true", help="also answer the query end-to-end (calls the LLM)")
+
+    short_term_parser = subparsers.add_parser("short_term", help="bounded short-term memory: fill, query and eviction cost")
+    short_term_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    short_term_parser.add_argument("--dim", type=int, default=1536)
+    short_term_parser.add_argument("--queries", type=int, default=100)
+
+    ann_parser = subparsers.add_parser("ann", help="long-term vector backends: build rate, query latency and recall vs exact search")
+    ann_parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    ann_parser.add_argument("--dim", type=int, default=256, help="1536 matches ada-002 but needs ~6 GiB per 1M vectors")
+    ann_parser.add_argument("--backends", nargs="+", default=["chroma", "faiss-hnsw", "faiss-ivf"], choices=["chroma", "faiss-hnsw", "faiss-ivf"])
+    ann_parser.add_argument("--search-params", type=int, nargs="+", default=[16, 64, 128], help="nprobe (IVF) / efSearch (HNSW) values to sweep")
+    ann_parser.add_argument("--nlist", type=int, default=1024)
+    ann_parser.add_argument("--batch-size", type=int, default=5000)
+    ann_parser.add_argument("--queries", type=int, default=100)
+    ann_parser.add_argument("--top-k", type=int, default=10)
+
+    quantization_parser = subparsers.add_parser("quantization", help="float16 / PQ memory vectors: recall vs memory, with and without exact re-ranking")
+    quantization_parser.add_argument("--size", type=int, default=100000)
+    quantization_parser.add_argument("--dim", type=int, default=1536)
+    quantization_parser.add_argument("--subspaces", type=int, nargs="+", default=[32, 64, 128])
+    quantization_parser.add_argument("--rerank-factors", type=int, nargs="+", default=[4, 16])
+    quantization_parser.add_argument("--train-size", type=int, default=20000)
+    quantization_parser.add_argument("--queries", type=int, default=100)
+    quantization_parser.add_argument("--top-k", type=int, default=10)
+
+    lexical_parser = subparsers.add_parser("lexical", help="BM25 key index: embedding calls saved by confident matches and the latency it adds")
+    lexical_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    lexical_parser.add_argument("--vocabulary", type=int, default=20000)
+    lexical_parser.add_argument("--queries", type=int, default=1000)
+    lexical_parser.add_argument("--repeat-ratio", type=float, default=0.3)
+    lexical_parser.add_argument("--variant-ratio", type=float, default=0.2)
+    lexical_parser.add_argument("--confidence", type=float, default=0.9)
+
+    minhash_parser = subparsers.add_parser("minhash", help="MinHash / LSH near-duplicate admission: latency and detection rate")
+    minhash_parser.add_argument("--size", type=int, default=10000)
+    minhash_parser.add_argument("--words", type=int, default=300)
+    minhash_parser.add_argument("--vocabulary", type=int, default=20000)
+    minhash_parser.add_argument("--queries", type=int, default=500)
+    minhash_parser.add_argument("--max-edit-ratio", type=float, default=0.2)
+    minhash_parser.add_argument("--threshold", type=float, default=0.8)
+
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
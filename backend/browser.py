@@ -0,0 +1,412 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import os
+import re
+import mmap
+import codecs
+import time
+import queue
+import atexit
+import requests
+import tempfile
+import threading
+from html.parser import HTMLParser
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, TimeoutError
+from termcolor import cprint
+
+class PageCache(object):
+    def __init__(self, ttl=600, max_bytes=64 * 1024 * 1024, revalidate_timeout=5) -> None:
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.revalidate_timeout = revalidate_timeout
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.lock = threading.RLock()
+        self.index = OrderedDict()
+
+    def get(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Fresh hit
+            if time.time() - entry["fetched_at"] < self.ttl:
+                self.index.move_to_end(url)
+                self.hits += 1
+                return entry["content"]
+
+        # Stale: revalidate with a conditional request (ETag / Last-Modified), outside the lock
+        if self.revalidate(url, entry):
+            with self.lock:
+                entry["fetched_at"] = time.time()
+                self.index.move_to_end(url)
+                self.revalidations += 1
+                self.hits += 1
+            return entry["content"]
+
+        with self.lock:
+            self._delete(url)
+            self.misses += 1
+        return None
+
+    def revalidate(self, url, entry) -> bool:
+        headers = dict()
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        if not headers:
+            return False
+        try:
+            with requests.get(url, headers=headers, timeout=self.revalidate_timeout, stream=True) as response:
+                return response.status_code == 304
+        except Exception as e:
+            print(f"Page Revalidation Error: {e}")
+            return False
+
+    def set(self, url, content, headers=None) -> None:
+        headers = {k.lower(): v for k, v in (headers or dict()).items()}
+        size = len(content.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._delete(url)
+            self.index[url] = {
+                "content": content,
+                "etag": headers.get("etag"),
+                "last_modified": headers.get("last-modified"),
+                "fetched_at": time.time(),
+                "size": size,
+            }
+            self.total_bytes += size
+
+            # Size-based eviction (least recently used first)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.index.popitem(last=False)
+                self.total_bytes -= evicted["size"]
+
+    def delete(self, url) -> None:
+        with self.lock:
+            self._delete(url)
+
+    def _delete(self, url) -> None:
+        entry = self.index.pop(url, None)
+        if entry:
+            self.total_bytes -= entry["size"]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "size": len(self.index),
+                "bytes": self.total_bytes,
+            }
+
+class BrowserPool(object):
+    # Playwright's sync API is bound to the thread that started it, so each worker owns one browser and context
+    def __init__(self, size=2, remove_selectors=("header", "footer"), timeout=30000, render_timeout=120) -> None:
+        self.size = size
+        self.remove_selectors = list(remove_selectors)
+        self.timeout = timeout
+        # Seconds a caller waits for its page, queueing included
+        self.render_timeout = render_timeout
+        self.jobs = queue.Queue()
+        self.workers = list()
+        self.lock = threading.Lock()
+        self.launch_error = None
+
+    def start(self) -> None:
+        # Also replaces workers that died (e.g. the browser failed to launch)
+        with self.lock:
+            self.workers = [worker for worker in self.workers if worker.is_alive()]
+            for index in range(len(self.workers), self.size):
+                worker = threading.Thread(target=self.work, name=f"browser-{index}", daemon=True)
+                worker.start()
+                self.workers += [worker]
+
+    def fail_pending(self, error) -> None:
+        # Queued jobs fail right away instead of waiting for a browser that never comes up (shutdown markers are kept)
+        stops = 0
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                stops += 1
+                continue
+            _, future = job
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+        for _ in range(stops):
+            self.jobs.put(None)
+
+    def work(self) -> None:
+        try:
+            from playwright.sync_api import sync_playwright
+
+            with sync_playwright() as playwright:
+                browser = playwright.chromium.launch(headless=True)
+                context = browser.new_context()
+                self.serve(context)
+                context.close()
+                browser.close()
+        except Exception as e:
+            print(f"Browser Worker Error: {e}")
+            # Under the lock: render() only queues a job while some worker is registered, so no job is left behind.
+            # Queued jobs fail only with the last worker; while another one is up, it serves them.
+            with self.lock:
+                self.launch_error = e
+                if threading.current_thread() in self.workers:
+                    self.workers.remove(threading.current_thread())
+                if not self.workers:
+                    self.fail_pending(e)
+
+    def serve(self, context) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            url, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.render_page(context, url))
+            except Exception as e:
+                future.set_exception(e)
+
+    def render_page(self, context, url):
+        # One page per job, so concurrent pages are bounded by the pool size
+        from unstructured.partition.html import partition_html
+
+        page = context.new_page()
+        try:
+            response = page.goto(url, timeout=self.timeout)
+            for selector in self.remove_selectors:
+                for element in page.locator(selector).all():
+                    if element.is_visible():
+                        element.evaluate("element => element.remove()")
+            elements = partition_html(text=page.content())
+            text = "\n\n".join([str(element) for element in elements])
+            headers = response.headers if response else dict()
+            return text, headers
+        finally:
+            page.close()
+
+    def render(self, url):
+        self.start()
+        future = Future()
+        with self.lock:
+            if not self.workers:
+                raise RuntimeError(f"No browser worker available: {self.launch_error}")
+            self.jobs.put((url, future))
+        try:
+            return future.result(timeout=self.render_timeout)
+        except TimeoutError:
+            # Still queued: withdraw the job so no worker renders it later
+            future.cancel()
+            raise
+
+    def close(self) -> None:
+        with self.lock:
+            for _ in self.workers:
+                self.jobs.put(None)
+            self.workers = list()
+
+class HTMLTextExtractor(HTMLParser):
+    # Lightweight HTML-to-text for static pages (mirrors the header/footer removal of the browser path)
+    SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "header", "footer", "nav"}
+    BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "pre", "blockquote", "table"}
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.skip_depth = 0
+        self.parts = list()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts += ["\n"]
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts += ["\n"]
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts += [data]
+
+    def get_text(self) -> str:
+        text = "".join(self.parts)
+        lines = [re.sub(r"[ \t\r\f\v]+", " ", line).strip() for line in text.split("\n")]
+        return "\n\n".join([line for line in lines if line])
+
+def html_to_text(html) -> str:
+    extractor = HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.get_text()
+
+def needs_javascript(html, text, min_text_length=200) -> bool:
+    # Client-side rendered pages ship an empty mount point and little static text
+    if len(text) < min_text_length:
+        return True
+    if re.search(r"<noscript[^>]*>[^<]*(enable|requires?) javascript", html, re.IGNORECASE):
+        return True
+    return bool(re.search(r"<div[^>]+id=[\"'](root|app|__next|__nuxt)[\"'][^>]*>\s*</div>", html, re.IGNORECASE))
+
+def pdf_to_text(path) -> str:
+    # Memory-mapped so large PDFs are paged in on demand instead of read into RAM
+    from pypdf import PdfReader
+
+    with open(path, "rb") as pdf_f:
+        with mmap.mmap(pdf_f.fileno(), 0, access=mmap.ACCESS_READ) as pdf_map:
+            reader = PdfReader(pdf_map)
+            return "\n\n".join([page.extract_text() or "" for page in reader.pages])
+
+class Fetcher(object):
+    # Tiered fetch: plain HTTP first, PDF extraction for documents, Playwright only when JavaScript is needed
+    def __init__(self, cache=None, timeout=15, max_bytes=20 * 1024 * 1024, max_pdf_bytes=50 * 1024 * 1024, chunk_size=64 * 1024) -> None:
+        self.cache = cache
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_pdf_bytes = max_pdf_bytes
+        self.chunk_size = chunk_size
+        self.headers = {"User-Agent": "Mozilla/5.0 (compatible; DynaMind/1.0)"}
+        self.lock = threading.Lock()
+        self.path_counts = defaultdict(int)
+        self.path_seconds = defaultdict(float)
+
+    def fetch(self, url, file_type="unknown"):
+        start = time.time()
+        content, path = self._fetch(url, file_type)
+        with self.lock:
+            self.path_counts[path] += 1
+            self.path_seconds[path] += time.time() - start
+        cprint(f"[Fetcher] {url} -> {path} ({time.time() - start:.2f}s)", color="yellow")
+        return content, path
+
+    def _fetch(self, url, file_type):
+        content = self.cache.get(url) if self.cache is not None else None
+        if content is not None:
+            return content, "cache"
+
+        try:
+            content, headers, path = self.fetch_http(url, file_type)
+        except Exception as e:
+            print(f"HTTP Fetch Error: {e}, falling back to the browser.")
+            content, headers, path = None, dict(), "browser"
+
+        if content is None:
+            content, headers = get_browser_pool().render(url)
+            path = "browser"
+
+        # Empty content (e.g. an oversized PDF that was skipped) is not cached as if it were the page
+        if self.cache is not None and content:
+            self.cache.set(url, content, headers)
+        return content, path
+
+    def fetch_http(self, url, file_type):
+        with requests.get(url, headers=self.headers, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "").lower()
+            is_pdf = "application/pdf" in content_type or file_type == "pdf" or url.lower().split("?")[0].endswith(".pdf")
+
+            if is_pdf:
+                # Stream to disk, never holding the whole document in memory
+                with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        pdf_f.write(chunk)
+                        if pdf_f.tell() > self.max_pdf_bytes:
+                            # A truncated PDF can't be parsed, and the browser can't do better: skip the document
+                            print(f"PDF larger than {self.max_pdf_bytes} bytes, skipped: {url}")
+                            return "", response.headers, "pdf"
+                    pdf_f.flush()
+                    return pdf_to_text(pdf_f.name), response.headers, "pdf"
+
+            if content_type and "html" not in content_type and not content_type.startswith("text/"):
+                return None, response.headers, "browser"
+
+            body = bytearray()
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                body += chunk
+                if len(body) > self.max_bytes:
+                    break
+            html = body.decode(self.get_encoding(response, body), errors="replace")
+
+        text = html_to_text(html) if "html" in content_type or "<html" in html[:1000].lower() else html
+        if needs_javascript(html, text):
+            return None, response.headers, "browser"
+        return text, response.headers, "http"
+
+    @staticmethod
+    def get_encoding(response, body) -> str:
+        # requests assumes ISO-8859-1 for any text/* without a charset: use the header only when it names one
+        if "charset=" in response.headers.get("Content-Type", "").lower():
+            return response.encoding
+        match = re.search(rb"<meta[^>]+charset=[\"']?([\w-]+)", bytes(body[:4096]), re.IGNORECASE)
+        if match:
+            try:
+                return codecs.lookup(match.group(1).decode("ascii")).name
+            except LookupError:
+                pass
+        try:
+            body.decode("utf-8")
+            return "utf-8"
+        except UnicodeDecodeError:
+            return response.apparent_encoding or "utf-8"
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {path: {"count": count, "avg_seconds": self.path_seconds[path] / count} for path, count in self.path_counts.items()}
+
+browser_pool = None
+page_cache = PageCache(
+    ttl=int(os.environ.get("PAGE_CACHE_TTL", 600)),
+    max_bytes=int(os.environ.get("PAGE_CACHE_BYTES", 64 * 1024 * 1024)),
+)
+
+def get_browser_pool() -> BrowserPool:
+    global browser_pool
+    if browser_pool is None:
+        browser_pool = BrowserPool(size=int(os.environ.get("BROWSER_POOL_SIZE", 2)), render_timeout=int(os.environ.get("BROWSER_RENDER_TIMEOUT", 120)))
+        atexit.register(browser_pool.close)
+    return browser_pool
+
+fetcher = Fetcher(cache=page_cache, max_pdf_bytes=int(os.environ.get("FETCH_MAX_PDF_BYTES", 50 * 1024 * 1024)))
+
+def fetch(url, file_type="unknown"):
+    return fetcher.fetch(url, file_type)
+
+if __name__ == "__main__":
+    # Render fixture pages from a local HTTP server: python browser.py [fixture_dir] (tests/test_browser.py covers the same tiers)
+    import sys
+    import functools
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+    fixture_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join("tests", "fixtures", "browser")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(SimpleHTTPRequestHandler, directory=fixture_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    for name in sorted(os.listdir(fixture_dir)):
+        if name.endswith((".html", ".pdf")):
+            for attempt in ["cold", "warm"]:
+                start = time.time()
+                content, path = fetch(f"{base_url}/{name}")
+                cprint(f"{name} [{attempt}] {len(content)} chars via {path} in {time.time() - start:.3f}s", color="green")
+    cprint(page_cache.stats(), color="blue")
+    cprint(fetcher.stats(), color="blue")
+    server.shutdown()
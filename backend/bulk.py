@@ -0,0 +1,160 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+# Streaming import / export of the long-term knowledge store (driven by `python memory.py import|export ...`)
+
+import os
+import csv
+import json
+import time
+import uuid
+import cache
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+def read_records(path, key_field="key", value_field="value"):
+    # (key, value, embedding or None) one record at a time; a missing key falls back to the value
+    with open(path, "r", newline="", encoding="utf-8") as source_f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(source_f):
+                yield row.get(key_field) or row[value_field], row[value_field], None
+        else:
+            for line in source_f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record.get(key_field) or record[value_field], record[value_field], record.get("embedding")
+
+def record_id(key, value) -> str:
+    # Content-addressed: re-running an import (or resuming one) never stores an entry twice
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, cache.hash_key("long_term", key, value)))
+
+def embed_with_retry(embedding_function, texts, retries):
+    for attempt in range(retries + 1):
+        try:
+            return embedding_function.embed_documents(texts)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f"Embedding Error (attempt {attempt + 1}/{retries + 1}): {e}")
+            time.sleep(2 ** attempt)
+
+def load_checkpoint(checkpoint_path, source) -> int:
+    if not os.path.exists(checkpoint_path):
+        return 0
+    with open(checkpoint_path, "r") as checkpoint_f:
+        checkpoint = json.load(checkpoint_f)
+    return checkpoint["records"] if checkpoint["source"] == source else 0
+
+def save_checkpoint(checkpoint_path, source, records) -> None:
+    with open(f"{checkpoint_path}.tmp", "w") as checkpoint_f:
+        json.dump({"source": source, "records": records}, checkpoint_f)
+    os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+def import_chunk(long_term_memory, embedding_function, executor, chunk, batch_size, retries, dedup, workers=1) -> dict:
+    # Entries already stored (or retired into a consolidated one) are dropped before anything is embedded
+    records = dict()
+    for key, value, embedding in chunk:
+        records.setdefault(record_id(key, value), (key, value, embedding))
+    existing = long_term_memory.index.existing_ids(list(records))
+    records = [(doc_id, record) for doc_id, record in records.items() if doc_id not in existing and doc_id not in long_term_memory.id_map]
+    batches = [records[start:start + batch_size] for start in range(0, len(records), batch_size)]
+
+    stats = {"imported": 0, "skipped": len(chunk) - len(records)}
+    if dedup:
+        def embed_documents(texts):
+            # Only the keys that survive the lexical / MinHash passes reach here: split them over the workers
+            size = -(-len(texts) // workers)
+            parts = [texts[start:start + size] for start in range(0, len(texts), size)]
+            return [vector for vectors in executor.map(lambda part: embed_with_retry(embedding_function, part, retries), parts) for vector in vectors]
+
+        # Admission checks (lexical, MinHash, vector) see every earlier batch, so batches go one at a time
+        for batch in batches:
+            result = long_term_memory.add_batch(
+                [key for _, (key, _, _) in batch],
+                [value for _, (_, value, _) in batch],
+                ids=[doc_id for doc_id, _ in batch],
+                embeddings=[embedding for _, (_, _, embedding) in batch],
+                embed_documents=embed_documents,
+                direct=True,
+            )
+            stats["imported"] += len(result["added"])
+            stats["skipped"] += len(result["skipped"])
+        return stats
+
+    def embed(batch):
+        missing = [key for _, (key, _, embedding) in batch if embedding is None]
+        vectors = iter(embed_with_retry(embedding_function, missing, retries) if missing else [])
+        return [embedding if embedding is not None else next(vectors) for _, (_, _, embedding) in batch]
+
+    # Bounded concurrency: at most `workers` embedding calls in flight, results written in file order.
+    # Straight to the index: the chunk is content-addressed and checkpointed, journaling it would only double the I/O
+    for batch, embeddings in zip(batches, executor.map(embed, batches)):
+        long_term_memory.apply_direct([{
+            "op": "add",
+            "ids": [doc_id for doc_id, _ in batch],
+            "embeddings": [list(map(float, embedding)) for embedding in embeddings],
+            "documents": [value for _, (_, value, _) in batch],
+            "keys": [key for _, (key, _, _) in batch],
+        }])
+        stats["imported"] += len(batch)
+    return stats
+
+def bulk_import(long_term_memory, path, batch_size=256, chunk_size=4096, workers=4, retries=3, checkpoint_path=None, dedup=False, key_field="key", value_field="value") -> dict:
+    # Streams the file a chunk at a time: embed (batched, concurrent), write, persist, checkpoint. Memory stays at one chunk.
+    # Operations journaled before the import are committed first, so the direct writes land after them
+    long_term_memory.open()
+    long_term_memory.flush()
+    source = os.path.abspath(path)
+    checkpoint_path = checkpoint_path or f"{path}.checkpoint"
+    done = load_checkpoint(checkpoint_path, source)
+    if done:
+        print(f"Resuming {path} after {done} records.")
+
+    # Imported texts are unique: go straight to the embedding client instead of filling the query cache
+    embedding_function = long_term_memory.embedding_function
+    embedding_function = getattr(embedding_function, "embeddings", embedding_function)
+
+    records = itertools.islice(read_records(path, key_field, value_field), done, None)
+    stats = {"records": done, "imported": 0, "skipped": 0, "seconds": 0.0}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="import") as executor:
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            chunk_stats = import_chunk(long_term_memory, embedding_function, executor, chunk, batch_size, retries, dedup, workers)
+            # One persist per chunk, then the checkpoint: an interrupted import resumes from the last committed chunk
+            long_term_memory.persist()
+            stats["records"] += len(chunk)
+            stats["imported"] += chunk_stats["imported"]
+            stats["skipped"] += chunk_stats["skipped"]
+            save_checkpoint(checkpoint_path, source, stats["records"])
+
+            stats["seconds"] = time.perf_counter() - started
+            print(f"{stats['records']} records, {stats['imported']} imported, {stats['skipped']} skipped, {stats['imported'] / stats['seconds']:.1f} entries/s")
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    stats["seconds"] = time.perf_counter() - started
+    stats["entries_per_second"] = stats["imported"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+def bulk_export(long_term_memory, path, batch_size=1000, embeddings=False) -> dict:
+    # Streams every live entry out as JSONL ({"id", "key", "value"[, "embedding"]}) or CSV (id, key, value)
+    long_term_memory.open()
+    long_term_memory.flush()
+    started, count = time.perf_counter(), 0
+    with open(path, "w", newline="", encoding="utf-8") as target_f:
+        writer = csv.DictWriter(target_f, fieldnames=["id", "key", "value"]) if path.endswith(".csv") else None
+        if writer is not None:
+            writer.writeheader()
+        for entries in long_term_memory.index.iter_entries(batch_size, embeddings=embeddings and writer is None):
+            for entry in entries:
+                if writer is not None:
+                    writer.writerow(entry)
+                else:
+                    target_f.write(json.dumps(entry) + "\n")
+            count += len(entries)
+    seconds = time.perf_counter() - started
+    return {"exported": count, "seconds": seconds, "entries_per_second": count / seconds if seconds else 0.0}
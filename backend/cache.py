@@ -0,0 +1,153 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import time
+import shelve
+import hashlib
+import threading
+from collections import OrderedDict
+
+def hash_key(*parts) -> str:
+    # Content-addressed key: identical inputs always map to the same entry
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+class LRUCache(object):
+    def __init__(self, capacity=1024, ttl=None, path=None) -> None:
+        self.capacity = capacity
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self.index = OrderedDict()
+
+        # Optional on-disk store (survives restarts, not bounded by capacity)
+        self.store = shelve.open(path) if path else None
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.index:
+                value, created_at = self.index[key]
+                if self.ttl is None or time.time() - created_at < self.ttl:
+                    self.index.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.index[key]
+
+            if self.store is not None and key in self.store:
+                value, created_at = self.store[key]
+                if self.ttl is None or time.time() - created_at < self.ttl:
+                    self._put(key, value, created_at)
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value) -> None:
+        with self.lock:
+            created_at = time.time()
+            self._put(key, value, created_at)
+            if self.store is not None:
+                self.store[key] = (value, created_at)
+
+    def _put(self, key, value, created_at) -> None:
+        self.index[key] = (value, created_at)
+        self.index.move_to_end(key)
+        while len(self.index) > self.capacity:
+            self.index.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self.lock:
+            self.index.pop(key, None)
+            if self.store is not None and key in self.store:
+                del self.store[key]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.index.clear()
+            if self.store is not None:
+                self.store.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self.index),
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            if self.store is not None:
+                self.store.close()
+                self.store = None
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            return key in self.index or (self.store is not None and key in self.store)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+class TokenCounter(object):
+    # Chat format overhead: every reply is primed with 3 tokens (see ChatOpenAI.get_num_tokens_from_messages)
+    REPLY_PRIMING = 3
+
+    def __init__(self, capacity=65536) -> None:
+        self.text_counts = LRUCache(capacity=capacity)
+        self.message_counts = LRUCache(capacity=capacity)
+
+    def count_text(self, llm, text) -> int:
+        key = hash_key(getattr(llm, "model_name", "unknown"), text)
+        count = self.text_counts.get(key)
+        if count is None:
+            count = llm.get_num_tokens(text)
+            self.text_counts.set(key, count)
+        return count
+
+    def count_message(self, llm, message) -> int:
+        # Tokens this message adds to a prompt (excluding the reply priming)
+        key = hash_key(getattr(llm, "model_name", "unknown"), message.type, message.content)
+        count = self.message_counts.get(key)
+        if count is None:
+            count = llm.get_num_tokens_from_messages([message]) - self.REPLY_PRIMING
+            self.message_counts.set(key, count)
+        return count
+
+    def count_messages(self, llm, messages) -> int:
+        return self.REPLY_PRIMING + sum(self.count_message(llm, message) for message in messages)
+
+    def fit_messages(self, llm, messages, quota) -> list:
+        # Keep the most recent messages that fit into the quota
+        fitted = list()
+        count = self.REPLY_PRIMING
+        for message in reversed(messages):
+            count += self.count_message(llm, message)
+            if quota - count < 0:
+                break
+            fitted += [message]
+        fitted.reverse()
+        return fitted
+
+    def fit_counted(self, entries, quota):
+        # fit_messages over (message, token count) pairs counted at write time: no tokenizer calls
+        fitted = list()
+        count = self.REPLY_PRIMING
+        for message, tokens in reversed(entries):
+            if quota - count - tokens < 0:
+                break
+            count += tokens
+            fitted += [message]
+        fitted.reverse()
+        return fitted, count
+
+    def stats(self) -> dict:
+        return {"text": self.text_counts.stats(), "message": self.message_counts.stats()}
@@ -0,0 +1,213 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import re
+import ast
+import math
+import operator
+import threading
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+class CalculatorError(Exception):
+    pass
+
+# Upper bounds that keep a single evaluation in the microsecond range
+MAX_EXPONENT = 1000
+MAX_BITS = 4096
+MAX_LENGTH = 256
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+
+UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+FUNCTIONS = {
+    "sqrt": math.sqrt,
+    "log": math.log,
+    "log10": math.log10,
+    "log2": math.log2,
+    "exp": math.exp,
+    "sin": math.sin,
+    "cos": math.cos,
+    "tan": math.tan,
+    "abs": abs,
+    "round": round,
+    "floor": math.floor,
+    "ceil": math.ceil,
+}
+
+CONSTANTS = {
+    "pi": math.pi,
+    "e": math.e,
+}
+
+# Unit conversions: unit -> (dimension, factor to the base unit)
+UNITS = {
+    "mm": ("length", Fraction(1, 1000)), "cm": ("length", Fraction(1, 100)), "m": ("length", Fraction(1)), "km": ("length", Fraction(1000)),
+    "in": ("length", Fraction(254, 10000)), "ft": ("length", Fraction(3048, 10000)), "yd": ("length", Fraction(9144, 10000)), "mi": ("length", Fraction(1609344, 1000)),
+    "mg": ("mass", Fraction(1, 1000000)), "g": ("mass", Fraction(1, 1000)), "kg": ("mass", Fraction(1)), "t": ("mass", Fraction(1000)),
+    "lb": ("mass", Fraction(45359237, 100000000)), "oz": ("mass", Fraction(45359237, 1600000000)),
+    "ms": ("time", Fraction(1, 1000)), "s": ("time", Fraction(1)), "min": ("time", Fraction(60)), "h": ("time", Fraction(3600)), "day": ("time", Fraction(86400)),
+    "ml": ("volume", Fraction(1, 1000)), "l": ("volume", Fraction(1)),
+    "b": ("data", Fraction(1)), "kb": ("data", Fraction(1024)), "mb": ("data", Fraction(1024 ** 2)), "gb": ("data", Fraction(1024 ** 3)), "tb": ("data", Fraction(1024 ** 4)),
+}
+
+UNIT_ALIASES = {
+    "meter": "m", "meters": "m", "metre": "m", "metres": "m", "kilometer": "km", "kilometers": "km", "centimeter": "cm", "centimeters": "cm", "millimeter": "mm", "millimeters": "mm",
+    "inch": "in", "inches": "in", "foot": "ft", "feet": "ft", "yard": "yd", "yards": "yd", "mile": "mi", "miles": "mi",
+    "gram": "g", "grams": "g", "kilogram": "kg", "kilograms": "kg", "kgs": "kg", "pound": "lb", "pounds": "lb", "lbs": "lb", "ounce": "oz", "ounces": "oz", "ton": "t", "tons": "t",
+    "second": "s", "seconds": "s", "sec": "s", "minute": "min", "minutes": "min", "mins": "min", "hour": "h", "hours": "h", "hr": "h", "hrs": "h", "days": "day",
+    "liter": "l", "liters": "l", "litre": "l", "litres": "l", "milliliter": "ml", "milliliters": "ml",
+    "byte": "b", "bytes": "b",
+}
+
+TEMPERATURES = {"c", "f", "k", "celsius", "fahrenheit", "kelvin"}
+
+QUESTION_PREFIX = re.compile(r"^\s*(what\s+is|what's|calculate|compute|evaluate|solve|convert|how\s+much\s+is)\s+", re.IGNORECASE)
+CONVERSION = re.compile(r"^\s*(-?[\d.,]+)\s*([a-z°]+)\s+(?:to|in|into)\s+([a-z°]+)\s*$", re.IGNORECASE)
+PERCENT_OF = re.compile(r"([\d.]+)\s*%\s*of\s*", re.IGNORECASE)
+
+def check_size(value):
+    if isinstance(value, Fraction) and max(abs(value.numerator).bit_length(), value.denominator.bit_length()) > MAX_BITS:
+        raise CalculatorError("Intermediate value too large.")
+    if isinstance(value, float) and not math.isfinite(value):
+        raise CalculatorError("Non-finite result.")
+    return value
+
+def to_float(value):
+    return float(value) if isinstance(value, Fraction) else value
+
+def eval_node(node):
+    if isinstance(node, ast.Expression):
+        return eval_node(node.body)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        # Keep literals exact: 0.1 is 1/10, not the nearest double
+        return Fraction(str(node.value))
+    if isinstance(node, ast.Name) and node.id in CONSTANTS:
+        return CONSTANTS[node.id]
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        return UNARY_OPERATORS[type(node.op)](eval_node(node.operand))
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+        base, exponent = eval_node(node.left), eval_node(node.right)
+        if isinstance(exponent, Fraction) and exponent.denominator == 1 and isinstance(base, Fraction):
+            if abs(exponent) > MAX_EXPONENT:
+                raise CalculatorError("Exponent too large.")
+            if base == 0 and exponent < 0:
+                raise CalculatorError("Division by zero.")
+            return check_size(base ** int(exponent))
+        return check_size(math.pow(to_float(base), to_float(exponent)))
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        left, right = eval_node(node.left), eval_node(node.right)
+        if type(node.op) in (ast.Div, ast.FloorDiv, ast.Mod) and right == 0:
+            raise CalculatorError("Division by zero.")
+        if isinstance(left, float) or isinstance(right, float):
+            left, right = to_float(left), to_float(right)
+        return check_size(BINARY_OPERATORS[type(node.op)](left, right))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+        args = [eval_node(arg) for arg in node.args]
+        if node.func.id in ("abs", "round", "floor", "ceil") and all(isinstance(arg, Fraction) for arg in args):
+            return check_size(Fraction(FUNCTIONS[node.func.id](*args)))
+        return check_size(FUNCTIONS[node.func.id](*[to_float(arg) for arg in args]))
+    raise CalculatorError(f"Unsupported expression: {ast.dump(node)}")
+
+def format_number(value) -> str:
+    if isinstance(value, Fraction):
+        if value.denominator == 1:
+            return str(value.numerator)
+        decimal = f"{float(value):.10g}"
+        return decimal if Fraction(decimal) == value else f"{value} ≈ {decimal}"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return f"{value:.10g}"
+
+def normalize(question) -> str:
+    expression = QUESTION_PREFIX.sub("", question.strip()).rstrip("?.! =")
+    expression = PERCENT_OF.sub(lambda m: f"{m.group(1)}/100*", expression)
+    for symbol, replacement in [("×", "*"), ("÷", "/"), ("^", "**"), ("−", "-")]:
+        expression = expression.replace(symbol, replacement)
+    return re.sub(r"(?<=\d),(?=\d{3}\b)", "", expression)
+
+def convert_temperature(value, source, target):
+    source, target = source[0], target[0]
+    celsius = {"c": value, "f": (value - 32) * Fraction(5, 9), "k": value - Fraction(27315, 100)}[source]
+    return {"c": celsius, "f": celsius * Fraction(9, 5) + 32, "k": celsius + Fraction(27315, 100)}[target]
+
+def convert(expression):
+    match = CONVERSION.match(expression)
+    if not match:
+        return None
+    value, source, target = Fraction(match.group(1).replace(",", "")), match.group(2).lower().lstrip("°"), match.group(3).lower().lstrip("°")
+    if source in TEMPERATURES and target in TEMPERATURES:
+        return f"{format_number(value)} {match.group(2)} = {format_number(convert_temperature(value, source, target))} {match.group(3)}"
+    source_unit, target_unit = UNIT_ALIASES.get(source, source), UNIT_ALIASES.get(target, target)
+    if source_unit not in UNITS or target_unit not in UNITS or UNITS[source_unit][0] != UNITS[target_unit][0]:
+        return None
+    result = value * UNITS[source_unit][1] / UNITS[target_unit][1]
+    return f"{format_number(value)} {match.group(2)} = {format_number(result)} {match.group(3)}"
+
+def evaluate(question):
+    # Returns the answer string, or None when the question is not a plain expression / conversion
+    expression = normalize(question)
+    if not expression or len(expression) > MAX_LENGTH:
+        return None
+    try:
+        conversion = convert(expression)
+        if conversion is not None:
+            return conversion
+        tree = ast.parse(expression, mode="eval")
+        return f"{expression} = {format_number(eval_node(tree))}"
+    except (CalculatorError, SyntaxError, ValueError, TypeError, ZeroDivisionError, OverflowError, RecursionError):
+        return None
+
+class LocalCalculator(object):
+    # First stage of MathTask: answers locally when it can, with a hit-rate metric and a timeout guard
+    def __init__(self, timeout=0.5, max_workers=2) -> None:
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="calculator")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+
+    def evaluate(self, question):
+        try:
+            result = self.executor.submit(evaluate, question).result(timeout=self.timeout)
+        except TimeoutError:
+            result = None
+            with self.lock:
+                self.timeouts += 1
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "timeouts": self.timeouts,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+if __name__ == "__main__":
+    calculator = LocalCalculator()
+    while True:
+        question = input("Math > ")
+        if not question:
+            break
+        print(calculator.evaluate(question), calculator.stats())
@@ -0,0 +1,63 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import os
+import openai
+import requests
+import threading
+import embeddings
+from requests.adapters import HTTPAdapter
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
+
+# Process-wide client registry: tasks borrow clients instead of building them
+registry = dict()
+registry_lock = threading.Lock()
+session = None
+
+def get_session() -> requests.Session:
+    # One keep-alive HTTP session shared by every OpenAI call
+    global session
+    with registry_lock:
+        if session is None:
+            pool_size = int(os.environ.get("OPENAI_POOL_SIZE", 32))
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            openai.requestssession = session
+        return session
+
+def get_model_name(role) -> str:
+    # role: "smart" / "fast", overridable via SMART_LLM_MODEL / FAST_LLM_MODEL in .env
+    defaults = {"smart": "gpt-4", "fast": "gpt-3.5-turbo"}
+    return os.environ.get(f"{role.upper()}_LLM_MODEL", defaults[role])
+
+def get_chat_model(model_name, temperature=0, **kwargs) -> ChatOpenAI:
+    get_session()
+    if "request_timeout" not in kwargs and "OPENAI_REQUEST_TIMEOUT" in os.environ:
+        kwargs["request_timeout"] = int(os.environ["OPENAI_REQUEST_TIMEOUT"])
+    if "max_retries" not in kwargs and "OPENAI_MAX_RETRIES" in os.environ:
+        kwargs["max_retries"] = int(os.environ["OPENAI_MAX_RETRIES"])
+
+    key = ("chat", model_name, temperature) + tuple(sorted(kwargs.items()))
+    with registry_lock:
+        if key not in registry:
+            registry[key] = ChatOpenAI(model_name=model_name, temperature=temperature, **kwargs)
+        return registry[key]
+
+def get_embeddings(**kwargs):
+    # Embeddings are served through a persistent text-hash cache unless EMBEDDING_CACHE_PATH is set to ""
+    get_session()
+    key = ("embeddings",) + tuple(sorted(kwargs.items()))
+    with registry_lock:
+        if key not in registry:
+            embedding_function = OpenAIEmbeddings(**kwargs)
+            cache_path = os.environ.get("EMBEDDING_CACHE_PATH", "cache/embeddings")
+            if cache_path:
+                model_name = getattr(embedding_function, "model", "text-embedding-ada-002")
+                store = embeddings.EmbeddingStore(f"{cache_path}-{model_name}")
+                embedding_function = embeddings.CachedEmbeddings(embedding_function, store, model_name=model_name)
+            registry[key] = embedding_function
+        return registry[key]
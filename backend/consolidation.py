@@ -0,0 +1,130 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+# Usage (from backend/): python consolidation.py   (one offline pass over db/)
+
+import os
+import time
+import task
+import memory
+import threading
+from termcolor import cprint
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class Consolidator(object):
+    # Merges clusters of similar long-term entries into one canonical entry each, off the serving path
+    def __init__(self, long_term_memory, threshold=0.15, max_cluster_size=8, max_clusters=64, llm_workers=2, cpu_share=0.25, batch_size=256, search_size=16) -> None:
+        self.long_term_memory = long_term_memory
+        # Squared L2 distance to the cluster leader (the add_batch dedup threshold is 0.1)
+        self.threshold = threshold
+        self.max_cluster_size = max_cluster_size
+        # Per run: bounds the LLM calls one pass can make
+        self.max_clusters = max_clusters
+        self.llm_executor = ThreadPoolExecutor(max_workers=llm_workers, thread_name_prefix="consolidate")
+        # Clustering sleeps between batches so it stays under this share of one core
+        self.cpu_share = cpu_share
+        self.batch_size = batch_size
+        # Queries per backend search: each search holds the backend lock, so serving searches and commits only wait for a slice
+        self.search_size = search_size
+        self.stop_event = threading.Event()
+        self.run_lock = threading.Lock()
+
+    def throttle(self, started):
+        elapsed = time.perf_counter() - started
+        self.stop_event.wait(elapsed * (1 - self.cpu_share) / self.cpu_share)
+
+    def clusters(self):
+        # Greedy leader clustering with the stored embeddings and the backend's own nearest-neighbour search
+        index = self.long_term_memory.index
+        assigned, clusters, scanned = set(), list(), 0
+        for batch in index.iter_entries(self.batch_size, embeddings=True):
+            started = time.perf_counter()
+            scanned += len(batch)
+            batch = [entry for entry in batch if entry["id"] not in assigned]
+            neighbours = list()
+            for start in range(0, len(batch), self.search_size):
+                neighbours += index.search([entry["embedding"] for entry in batch[start:start + self.search_size]], self.max_cluster_size)
+            for entry, hits in zip(batch, neighbours):
+                if entry["id"] in assigned:
+                    continue
+                members = [(entry["id"], entry["value"])] + [(hit_id, hit_document) for hit_id, hit_document, distance in hits if hit_id != entry["id"] and hit_id not in assigned and distance < self.threshold]
+                if len(members) > 1:
+                    # The leader's embedding and key carry over to the canonical entry
+                    clusters += [(members, entry["embedding"], entry["key"])]
+                    assigned |= {member_id for member_id, _ in members}
+            if len(clusters) >= self.max_clusters or self.stop_event.is_set():
+                break
+            self.throttle(started)
+        return clusters[:self.max_clusters], scanned
+
+    def summarize(self, members):
+        # One summarization pass per cluster
+        text = "\n\n".join(f"[{index + 1}] {document}" for index, (_, document) in enumerate(members))
+        return task.SummaryTask("summary", {
+            "text": text,
+            "question": "everything the entries above state, as one self-contained knowledge entry without repeating shared facts",
+            "fast_model": True,
+        }).execute()
+
+    def merge(self, members, embedding, key, summary):
+        # Entries deleted or merged since clustering are left out; what remains is retired in one journaled operation
+        member_ids = [member_id for member_id, _ in members]
+        existing = self.long_term_memory.index.existing_ids(member_ids)
+        retired = [member_id for member_id in member_ids if member_id in existing]
+        if len(retired) < 2:
+            return list()
+        self.long_term_memory.replace(retired, embedding, summary, key)
+        return retired
+
+    def run_once(self) -> dict:
+        with self.run_lock:
+            self.long_term_memory.open()
+            clusters, scanned = self.clusters()
+            stats = {"scanned": scanned, "clusters": len(clusters), "merged": 0, "retired": 0, "failed": 0}
+
+            futures = {self.llm_executor.submit(self.summarize, members): (members, embedding, key) for members, embedding, key in clusters}
+            for future in as_completed(futures):
+                members, embedding, key = futures[future]
+                try:
+                    retired = self.merge(members, embedding, key, future.result())
+                except Exception as e:
+                    print(f"Consolidation Error: {[member_id for member_id, _ in members]} -> {e}")
+                    stats["failed"] += 1
+                    continue
+                if retired:
+                    stats["merged"] += 1
+                    stats["retired"] += len(retired)
+            return stats
+
+    def loop(self, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                stats = self.run_once()
+                if stats["merged"]:
+                    print(f"Long-term memory consolidated: {stats}")
+            except Exception as e:
+                print(f"Consolidation Error: {e}")
+
+    def start(self, interval) -> None:
+        # Background mode: one pass every `interval` seconds on a daemon thread
+        threading.Thread(target=self.loop, args=(interval,), name="long-term-consolidate", daemon=True).start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+def from_env(long_term_memory) -> Consolidator:
+    return Consolidator(
+        long_term_memory,
+        threshold=float(os.environ.get("CONSOLIDATE_THRESHOLD", 0.15)),
+        max_clusters=int(os.environ.get("CONSOLIDATE_MAX_CLUSTERS", 64)),
+        llm_workers=int(os.environ.get("CONSOLIDATE_LLM_WORKERS", 2)),
+        cpu_share=float(os.environ.get("CONSOLIDATE_CPU_SHARE", 0.25)),
+    )
+
+if __name__ == "__main__":
+    long_term_memory = memory.LongTermMemory()
+    consolidator = from_env(long_term_memory)
+    stats = consolidator.run_once()
+    long_term_memory.flush()
+    cprint(f"Consolidation finished: {stats}", color="green")
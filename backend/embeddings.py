@@ -0,0 +1,144 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import os
+import cache
+import fcntl
+import contextlib
+import threading
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+class EmbeddingStore(object):
+    # Compact on-disk vectors: <path>.f32 is a memory-mapped float32 matrix, <path>.idx maps key -> row (append-only)
+    # Several processes share the files (app, memory.py import, consolidation.py): rows are assigned under an flock on .idx
+    def __init__(self, path, dim=1536, grow_rows=4096) -> None:
+        self.path = path
+        self.dim = dim
+        self.grow_rows = grow_rows
+        self.lock = threading.Lock()
+        self.rows = dict()
+        self.next_row = 0
+        self.index_offset = 0
+        self.vectors = None
+        self.capacity = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.index_f = open(f"{path}.idx", "a+b")
+        with self.file_lock(fcntl.LOCK_SH):
+            self.sync()
+        self.resize(max(self.next_row, self.grow_rows))
+
+    @contextlib.contextmanager
+    def file_lock(self, mode):
+        fcntl.flock(self.index_f.fileno(), mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.index_f.fileno(), fcntl.LOCK_UN)
+
+    def sync(self) -> None:
+        # Read the .idx tail written since the last sync (by any process); call with the file lock held
+        self.index_f.seek(self.index_offset)
+        data = self.index_f.read()
+        data = data[:data.rfind(b"\n") + 1]
+        for line in data.decode("utf-8").splitlines():
+            key, row = line.split("\t")
+            self.rows[key] = int(row)
+            self.next_row = max(self.next_row, int(row) + 1)
+        self.index_offset += len(data)
+        if self.vectors is not None and self.next_row > self.capacity:
+            self.resize(self.next_row)
+
+    def resize(self, rows) -> None:
+        # Grow the backing file, then re-map it
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        with open(f"{self.path}.f32", "ab") as vector_f:
+            vector_f.truncate(max(os.path.getsize(f"{self.path}.f32"), rows * self.dim * 4))
+        self.capacity = os.path.getsize(f"{self.path}.f32") // (self.dim * 4)
+        self.vectors = np.memmap(f"{self.path}.f32", dtype=np.float32, mode="r+", shape=(self.capacity, self.dim))
+
+    def get(self, key):
+        with self.lock:
+            row = self.rows.get(key)
+            if row is None:
+                # Maybe stored by another process since the last sync
+                with self.file_lock(fcntl.LOCK_SH):
+                    self.sync()
+                row = self.rows.get(key)
+            return None if row is None else np.array(self.vectors[row])
+
+    def put(self, key, vector) -> None:
+        with self.lock:
+            if key in self.rows:
+                return
+            with self.file_lock(fcntl.LOCK_EX):
+                # Catch up first: the next free row is the one after every row handed out by any process
+                self.sync()
+                if key in self.rows:
+                    return
+                row = self.next_row
+                if row >= self.capacity:
+                    self.resize(self.capacity + self.grow_rows)
+                # The vector is written before its .idx line, so a reader that sees the row sees the vector
+                self.vectors[row] = np.asarray(vector, dtype=np.float32)
+                self.rows[key] = row
+                self.next_row = row + 1
+                self.index_f.write(f"{key}\t{row}\n".encode("utf-8"))
+                self.index_f.flush()
+                self.index_offset = self.index_f.tell()
+
+    def flush(self) -> None:
+        with self.lock:
+            self.vectors.flush()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+class CachedEmbeddings(Embeddings):
+    # Wraps an embedding client: texts seen before (same model) are served from the store without an API call.
+    # Only query embeddings are stored (a query repeats within and across turns); document embeddings are looked up but
+    # never written, otherwise every stored memory entry would also land in the store, which has no eviction
+    def __init__(self, embeddings, store, model_name="text-embedding-ada-002") -> None:
+        self.embeddings = embeddings
+        self.store = store
+        self.model_name = model_name
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text) -> str:
+        return cache.hash_key(self.model_name, text)
+
+    def embed_documents(self, texts):
+        vectors = [self.store.get(self.key(text)) for text in texts]
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        with self.lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        # One batched API call for all the misses, not stored
+        if missing:
+            for index, vector in zip(missing, self.embeddings.embed_documents([texts[index] for index in missing])):
+                vectors[index] = vector
+        return [list(map(float, vector)) for vector in vectors]
+
+    def embed_query(self, text):
+        vector = self.store.get(self.key(text))
+        with self.lock:
+            if vector is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.store.put(self.key(text), vector)
+        return list(map(float, vector))
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "size": len(self.store)}
@@ -0,0 +1,60 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import os
+import json
+import threading
+
+class Journal(object):
+    # Append-only JSONL log of store operations; rotated to <path>.committing while a group commit is applied
+    def __init__(self, path, fsync=False) -> None:
+        self.path = path
+        self.committing_path = f"{path}.committing"
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.journal_f = open(self.path, "a")
+
+    def append(self, operation) -> None:
+        with self.lock:
+            self.journal_f.write(json.dumps(operation) + "\n")
+            self.journal_f.flush()
+            if self.fsync:
+                os.fsync(self.journal_f.fileno())
+
+    def rotate(self) -> None:
+        # Operations logged from now on go to a fresh journal; the rotated one is dropped by commit_done()
+        with self.lock:
+            self.journal_f.close()
+            if os.path.exists(self.committing_path):
+                # A previous commit failed: keep its operations first, in order
+                with open(self.path, "r") as journal_f, open(self.committing_path, "a") as committing_f:
+                    committing_f.write(journal_f.read())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.committing_path)
+            self.journal_f = open(self.path, "a")
+
+    def commit_done(self) -> None:
+        if os.path.exists(self.committing_path):
+            os.remove(self.committing_path)
+
+    def replay(self) -> list:
+        # Operations that were logged but never committed (rotated journal first, it is older)
+        operations = list()
+        for path in [self.committing_path, self.path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r") as journal_f:
+                for line in journal_f:
+                    try:
+                        operations += [json.loads(line)]
+                    except json.JSONDecodeError:
+                        # Torn write at crash time: everything before it is still valid
+                        break
+        return operations
+
+    def close(self) -> None:
+        with self.lock:
+            self.journal_f.close()
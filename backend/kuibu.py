@@ -7,8 +7,8 @@ import utils
 import prompt
 import agent
 import memory
+import clients
 
-from langchain.chat_models import ChatOpenAI
 from langchain.schema import (
     AIMessage,
     HumanMessage,
@@ -18,11 +18,12 @@ from langchain.schema import (
 class KuiBu():
     def __init__(self, name, personalities):
         # LLM settings
-        self.smart_llm = ChatOpenAI(model_name = "gpt-4o", temperature=0)
-        self.fast_llm = ChatOpenAI(model_name = "gpt-3.5-turbo", temperature=0)
+        self.smart_llm = clients.get_chat_model("gpt-4o", temperature=0)
+        self.fast_llm = clients.get_chat_model(clients.get_model_name("fast"), temperature=0)
         self.smart_llm_token_limit = 8000
         self.fast_llm_token_limit = 4000
         self.recursion_depth = 3
+        self.token_counter = utils.token_counter
         self.agent = agent.Agent(name, personalities)
 
     def gate(self, query):
@@ -34,6 +35,8 @@ class KuiBu():
         short_term_memory_messages = self.agent.short_term_memory.convert(short_term_memory_documents)
 
         messages = prompt.gate_prompt.format_messages(query=query)
+        context_quota = self.fast_llm_token_limit - self.token_counter.count_messages(self.fast_llm, messages)
+        short_term_memory_messages = self.token_counter.fit_messages(self.fast_llm, short_term_memory_messages, context_quota)
         result = self.fast_llm(short_term_memory_messages + messages)
         print(f"Gate Result: {result}")
         return result.content != "NO"
@@ -53,9 +56,13 @@ class KuiBu():
         # Retrieve history
         history = self.agent.history.query(top_k=5)
 
+        # Keep the context within the model window
+        context_quota = self.smart_llm_token_limit - self.token_counter.count_messages(self.smart_llm, [kuibu_message])
+        context_messages = self.token_counter.fit_messages(self.smart_llm, short_term_memory_messages + history, context_quota)
+
         # Inference
         print(f"Planing...")
-        result = self.smart_llm(short_term_memory_messages + history + [kuibu_message])
+        result = self.smart_llm(context_messages + [kuibu_message])
         
         # Validation
         step_list = utils.kuibu_validation(result.content)
@@ -0,0 +1,187 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import os
+import re
+import json
+import math
+import itertools
+import threading
+from collections import Counter
+
+def tokenize(text) -> list:
+    return re.findall(r"\w+", str(text).lower())
+
+class BM25Index(object):
+    # Incremental inverted index over memory keys (doc id -> key text), optionally logged to a JSONL file
+    def __init__(self, path=None, k1=1.5, b=0.75, common_ratio=0.01, common_min=256, max_candidates=2048) -> None:
+        self.k1 = k1
+        self.b = b
+        # Terms in more than this share of the keys (and more than common_min of them, e.g. "search") only re-score candidates
+        self.common_ratio = common_ratio
+        self.common_min = common_min
+        # A query made only of common terms scans at most this many postings (it is rarely a confident key match anyway)
+        self.max_candidates = max_candidates
+        self.lock = threading.RLock()
+        self.postings = dict()
+        self.doc_terms = dict()
+        self.doc_lengths = dict()
+        self.keys = dict()
+        self.total_length = 0
+        self.path = path
+        self.log_f = None
+        self.log_lines = 0
+
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            if os.path.exists(path):
+                with open(path, "r") as log_f:
+                    for line in log_f:
+                        try:
+                            operation = json.loads(line)
+                        except json.JSONDecodeError:
+                            break
+                        self.log_lines += 1
+                        if operation["op"] == "add":
+                            self.index(operation["id"], operation["key"])
+                        else:
+                            self.unindex(operation["id"])
+            self.log_f = open(path, "a")
+            self.compact()
+
+    def log(self, operations) -> None:
+        if self.log_f is not None:
+            self.log_f.write("".join(json.dumps(operation) + "\n" for operation in operations))
+            self.log_f.flush()
+            self.log_lines += len(operations)
+            self.compact()
+
+    def compact(self) -> None:
+        # The log only grows (deletes, re-adds): rewrite it as one add per live key once it is mostly dead lines
+        with self.lock:
+            if self.log_f is None or self.log_lines <= max(1024, 2 * len(self.keys)):
+                return
+            with open(f"{self.path}.tmp", "w") as compact_f:
+                compact_f.write("".join(json.dumps({"op": "add", "id": doc_id, "key": key}) + "\n" for doc_id, key in self.keys.items()))
+            self.log_f.close()
+            os.replace(f"{self.path}.tmp", self.path)
+            self.log_f = open(self.path, "a")
+            self.log_lines = len(self.keys)
+
+    def index(self, doc_id, text) -> None:
+        self.unindex(doc_id)
+        terms = Counter(tokenize(text))
+        self.doc_terms[doc_id] = terms
+        self.doc_lengths[doc_id] = sum(terms.values())
+        self.keys[doc_id] = text
+        self.total_length += self.doc_lengths[doc_id]
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, dict())[doc_id] = frequency
+
+    def unindex(self, doc_id) -> None:
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        self.total_length -= self.doc_lengths.pop(doc_id)
+        self.keys.pop(doc_id, None)
+        for term in terms:
+            self.postings[term].pop(doc_id, None)
+            if not self.postings[term]:
+                del self.postings[term]
+
+    def add(self, doc_ids, texts) -> None:
+        with self.lock:
+            for doc_id, text in zip(doc_ids, texts):
+                self.index(doc_id, text)
+            self.log([{"op": "add", "id": doc_id, "key": text} for doc_id, text in zip(doc_ids, texts)])
+
+    def delete(self, doc_ids) -> None:
+        with self.lock:
+            doc_ids = [doc_id for doc_id in doc_ids if doc_id in self.doc_terms]
+            for doc_id in doc_ids:
+                self.unindex(doc_id)
+            self.log([{"op": "delete", "id": doc_id} for doc_id in doc_ids])
+
+    def idf(self, term) -> float:
+        frequency = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.doc_terms) - frequency + 0.5) / (frequency + 0.5))
+
+    def term_score(self, idf, frequency, length, average_length) -> float:
+        return idf * frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length / average_length))
+
+    def search(self, text, top_k=5) -> list:
+        # [(doc_id, bm25 score, confidence)], best first. confidence is 1.0 for the same key (modulo case / punctuation)
+        query_terms = Counter(tokenize(text))
+        with self.lock:
+            if not query_terms or not self.doc_terms:
+                return list()
+            average_length = self.total_length / len(self.doc_terms)
+            query_length = sum(query_terms.values())
+            idfs = {term: self.idf(term) for term in query_terms}
+
+            # Rare terms first: they produce the candidate set, common ones only add to it
+            scores = dict()
+            common = max(self.common_min, len(self.doc_terms) * self.common_ratio)
+            for term in sorted(query_terms, key=lambda term: -idfs[term]):
+                postings = self.postings.get(term, dict())
+                if len(postings) > common and scores:
+                    targets = [(doc_id, postings[doc_id]) for doc_id in scores if doc_id in postings]
+                elif len(postings) > common:
+                    targets = itertools.islice(postings.items(), self.max_candidates)
+                else:
+                    targets = postings.items()
+                for doc_id, frequency in targets:
+                    scores[doc_id] = scores.get(doc_id, 0.0) + self.term_score(idfs[term], frequency, self.doc_lengths[doc_id], average_length)
+
+            # Confidence: score relative to a stored key identical to the query, damped by the length mismatch
+            ideal = sum(self.term_score(idfs[term], frequency, query_length, average_length) for term, frequency in query_terms.items())
+            results = list()
+            for doc_id, score in sorted(scores.items(), key=lambda item: -item[1])[:top_k]:
+                length = self.doc_lengths[doc_id]
+                confidence = min(score / ideal, 1.0) * min(length, query_length) / max(length, query_length) if ideal > 0 else 0.0
+                results += [(doc_id, score, confidence)]
+            return results
+
+    def __len__(self) -> int:
+        return len(self.doc_terms)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self.doc_terms
+
+    def close(self) -> None:
+        if self.log_f is not None:
+            self.log_f.close()
+
+class HybridStats(object):
+    # Counters for the lexical-first lookup path of one memory store
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.lexical_hits = 0
+        self.fused = 0
+        self.lexical_seconds = 0.0
+
+    def record(self, lexical_hit, seconds) -> None:
+        with self.lock:
+            self.lookups += 1
+            self.lexical_hits += int(lexical_hit)
+            self.fused += int(not lexical_hit)
+            self.lexical_seconds += seconds
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "lookups": self.lookups,
+                "embedding_calls_saved": self.lexical_hits,
+                "fused": self.fused,
+                "lexical_ms_per_lookup": self.lexical_seconds * 1000 / self.lookups if self.lookups else 0.0,
+            }
+
+def fuse(rankings, k=60) -> list:
+    # Reciprocal rank fusion of several best-first id lists (score scales don't need to agree)
+    scores = dict()
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return [doc_id for doc_id, _ in sorted(scores.items(), key=lambda item: -item[1])]
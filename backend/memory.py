@@ -2,19 +2,28 @@
 # Author: Du Mingzhe (mingzhe@nus.edu.sg)
 # Date: 2023-04-29
 
+import os
 import json
+import time
 import uuid
-import uuid
-import faiss
+import sqlite3
+import itertools
+import atexit
+import cache
+import tempfile
+import numpy as np
 import utils
+import journal
+import lexical
+import minhash
+import clients
+import quantization
+import threading
+import vector_store
 from enum import Enum
 from termcolor import cprint
+from collections import deque
 from datetime import datetime, timedelta
-from langchain.docstore import InMemoryDocstore
-from langchain.memory import ChatMessageHistory
-from langchain.vectorstores import FAISS, Chroma
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.retrievers import TimeWeightedVectorStoreRetriever
 from langchain.schema import Document, AIMessage, HumanMessage, SystemMessage
 
 class MemoryType(Enum):
@@ -39,46 +48,312 @@ class Memory(object):
     def update(self, key, value):
         raise NotImplementedError("Don't call the interface.")
     
+class HistoryStore(object):
+    # Message archive for every persistent History: one SQLite file, one row per message, keyed by (session_id, seq)
+    # Retention: messages older than `retention` seconds are pruned (at most once per `prune_interval`), 0 keeps everything
+    def __init__(self, path, retention=None, prune_interval=3600) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.retention = retention if retention is not None else float(os.environ.get("HISTORY_RETENTION", 30 * 24 * 3600))
+        self.prune_interval = prune_interval
+        self.last_pruned = 0.0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (session_id TEXT, seq INTEGER, role TEXT, content TEXT, tokens INTEGER, model TEXT, created_at REAL, PRIMARY KEY (session_id, seq))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at)")
+        self.db.commit()
+        self.prune()
+
+    def append(self, session_id, role, content, tokens, model) -> int:
+        # seq is allocated here, in the same statement as the insert: several writers of one session (two tabs) never collide
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO messages SELECT ?, COALESCE(MAX(seq), -1) + 1, ?, ?, ?, ?, ? FROM messages WHERE session_id = ?",
+                (session_id, role, content, tokens, model, time.time(), session_id),
+            )
+            seq = self.db.execute("SELECT seq FROM messages WHERE rowid = ?", (cursor.lastrowid,)).fetchone()[0]
+            self.db.commit()
+        return seq
+
+    def before(self, session_id, seq, limit) -> list:
+        # (seq, role, content, tokens, model) of the `limit` messages preceding seq, oldest first
+        with self.lock:
+            rows = self.db.execute("SELECT seq, role, content, tokens, model FROM messages WHERE session_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?", (session_id, seq, limit)).fetchall()
+        return rows[::-1]
+
+    def prune(self) -> int:
+        # Drop expired messages; returns how many rows were deleted
+        now = time.time()
+        with self.lock:
+            if self.retention <= 0 or now - self.last_pruned < self.prune_interval:
+                return 0
+            self.last_pruned = now
+            deleted = self.db.execute("DELETE FROM messages WHERE created_at < ?", (now - self.retention,)).rowcount
+            self.db.commit()
+        return deleted
+
+    def delete(self, session_id) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self.db.commit()
+
+history_stores = dict()
+history_stores_lock = threading.Lock()
+
+def get_history_store(path) -> HistoryStore:
+    with history_stores_lock:
+        if path not in history_stores:
+            history_stores[path] = HistoryStore(path)
+        return history_stores[path]
+
 class History(Memory):
-    def __init__(self):
+    # Ring buffer of the latest messages, each stored with its token count (counted once, at write time).
+    # With a session_id and HISTORY_DB_PATH every message is also archived to SQLite: older ones leave RAM, and a session is restored on restart.
+    # The session_id must be stable across connections (the client's own id, not the socket sid) for the restore to find anything.
+    ROLES = {"user": HumanMessage, "assistant": AIMessage}
+
+    def __init__(self, capacity=None, session_id=None, path=None):
         super().__init__()
         self.memory_type = MemoryType.HISTORY
-        self.history_length = 0
-        self.index = ChatMessageHistory()
-    
+        self.capacity = capacity if capacity is not None else int(os.environ.get("HISTORY_CAPACITY", 200))
+        self.index = deque(maxlen=self.capacity)
+        # Archive seq of every buffered message (persistent histories only), and one past the last one
+        self.seqs = deque(maxlen=self.capacity)
+        self.seq = 0
+        self.session_id = session_id
+        # Token counts are taken with the smart model's tokenizer; planners on another model recount (see PLANTask)
+        self.count_model = clients.get_model_name("smart")
+        path = path if path is not None else os.environ.get("HISTORY_DB_PATH", "")
+        self.store = get_history_store(path) if session_id is not None and path else None
+        if self.store is not None:
+            self.store.prune()
+            for seq, role, content, tokens, model in self.store.before(self.session_id, float("inf"), self.capacity):
+                message = self.ROLES[role](content=content)
+                # Archived under another smart model (SMART_LLM_MODEL changed since): count again
+                self.index.append((message, tokens if model == self.count_model else self.count(message)))
+                self.seqs.append(seq)
+                self.seq = seq + 1
+
+    @property
+    def history_length(self):
+        return self.seq
+
     def clear(self):
         self.index.clear()
+        self.seqs.clear()
+        if self.store is not None:
+            self.store.delete(self.session_id)
+
+    def count(self, message):
+        return utils.token_counter.count_message(clients.get_chat_model(self.count_model), message)
 
     def add(self, key, value):
-        if key == "user":
-            self.index.add_user_message(value)
-        elif key == "assistant":
-            self.index.add_ai_message(value)
-        else:
+        if key not in self.ROLES:
             raise KeyError("Unknown History Key.")
-    
+        message = self.ROLES[key](content=value)
+        tokens = self.count(message)
+        self.index.append((message, tokens))
+        if self.store is not None:
+            self.seqs.append(self.store.append(self.session_id, key, value, tokens, self.count_model))
+            self.seq = self.seqs[-1] + 1
+        else:
+            self.seq += 1
+
+    def recent(self, top_k):
+        # The last top_k (message, token count) pairs, oldest first, in O(top_k)
+        entries = list(itertools.islice(reversed(self.index), top_k))
+        entries.reverse()
+        return entries
+
     def query(self, top_k):
-        return self.index.messages[-top_k:]
+        return [message for message, _ in self.recent(top_k)]
+
+    def archived(self, limit=50):
+        # Messages older than the ring buffer, read back from the archive on demand
+        if self.store is None:
+            return list()
+        first_seq = self.seqs[0] if self.seqs else self.seq
+        return [self.ROLES[role](content=content) for _, role, content, _, _ in self.store.before(self.session_id, first_seq, limit)]
+
+    def __len__(self):
+        return len(self.index)
 
 class ShortTermMemory(Memory):
-    def __init__(self):
+    def __init__(self, capacity=None, embedding_size=1536, embeddings_model=None, quantization_kind=None):
         super().__init__()
         self.memory_type = MemoryType.SHORTTERM
-        self.embeddings_model = OpenAIEmbeddings()
-        self.embedding_size = 1536
+        self.embeddings_model = embeddings_model if embeddings_model is not None else clients.get_embeddings()
+        self.embedding_size = embedding_size
         self.decay_rate = 0.5
         self.top_k = 10
-        self.vectorstore = FAISS(self.embeddings_model.embed_query, faiss.IndexFlatL2(self.embedding_size), InMemoryDocstore({}), {})
-        self.retriever = TimeWeightedVectorStoreRetriever(vectorstore=self.vectorstore, decay_rate=self.decay_rate, k=self.top_k)
+
+        # Capacity-bounded store: contiguous arrays, row i of every array describes docs[i]
+        self.capacity = capacity if capacity is not None else int(os.environ.get("SHORT_TERM_CAPACITY", 1000))
+        self.evict_ratio = 0.1
+        self.size = 0
+
+        # Optional compact codes ("float16" / "pq"): codes rank candidates in RAM, exact vectors on disk re-rank them
+        kind = quantization_kind if quantization_kind is not None else os.environ.get("SHORT_TERM_QUANTIZATION", "none")
+        self.codec = quantization.get_codec(kind, self.embedding_size, subspaces=int(os.environ.get("SHORT_TERM_PQ_SUBSPACES", 64)), max_rows=self.capacity)
+        self.rerank_factor = 4
+        if self.codec is None:
+            self.vectors = np.zeros((0, self.embedding_size), dtype=np.float32)
+        else:
+            self.vectors = np.zeros((0,) + self.codec.code_shape, dtype=self.codec.dtype)
+            self.exact = np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode="w+", shape=(self.capacity, self.embedding_size))
+        self.squared_norms = np.zeros(0, dtype=np.float32)
+        self.last_accessed = np.zeros(0, dtype=np.float64)
+        self.access_counts = np.zeros(0, dtype=np.float32)
+        self.docs = list()
+
+        # Retrieval memo for the current turn, invalidated whenever the memory changes
+        self.query_cache = dict()
+
+        # BM25 over the keys (doc uuid -> key): a confident key match replaces the embedding call, otherwise it is a score bonus
+        self.lexical = lexical.BM25Index() if os.environ.get("HYBRID_LEXICAL", "1") == "1" else None
+        self.lexical_confidence = float(os.environ.get("LEXICAL_CONFIDENCE", 0.9))
+        self.lexical_weight = 0.5
+        self.hybrid_stats = lexical.HybridStats()
+
+    def new_turn(self):
+        self.query_cache.clear()
     
     def add(self, key, value):
         key_str = json.dumps(key)
         value_str = json.dumps(value)
         content = f"{key_str} -> {value_str}"
-        self.retriever.add_documents([Document(page_content=content, metadata={"last_accessed_at": datetime.now(), "uuid": str(uuid.uuid4()), "key": key_str})])
+        self.add_vector(Document(page_content=content, metadata={"last_accessed_at": datetime.now(), "uuid": str(uuid.uuid4()), "key": key_str, "summaries": dict()}), self.embeddings_model.embed_documents([content])[0])
+
+    def add_vector(self, doc, vector):
+        if self.size >= self.capacity:
+            self.evict(max(1, int(self.capacity * self.evict_ratio)))
+        if self.size >= len(self.vectors):
+            self.grow()
+        row = self.size
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.codec is None:
+            self.vectors[row] = vector
+        else:
+            self.exact[row] = vector
+            if self.codec.trained:
+                self.vectors[row] = self.codec.encode(vector)[0]
+            elif row + 1 >= self.codec.train_rows:
+                # Enough samples: train the codebooks once, then encode everything stored so far
+                self.codec.train(self.exact[:row + 1])
+                self.vectors[:row + 1] = self.codec.encode(self.exact[:row + 1])
+        self.squared_norms[row] = float(np.dot(vector, vector))
+        self.last_accessed[row] = doc.metadata["last_accessed_at"].timestamp()
+        self.access_counts[row] = 0
+        self.docs += [doc]
+        self.size += 1
+        if self.lexical is not None:
+            self.lexical.add([doc.metadata["uuid"]], [doc.metadata["key"]])
+        self.query_cache.clear()
+
+    def grow(self):
+        # Arrays grow geometrically up to the capacity, so idle sessions stay small
+        rows = min(self.capacity, max(64, 2 * len(self.vectors)))
+        self.vectors = np.concatenate([self.vectors, np.zeros((rows - len(self.vectors),) + self.vectors.shape[1:], dtype=self.vectors.dtype)])
+        self.squared_norms = np.concatenate([self.squared_norms, np.zeros(rows - len(self.squared_norms), dtype=np.float32)])
+        self.last_accessed = np.concatenate([self.last_accessed, np.zeros(rows - len(self.last_accessed), dtype=np.float64)])
+        self.access_counts = np.concatenate([self.access_counts, np.zeros(rows - len(self.access_counts), dtype=np.float32)])
+
+    def recency(self, now=None):
+        # Same decay as TimeWeightedVectorStoreRetriever: (1 - decay_rate) ^ hours since last access
+        now = now if now is not None else datetime.now().timestamp()
+        hours_passed = np.maximum(now - self.last_accessed[:self.size], 0) / 3600
+        return np.power(1.0 - self.decay_rate, hours_passed)
+
+    def evict(self, count):
+        # Drop the entries with the lowest decay score (recency plus a small frequency bonus)
+        scores = self.recency() + 0.1 * np.minimum(self.access_counts[:self.size], 10) / 10
+        evicted = np.argpartition(scores, count - 1)[:count] if count < self.size else np.arange(self.size)
+        keep = np.setdiff1d(np.arange(self.size), evicted, assume_unique=True)
+        if self.lexical is not None:
+            self.lexical.delete([self.docs[row].metadata["uuid"] for row in evicted])
+
+        # Compact the arrays and the docstore in one pass, so they stay contiguous
+        size = len(keep)
+        arrays = [self.vectors, self.squared_norms, self.last_accessed, self.access_counts] + ([self.exact] if self.codec is not None else [])
+        for array in arrays:
+            array[:size] = array[keep]
+        self.docs = [self.docs[row] for row in keep]
+        self.size = size
+        self.query_cache.clear()
+        print(f"Short-term memory full, evicted {len(evicted)} entries.")
 
     def query(self, key, top_k, threshold=1):
-        return self.retriever.get_relevant_documents(key)[:top_k]
+        # A memoized result for a larger top_k also answers smaller ones
+        cached_top_k, docs = self.query_cache.get(key, (0, None))
+        if docs is None or top_k > cached_top_k:
+            docs = self.hybrid_search(key, top_k) if self.lexical is not None else self.search(self.embed(key), top_k)
+            self.query_cache[key] = (top_k, docs)
+        return docs[:top_k]
+
+    def embed(self, key):
+        return np.asarray(self.embeddings_model.embed_query(key), dtype=np.float32)
+
+    def hybrid_search(self, key, top_k):
+        start = time.perf_counter()
+        matches = self.lexical.search(key, top_k)
+        confident = bool(matches) and matches[0][2] >= self.lexical_confidence
+        self.hybrid_stats.record(confident, time.perf_counter() - start)
+
+        # Confident: only the matched keys are candidates, ranked by key confidence and recency (no embedding);
+        # otherwise the confidence is added to the vector relevance of every entry
+        confidences = {doc_id: confidence for doc_id, _, confidence in matches}
+        weight = 1.0 if confident else self.lexical_weight
+        bonus = np.array([weight * confidences.get(doc.metadata["uuid"], 0.0) for doc in self.docs], dtype=np.float64)
+        return self.search(None if confident else self.embed(key), top_k, bonus)
+
+    def search(self, query_vector, top_k, bonus=None):
+        if not self.size:
+            return list()
+        top_k = min(top_k, self.size)
+
+        # One vectorized pass: L2 relevance (as FAISS in langchain: 1 - d / sqrt(2)) + time decay (+ lexical bonus)
+        now = datetime.now().timestamp()
+        prior = self.recency(now) + (bonus if bonus is not None else 0.0)
+        if query_vector is None:
+            # Lexical-only lookup (hybrid_search): rows without a key match are not candidates at all
+            matched = np.flatnonzero(bonus > 0)
+            if not matched.size:
+                return list()
+            rows = matched[self.top_rows(prior[matched], top_k)]
+        elif self.codec is None:
+            squared_distances = self.squared_norms[:self.size] - 2 * (self.vectors[:self.size] @ query_vector) + float(np.dot(query_vector, query_vector))
+            rows = self.top_rows(self.relevance(squared_distances) + prior, top_k)
+        else:
+            # Approximate scores pick rerank_factor x top_k candidates, their exact vectors (paged in from disk) pick the result
+            if self.codec.trained:
+                squared_distances = self.codec.squared_distances(self.vectors[:self.size], query_vector)
+            else:
+                squared_distances = self.exact_distances(np.arange(self.size), query_vector)
+            candidates = np.sort(self.top_rows(self.relevance(squared_distances) + prior, top_k * self.rerank_factor))
+            rows = candidates[self.top_rows(self.relevance(self.exact_distances(candidates, query_vector)) + prior[candidates], top_k)]
+
+        # Retrieved entries are refreshed, like the retriever's last_accessed_at update
+        self.last_accessed[rows] = now
+        self.access_counts[rows] += 1
+        docs = [self.docs[row] for row in rows]
+        for doc in docs:
+            doc.metadata["last_accessed_at"] = datetime.fromtimestamp(now)
+        return docs
+
+    def relevance(self, squared_distances):
+        return 1.0 - np.sqrt(np.maximum(squared_distances, 0)) / np.sqrt(2)
+
+    def exact_distances(self, rows, query_vector):
+        delta = np.asarray(self.exact[rows]) - query_vector
+        return np.einsum("ij,ij->i", delta, delta)
+
+    def top_rows(self, scores, top_k):
+        top_k = min(top_k, len(scores))
+        rows = np.argpartition(-scores, top_k - 1)[:top_k]
+        return rows[np.argsort(-scores[rows])]
+
+    def __len__(self):
+        return self.size
     
     def convert(self, docs):
         return [SystemMessage(content=doc.page_content) for doc in docs]    
@@ -87,56 +362,498 @@ class ShortTermMemory(Memory):
         return [(AIMessage(content=doc.page_content), doc.metadata) for doc in docs]            
 
 class LongTermMemory(Memory):
-    def __init__(self) -> None:
+    def __init__(self, write_behind=None, commit_size=64, commit_interval=2.0, persist_directory="db", backend=None, quantization_kind=None) -> None:
         super().__init__()
         self.memory_type = MemoryType.LONGTERM
-        self.embedding_function = OpenAIEmbeddings()
-        self.index = Chroma(embedding_function=self.embedding_function, persist_directory='db')
+        self.persist_directory = persist_directory
+
+        # Vector backend: "chroma" (default) or "faiss" (see vector_store.py)
+        self.backend_kind = backend if backend is not None else os.environ.get("LONG_TERM_BACKEND", "chroma")
+        self.quantization_kind = quantization_kind if quantization_kind is not None else os.environ.get("LONG_TERM_QUANTIZATION", "none")
 
-        # Create an empty collection and persist it
-        [self.index.add_texts([""]) for _ in range(5)]
-        self.index.persist()
+        # Opened lazily on first use (see open): no writes, no network and no index load at construction
+        self._index = None
+        self._embedding_function = None
+        self.open_lock = threading.RLock()
+
+        # Retrieval memo (shared by all sessions), invalidated whenever the store changes
+        self.query_cache = cache.LRUCache(capacity=256)
+
+        # BM25 over stored keys (persisted next to the store): confident key matches skip the embedding call
+        self.hybrid = os.environ.get("HYBRID_LEXICAL", "1") == "1"
+        self.lexical = None
+        self.lexical_confidence = float(os.environ.get("LEXICAL_CONFIDENCE", 0.9))
+        self.lexical_min_confidence = 0.5
+        self.hybrid_stats = lexical.HybridStats()
+
+        # MinHash / LSH over document contents (persisted next to the store): near-duplicates are rejected, or replace
+        # the stored entry with LONG_TERM_DEDUP_MODE=merge, before anything is embedded
+        self.dedup = os.environ.get("LONG_TERM_DEDUP", "1") == "1"
+        self.dedup_mode = os.environ.get("LONG_TERM_DEDUP_MODE", "reject")
+        self.minhash_threshold = float(os.environ.get("MINHASH_THRESHOLD", 0.8))
+        self.fingerprints = None
+        self.pending_signatures = dict()
+
+        # Consolidation (see consolidation.py) retires entries into canonical ones: retired id -> canonical id
+        self.id_map = dict()
+        self.id_map_f = None
+
+        # Write-behind: inserts / deletes are journaled and group-committed off the request path
+        self.write_behind = write_behind if write_behind is not None else os.environ.get("LONG_TERM_WRITE_BEHIND", "1") == "1"
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        self.pending = list()
+        self.pending_lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        self.commit_event = threading.Event()
+        # Set after a failed commit: the retried batch may be partly applied already
+        self.retrying = False
+
+    def open(self):
+        # Idempotent: the first caller loads the index (and replays the journal), everyone else reuses it
+        with self.open_lock:
+            if self._index is None:
+                self._embedding_function = clients.get_embeddings()
+                if self.hybrid:
+                    self.lexical = lexical.BM25Index(os.path.join(self.persist_directory, "long_term.keys.jsonl"))
+                if self.dedup:
+                    self.fingerprints = minhash.MinHashIndex(os.path.join(self.persist_directory, "long_term.minhash.jsonl"), threshold=self.minhash_threshold)
+                self.load_id_map()
+                self._index = vector_store.get_backend(self.backend_kind, persist_directory=self.persist_directory, embedding_function=self._embedding_function, quantization=self.quantization_kind)
+                if self.fingerprints is not None and self.fingerprints.stale:
+                    self.refingerprint()
+                if self.write_behind:
+                    self.journal = journal.Journal(os.path.join(self.persist_directory, "long_term.journal"))
+                    self.recover()
+                    threading.Thread(target=self.commit_loop, name="long-term-commit", daemon=True).start()
+                    atexit.register(self.flush)
+            return self._index
+
+    def refingerprint(self):
+        # The fingerprint log was written with an older hashing scheme: recompute every signature from the stored documents
+        print("Rebuilding long-term memory fingerprints...")
+        signatures = dict()
+        for batch in self._index.iter_documents():
+            for doc_id, document in batch:
+                signature = self.fingerprints.signature(document)
+                if signature is not None:
+                    signatures[doc_id] = signature
+        self.fingerprints.reset(signatures)
+        self.fingerprints.stale = False
+
+    def load_id_map(self):
+        path = os.path.join(self.persist_directory, "long_term.idmap.jsonl")
+        if os.path.exists(path):
+            with open(path, "r") as id_map_f:
+                for line in id_map_f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    self.id_map[entry["old"]] = entry["new"]
+        self.id_map_f = open(path, "a")
+
+    def record_ids(self, retired_ids, new_ids):
+        self.id_map.update(zip(retired_ids, new_ids))
+        self.id_map_f.write("".join(json.dumps({"old": doc_id, "new": new_id}) + "\n" for doc_id, new_id in zip(retired_ids, new_ids)))
+        self.id_map_f.flush()
+
+    def resolve(self, doc_id):
+        # Follows consolidation merges to the entry that currently holds the knowledge of doc_id
+        self.open()
+        seen = set()
+        while doc_id in self.id_map and doc_id not in seen:
+            seen.add(doc_id)
+            doc_id = self.id_map[doc_id]
+        return doc_id
+
+    @property
+    def index(self):
+        return self._index if self._index is not None else self.open()
+
+    @property
+    def embedding_function(self):
+        self.open()
+        return self._embedding_function
+
+    def recover(self):
+        # Replay operations that were journaled but not committed before a crash
+        operations = self.journal.replay()
+        if operations:
+            print(f"Replaying {len(operations)} journaled long-term memory operations...")
+            self.apply(operations, replay=True)
+        self.journal.rotate()
+        self.journal.commit_done()
+
+    def apply(self, operations, replay=False, persist=True):
+        for operation in operations:
+            # "replace" (consolidation) = add the canonical entry + retire the originals, applied in one group commit
+            if operation["op"] in ["add", "replace"]:
+                ids, embeddings, documents = operation["ids"], operation["embeddings"], operation["documents"]
+                if self.lexical is not None and operation.get("keys"):
+                    # Re-indexing an id is a no-op, so replay needs no special case here
+                    self.lexical.add(ids, operation["keys"])
+                if self.fingerprints is not None:
+                    self.fingerprints.add(ids, [self.fingerprint(doc_id, document) for doc_id, document in zip(ids, documents)])
+                keys = operation.get("keys")
+                if replay:
+                    # Idempotent: the crash may have happened after the index write
+                    existing = self.index.existing_ids(ids)
+                    keep = [index for index, doc_id in enumerate(ids) if doc_id not in existing]
+                    ids, embeddings, documents = [ids[i] for i in keep], [embeddings[i] for i in keep], [documents[i] for i in keep]
+                    keys = [keys[i] for i in keep] if keys else None
+                if ids:
+                    self.index.add(ids, embeddings, documents, keys)
+            if operation["op"] in ["delete", "replace"]:
+                retired = operation["ids"] if operation["op"] == "delete" else operation["retired"]
+                self.index.delete(retired)
+                if self.lexical is not None:
+                    self.lexical.delete(retired)
+                if self.fingerprints is not None:
+                    self.fingerprints.delete(retired)
+            if operation["op"] == "replace":
+                # retired_by: the new id holding each retired entry (merge-mode admission); consolidation has one canonical id
+                self.record_ids(operation["retired"], operation.get("retired_by", [operation["ids"][0]] * len(operation["retired"])))
+        if persist:
+            self.index.persist()
+        self.query_cache.clear()
+
+    def apply_direct(self, operations, persist=False):
+        # Bulk import: content-addressed, checkpointed batches skip the journal and go straight to the index.
+        # Applied like a replay (ids already stored are skipped), so re-running a chunk after a crash is safe.
+        self.open()
+        with self.commit_lock:
+            self.apply(operations, replay=True, persist=persist)
+
+    def persist(self):
+        self.open()
+        with self.commit_lock:
+            self.index.persist()
+
+    def write(self, operation):
+        self.open()
+        if not self.write_behind:
+            self.apply([operation])
+            return
+        with self.pending_lock:
+            self.journal.append(operation)
+            self.pending += [operation]
+            if len(self.pending) >= self.commit_size:
+                self.commit_event.set()
+
+    def commit(self):
+        # Group commit: everything pending is applied with one persist, then its journal segment is dropped
+        with self.commit_lock:
+            with self.pending_lock:
+                operations, self.pending = self.pending, list()
+                if not operations:
+                    return 0
+                self.journal.rotate()
+            try:
+                # A retry is applied like a replay (ids already in the index are skipped), so it can't fail on its own earlier writes
+                self.apply(operations, replay=self.retrying)
+            except Exception:
+                # Retried by the next commit; the rotated journal segment is kept until then
+                self.retrying = True
+                with self.pending_lock:
+                    self.pending = operations + self.pending
+                raise
+            self.retrying = False
+            self.journal.commit_done()
+            return len(operations)
+
+    def commit_loop(self):
+        while True:
+            self.commit_event.wait(timeout=self.commit_interval)
+            self.commit_event.clear()
+            try:
+                self.commit()
+            except Exception as e:
+                print(f"Long-term memory commit error: {e}")
+
+    def flush(self):
+        # Explicit flush for shutdown
+        if self.write_behind and self._index is not None:
+            self.commit()
+
+    def pending_embeddings(self):
+        with self.pending_lock:
+            return [embedding for operation in self.pending if operation["op"] in ["add", "replace"] for embedding in operation["embeddings"]]
+
+    def fingerprint(self, doc_id, document):
+        # Computed at admission time for new entries, recomputed for replayed ones
+        with self.pending_lock:
+            signature = self.pending_signatures.pop(doc_id, None)
+        return signature if signature is not None else self.fingerprints.signature(document)
+
+    def pending_keys(self):
+        with self.pending_lock:
+            return [key for operation in self.pending if operation["op"] in ["add", "replace"] for key in operation.get("keys", [])]
 
     def add(self, keys, values):
         embeddings = self.embedding_function.embed_documents(list(keys))
         ids = [str(uuid.uuid1()) for _ in keys]
-        self.index._collection.add(embeddings=embeddings, documents=values, ids=ids)
-        self.index.persist()
+        self.write({"op": "add", "ids": ids, "embeddings": embeddings, "documents": list(values), "keys": list(keys)})
         return ids
 
+    def lexical_duplicates(self, keys):
+        # Keys already stored (or pending, or earlier in the batch) near-verbatim, decided without embedding them
+        duplicated = np.zeros(len(keys), dtype=bool)
+        if not self.hybrid:
+            return duplicated
+        self.open()
+        start = time.perf_counter()
+        seen = {" ".join(lexical.tokenize(key)) for key in self.pending_keys()}
+        for index, key in enumerate(keys):
+            normalized = " ".join(lexical.tokenize(key))
+            matches = self.lexical.search(key, top_k=1)
+            duplicated[index] = normalized in seen or (bool(matches) and matches[0][2] >= self.lexical_confidence)
+            seen.add(normalized)
+        seconds = (time.perf_counter() - start) / len(keys)
+        for lexical_hit in duplicated:
+            self.hybrid_stats.record(lexical_hit, seconds)
+        return duplicated
+
+    def content_duplicates(self, values):
+        # MinHash pass over the contents: a signature per value, whether it is rejected, and the stored ids it replaces (merge mode)
+        signatures, rejected, replaced = [None] * len(values), np.zeros(len(values), dtype=bool), [list() for _ in values]
+        if not self.dedup:
+            return signatures, rejected, replaced
+        self.open()
+        with self.pending_lock:
+            earlier = list(self.pending_signatures.values())
+        for index, value in enumerate(values):
+            signature = signatures[index] = self.fingerprints.signature(value)
+            if signature is None:
+                continue
+            # Pending and same-batch entries are always rejected: there is nothing committed to merge into yet
+            if any(self.fingerprints.similarity(signature, other) >= self.minhash_threshold for other in earlier):
+                rejected[index] = True
+                continue
+            matches = self.fingerprints.query(signature)
+            if matches and self.dedup_mode == "merge":
+                replaced[index] = [doc_id for doc_id, _ in matches]
+            elif matches:
+                rejected[index] = True
+                continue
+            earlier += [signature]
+        return signatures, rejected, replaced
+
+    def add_batch(self, keys, values, threshold=0.1, ids=None, embeddings=None, embed_documents=None, direct=False):
+        # Bulk dedup-and-insert: lexical and MinHash passes, then one embedding call, one vectorized nearest-neighbour query, one insert, one persist
+        # ids / embeddings (aligned with keys, an embedding may be None): content ids and precomputed vectors from bulk import
+        # embed_documents: replaces the embedding call for the keys still without a vector (bulk import adds retries and workers)
+        # direct: applied to the index without the journal or a persist (bulk import, see apply_direct)
+        keys, values = list(keys), list(values)
+        ids = list(ids) if ids is not None else [None] * len(keys)
+        embeddings = list(embeddings) if embeddings is not None else [None] * len(keys)
+        if not keys:
+            return {"added": [], "skipped": [], "replaced": []}
+        lexical_hits = self.lexical_duplicates(keys)
+        skipped = [key for key, hit in zip(keys, lexical_hits) if hit]
+        kept = [index for index, hit in enumerate(lexical_hits) if not hit]
+        keys, values, ids, embeddings = [keys[index] for index in kept], [values[index] for index in kept], [ids[index] for index in kept], [embeddings[index] for index in kept]
+
+        signatures, content_hits, replaced = self.content_duplicates(values)
+        skipped += [key for key, hit in zip(keys, content_hits) if hit]
+        kept = np.flatnonzero(~content_hits).tolist()
+        keys, values, signatures, replaced = [keys[index] for index in kept], [values[index] for index in kept], [signatures[index] for index in kept], [replaced[index] for index in kept]
+        ids, embeddings = [ids[index] for index in kept], [embeddings[index] for index in kept]
+        if not keys:
+            return {"added": [], "skipped": skipped, "replaced": []}
+        missing = [index for index, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            for index, embedding in zip(missing, (embed_documents or self.embedding_function.embed_documents)([keys[index] for index in missing])):
+                embeddings[index] = embedding
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        # Nearest stored neighbour of every key at once (same L2 distance as similarity_search_with_score)
+        duplicated = np.zeros(len(keys), dtype=bool)
+        if self.index.count() > 0:
+            duplicated |= np.array([bool(hits) and hits[0][2] < threshold for hits in self.index.search(embeddings, 1)])
+
+        # Entries still waiting for the next group commit count as stored
+        pending = self.pending_embeddings()
+        if pending:
+            pending = np.asarray(pending, dtype=np.float32)
+            pending_distances = (embeddings ** 2).sum(axis=1)[:, None] + (pending ** 2).sum(axis=1)[None, :] - 2 * embeddings @ pending.T
+            duplicated |= pending_distances.min(axis=1) < threshold
+
+        # Near-duplicates inside the batch itself: keep the first occurrence
+        squared_norms = (embeddings ** 2).sum(axis=1)
+        distances = squared_norms[:, None] + squared_norms[None, :] - 2 * embeddings @ embeddings.T
+        for index in range(1, len(keys)):
+            earlier = np.flatnonzero(~duplicated[:index])
+            if not duplicated[index] and earlier.size and distances[index, earlier].min() < threshold:
+                duplicated[index] = True
+
+        added_indices = np.flatnonzero(~duplicated).tolist()
+        ids = [ids[index] or str(uuid.uuid1()) for index in added_indices]
+        # Merge mode: each stored near-duplicate is retired by the first new entry that matched it
+        replaced_ids, replaced_by = list(), list()
+        for index, doc_id in zip(added_indices, ids):
+            for replaced_id in replaced[index]:
+                if replaced_id not in replaced_ids:
+                    replaced_ids += [replaced_id]
+                    replaced_by += [doc_id]
+        if added_indices:
+            with self.pending_lock:
+                for index, doc_id in zip(added_indices, ids):
+                    if signatures[index] is not None:
+                        self.pending_signatures[doc_id] = signatures[index]
+            operation = {"op": "add", "ids": ids, "embeddings": embeddings[added_indices].tolist(), "documents": [values[index] for index in added_indices], "keys": [keys[index] for index in added_indices]}
+            if replaced_ids:
+                # Adds and retirements in one journaled operation, so they always land in the same group commit
+                operation.update({"op": "replace", "retired": replaced_ids, "retired_by": replaced_by})
+            if direct:
+                self.apply_direct([operation])
+            else:
+                self.write(operation)
+
+        return {
+            "added": [(keys[index], doc_id) for index, doc_id in zip(added_indices, ids)],
+            "skipped": skipped + [keys[index] for index in np.flatnonzero(duplicated).tolist()],
+            "replaced": replaced_ids,
+        }
+
     def delete(self, ids):
-        self.index._collection.delete(ids=ids)
+        self.write({"op": "delete", "ids": list(ids)})
+
+    def replace(self, retired_ids, embedding, document, key=None):
+        # One canonical entry for several retired ones (reuses an existing embedding and its key, nothing is embedded)
+        new_id = str(uuid.uuid1())
+        operation = {"op": "replace", "ids": [new_id], "embeddings": [list(map(float, embedding))], "documents": [document], "retired": list(retired_ids)}
+        if key is not None:
+            # Keeps the canonical entry in the BM25 key index and in exports
+            operation["keys"] = [key]
+        self.write(operation)
+        return new_id
+
+    def rededup(self, threshold=None, dry_run=False):
+        # Bulk pass over an existing store: keeps the first entry of every near-duplicate group and rebuilds the fingerprints
+        self.open()
+        self.flush()
+        index = minhash.MinHashIndex(threshold=threshold if threshold is not None else self.minhash_threshold)
+        scanned, duplicates = 0, list()
+        for batch in self.index.iter_documents():
+            for doc_id, document in batch:
+                scanned += 1
+                signature = index.signature(document)
+                if index.query(signature):
+                    duplicates += [doc_id]
+                else:
+                    index.add([doc_id], [signature])
+        if not dry_run:
+            if duplicates:
+                self.delete(duplicates)
+                self.flush()
+            if self.fingerprints is not None:
+                self.fingerprints.reset(index.signatures)
+        return {"scanned": scanned, "duplicates": duplicates}
     
-    def query(self, key, top_k, threshold):
-        docs = self.index.similarity_search_with_score(query=key, k=top_k)
-        return [doc[0] for doc in docs if doc[0] and doc[1] < threshold]
+    def query(self, key, top_k, threshold, lexical_bypass=False):
+        # threshold bounds the vector distance of every result. lexical_bypass (opt-in, needs HYBRID_LEXICAL): keys matched at
+        # LEXICAL_CONFIDENCE or above are returned without an embedding, so no distance exists for them and the threshold does not apply
+        cache_key = (key, top_k, threshold, lexical_bypass)
+        docs = self.query_cache.get(cache_key)
+        if docs is None:
+            docs = self.hybrid_search(key, top_k, threshold, lexical_bypass) if self.hybrid else self.vector_search(key, top_k, threshold)
+            docs = [Document(page_content=document, metadata={"id": doc_id}) for doc_id, document in docs]
+            self.query_cache.set(cache_key, docs)
+        return docs
     
+    def vector_search(self, key, top_k, threshold):
+        # The backend caps k at its size (it may hold fewer than top_k entries, or none at all)
+        hits = self.index.search([self.embedding_function.embed_query(key)], top_k)[0]
+        return [(doc_id, document) for doc_id, document, distance in hits if document and distance < threshold]
+
+    def hybrid_search(self, key, top_k, threshold, lexical_bypass=False):
+        self.open()
+        start = time.perf_counter()
+        matches = self.lexical.search(key, top_k)
+        confident = [doc_id for doc_id, _, confidence in matches if confidence >= self.lexical_confidence] if lexical_bypass else list()
+        self.hybrid_stats.record(bool(confident), time.perf_counter() - start)
+        if confident:
+            # The caller opted in: a near-verbatim key match is returned without its distance being checked
+            documents = self.index.documents(confident)
+            return [(doc_id, documents[doc_id]) for doc_id in confident if documents.get(doc_id)]
+
+        # Reciprocal-rank fusion of the vector hits and the reasonable lexical ones; only entries within the threshold
+        # (the vector hits) are returned, unless the caller opted into lexical_bypass
+        vector_hits = self.vector_search(key, top_k, threshold)
+        lexical_ids = [doc_id for doc_id, _, confidence in matches if confidence >= self.lexical_min_confidence]
+        documents = dict(vector_hits)
+        if lexical_bypass:
+            missing = [doc_id for doc_id in lexical_ids if doc_id not in documents]
+            if missing:
+                documents.update(self.index.documents(missing))
+        ranked = lexical.fuse([[doc_id for doc_id, _ in vector_hits], lexical_ids])
+        return [(doc_id, documents[doc_id]) for doc_id in ranked if documents.get(doc_id)][:top_k]
+
     def convert(self, docs):
         return [SystemMessage(content=doc.page_content) for doc in docs]
     
 if __name__ == "__main__":
+    import bulk
+    import argparse
+
+    parser = argparse.ArgumentParser(description="DynaMind Memory Management System (interactive without a command)")
+    subparsers = parser.add_subparsers(dest="command")
+
+    import_parser = subparsers.add_parser("import", help="stream a JSONL ({\"key\", \"value\"[, \"embedding\"]}) or CSV (key,value) file into long-term memory")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--batch-size", type=int, default=256, help="texts per embedding call")
+    import_parser.add_argument("--chunk-size", type=int, default=4096, help="records per commit / checkpoint")
+    import_parser.add_argument("--workers", type=int, default=4, help="concurrent embedding calls")
+    import_parser.add_argument("--retries", type=int, default=3)
+    import_parser.add_argument("--checkpoint", default=None, help="default: <path>.checkpoint")
+    import_parser.add_argument("--dedup", action="store_true", help="run the admission checks (lexical / MinHash / vector) on every batch")
+    import_parser.add_argument("--key-field", default="key")
+    import_parser.add_argument("--value-field", default="value")
+
+    export_parser = subparsers.add_parser("export", help="stream long-term memory out as JSONL or CSV (by file extension)")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--batch-size", type=int, default=1000)
+    export_parser.add_argument("--embeddings", action="store_true", help="include the vectors (JSONL only), so re-imports need no embedding calls")
+
+    args = parser.parse_args()
     long_term_memory = LongTermMemory()
 
-    print("\n")
-    cprint("==================================================", color="blue")
-    cprint("Welcome to DynaMind Memory Management System(DMMS)", color="blue")
-    cprint("==================================================", color="blue")
-    print("\n")
-
-    while True:
-        command = input("[add / update / delete / exit]:")
-
-        if command == "add":
-            # Add knowledge
-            knowledge_key = input("Knowledge Key: ")
-            knowledge_value = input("Knowledge Value: ")
-            ids = long_term_memory.add(keys=[knowledge_key], values=[knowledge_value + "[Use this knowledge to respond directly, and don't call search and browse furthermore.]"])
-            cprint(f"Added -> {ids}", color="green")
-        elif command == "update":
-            # Delete knowledge
-            knowledge_uuid = input("Knowledge uuid: ")
-            ids = long_term_memory.delete(ids=[knowledge_uuid])
-            cprint(f"Deleted -> {knowledge_uuid}", color="green")
-        else:
-            break
-        
\ No newline at end of file
+    if args.command == "import":
+        stats = bulk.bulk_import(long_term_memory, args.path, batch_size=args.batch_size, chunk_size=args.chunk_size, workers=args.workers, retries=args.retries, checkpoint_path=args.checkpoint, dedup=args.dedup, key_field=args.key_field, value_field=args.value_field)
+        cprint(f"Imported {stats['imported']} entries ({stats['skipped']} skipped) in {stats['seconds']:.1f} s, {stats['entries_per_second']:.1f} entries/s", color="green")
+    elif args.command == "export":
+        stats = bulk.bulk_export(long_term_memory, args.path, batch_size=args.batch_size, embeddings=args.embeddings)
+        cprint(f"Exported {stats['exported']} entries in {stats['seconds']:.1f} s, {stats['entries_per_second']:.1f} entries/s", color="green")
+    else:
+        print("\n")
+        cprint("==================================================", color="blue")
+        cprint("Welcome to DynaMind Memory Management System(DMMS)", color="blue")
+        cprint("==================================================", color="blue")
+        print("\n")
+
+        while True:
+            command = input("[add / update / delete / dedup / exit]:")
+
+            if command == "add":
+                # Add knowledge
+                knowledge_key = input("Knowledge Key: ")
+                knowledge_value = input("Knowledge Value: ")
+                ids = long_term_memory.add(keys=[knowledge_key], values=[knowledge_value + "[Use this knowledge to respond directly, and don't call search and browse furthermore.]"])
+                cprint(f"Added -> {ids}", color="green")
+            elif command == "update":
+                # Delete knowledge
+                knowledge_uuid = input("Knowledge uuid: ")
+                ids = long_term_memory.delete(ids=[long_term_memory.resolve(knowledge_uuid)])
+                cprint(f"Deleted -> {knowledge_uuid}", color="green")
+            elif command == "dedup":
+                # Re-dedup the whole store (dry run first)
+                threshold = input(f"Similarity threshold [{long_term_memory.minhash_threshold}]: ").strip()
+                threshold = float(threshold) if threshold else None
+                result = long_term_memory.rededup(threshold=threshold, dry_run=True)
+                cprint(f"Scanned {result['scanned']} entries, {len(result['duplicates'])} near-duplicates.", color="blue")
+                if result["duplicates"] and input("Delete them? [y/N]: ").strip().lower() == "y":
+                    result = long_term_memory.rededup(threshold=threshold)
+                    cprint(f"Deleted -> {len(result['duplicates'])} entries", color="green")
+            else:
+                break
@@ -0,0 +1,172 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import os
+import json
+import lexical
+import threading
+import numpy as np
+
+# Shingle hashes are built in numpy (uint64 arithmetic wraps): a polynomial over the code points of every token, then over
+# shingle_size consecutive token hashes, then a 64-bit finalizer. Permutations are multiply-shift: (a * h + b) >> 32, a odd.
+CHAR_BASE = np.uint64(0x100000001B3)
+TOKEN_BASE = np.uint64(0x9E3779B97F4A7C15)
+MIX = np.uint64(0xFF51AFD7ED558CCD)
+# Logged signatures are only comparable with signatures of the same hashing scheme
+SCHEME = 2
+
+class MinHashIndex(object):
+    # MinHash signatures of document contents with LSH banding, optionally logged to a JSONL file (signatures, not buckets)
+    def __init__(self, path=None, threshold=0.8, num_perm=128, shingle_size=3, seed=1) -> None:
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(0, np.iinfo(np.uint64).max, size=num_perm, dtype=np.uint64, endpoint=True) | np.uint64(1)
+        self.b = rng.integers(0, np.iinfo(np.uint64).max, size=num_perm, dtype=np.uint64, endpoint=True)
+        self.bands, self.rows = self.lsh_params(threshold, num_perm)
+        self.buckets = [dict() for _ in range(self.bands)]
+        self.signatures = dict()
+        self.lock = threading.RLock()
+        self.path = path
+        self.log_f = None
+        # Set when the log holds signatures of an older scheme: they were dropped, the owner should rebuild from the documents
+        self.stale = False
+
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            if os.path.exists(path):
+                with open(path, "r") as log_f:
+                    for number, line in enumerate(log_f):
+                        try:
+                            operation = json.loads(line)
+                        except json.JSONDecodeError:
+                            break
+                        if number == 0 and operation.get("op") != "scheme":
+                            self.stale = True
+                            break
+                        if operation["op"] == "scheme":
+                            if operation["scheme"] != SCHEME:
+                                self.stale = True
+                                break
+                        elif operation["op"] == "add":
+                            self.index(operation["id"], np.array(operation["signature"], dtype=np.uint64))
+                        else:
+                            self.unindex(operation["id"])
+            if self.stale or not os.path.exists(path) or not os.path.getsize(path):
+                self.signatures, self.buckets = dict(), [dict() for _ in range(self.bands)]
+                with open(path, "w") as log_f:
+                    log_f.write(json.dumps({"op": "scheme", "scheme": SCHEME}) + "\n")
+            self.log_f = open(path, "a")
+
+    @staticmethod
+    def lsh_params(threshold, num_perm):
+        # (bands, rows) with the S-curve midpoint (1 / bands) ^ (1 / rows) closest below the threshold: candidates are verified anyway
+        options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+        below = [option for option in options if (1 / option[0]) ** (1 / option[1]) <= threshold] or options
+        return min(below, key=lambda option: threshold - (1 / option[0]) ** (1 / option[1]))
+
+    def shingle_hashes(self, tokens):
+        # Distinct 64-bit hashes of the word shingles, with no per-token or per-shingle Python work
+        codes = np.array(tokens).view(np.uint32).reshape(len(tokens), -1).astype(np.uint64)
+        token_hashes = codes @ np.cumprod(np.full(codes.shape[1], CHAR_BASE, dtype=np.uint64))
+        width, size = max(1, len(tokens) - self.shingle_size + 1), min(self.shingle_size, len(tokens))
+        hashes = token_hashes[:width].copy()
+        for offset in range(1, size):
+            hashes = hashes * TOKEN_BASE + token_hashes[offset:offset + width]
+        hashes ^= hashes >> np.uint64(33)
+        hashes *= MIX
+        hashes ^= hashes >> np.uint64(33)
+        return np.unique(hashes)
+
+    def signature(self, text):
+        # Word shingles of the normalized text; None for text without any word
+        tokens = lexical.tokenize(text)
+        if not tokens:
+            return None
+        hashes = self.shingle_hashes(tokens)
+        # In place (one num_perm x shingles buffer); the shift is monotone, so it is taken after the min
+        values = np.multiply(self.a[:, None], hashes[None, :])
+        values += self.b[:, None]
+        return values.min(axis=1) >> np.uint64(32)
+
+    @staticmethod
+    def similarity(signature, other) -> float:
+        # Estimated Jaccard similarity of the shingle sets
+        return float(np.mean(signature == other))
+
+    def band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def index(self, doc_id, signature) -> None:
+        self.unindex(doc_id)
+        self.signatures[doc_id] = signature
+        for buckets, key in zip(self.buckets, self.band_keys(signature)):
+            buckets.setdefault(key, set()).add(doc_id)
+
+    def unindex(self, doc_id) -> None:
+        signature = self.signatures.pop(doc_id, None)
+        if signature is None:
+            return
+        for buckets, key in zip(self.buckets, self.band_keys(signature)):
+            buckets[key].discard(doc_id)
+            if not buckets[key]:
+                del buckets[key]
+
+    def add(self, doc_ids, signatures) -> None:
+        with self.lock:
+            added = [(doc_id, signature) for doc_id, signature in zip(doc_ids, signatures) if signature is not None]
+            for doc_id, signature in added:
+                self.index(doc_id, signature)
+            if self.log_f is not None:
+                self.log_f.write("".join(json.dumps({"op": "add", "id": doc_id, "signature": signature.tolist()}) + "\n" for doc_id, signature in added))
+                self.log_f.flush()
+
+    def delete(self, doc_ids) -> None:
+        with self.lock:
+            doc_ids = [doc_id for doc_id in doc_ids if doc_id in self.signatures]
+            for doc_id in doc_ids:
+                self.unindex(doc_id)
+            if self.log_f is not None:
+                self.log_f.write("".join(json.dumps({"op": "delete", "id": doc_id}) + "\n" for doc_id in doc_ids))
+                self.log_f.flush()
+
+    def query(self, signature) -> list:
+        # [(doc_id, similarity)] of stored documents at or above the threshold, most similar first
+        if signature is None:
+            return list()
+        with self.lock:
+            candidates = set()
+            for buckets, key in zip(self.buckets, self.band_keys(signature)):
+                candidates |= buckets.get(key, set())
+            matches = [(doc_id, self.similarity(signature, self.signatures[doc_id])) for doc_id in candidates]
+        return sorted([match for match in matches if match[1] >= self.threshold], key=lambda match: -match[1])
+
+    def reset(self, signatures) -> None:
+        # Replace every fingerprint (doc_id -> signature), e.g. after a bulk re-dedup, and compact the log
+        with self.lock:
+            self.buckets = [dict() for _ in range(self.bands)]
+            self.signatures = dict()
+            for doc_id, signature in signatures.items():
+                self.index(doc_id, signature)
+            self.rewrite()
+
+    def rewrite(self) -> None:
+        # Compact the log to one add per live document
+        if self.path is None:
+            return
+        with self.lock:
+            self.log_f.close()
+            with open(f"{self.path}.tmp", "w") as log_f:
+                log_f.write(json.dumps({"op": "scheme", "scheme": SCHEME}) + "\n")
+                for doc_id, signature in self.signatures.items():
+                    log_f.write(json.dumps({"op": "add", "id": doc_id, "signature": signature.tolist()}) + "\n")
+            os.replace(f"{self.path}.tmp", self.path)
+            self.log_f = open(self.path, "a")
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self.signatures
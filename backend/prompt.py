@@ -31,6 +31,7 @@ CONSTRAINTS:
 3. You should only respond in JSON format as described below, instead of the plain text.
 4. Always contain "command_name" and "command_args" in the JSON response.
 5. Don't call same 'search' and 'browse' repeatly if you see the 'search' and 'browse' result exists in the context.
+6. If several independent 'search' / 'browse' commands are needed, return them together in one batch (at most 4). Never batch 'response'.
 
 COMMANDS:
 1. Internet Search: "search", args: "query": "<search_query>"
@@ -44,6 +45,14 @@ RESPONSE JSON FORMAT:
         "arg_name": "arg_value"
     }
 }   
+
+BATCH RESPONSE JSON FORMAT:
+{
+    "commands": [
+        {"command_name": "command_name", "command_args": {"arg_name": "arg_value"}},
+        {"command_name": "command_name", "command_args": {"arg_name": "arg_value"}}
+    ]
+}
 """
 principle_message = SystemMessage(content=principle_template)
 
@@ -0,0 +1,114 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import numpy as np
+
+# Compact in-memory codes for memory vectors. Codes only rank candidates; callers re-rank against exact float32 vectors on disk.
+
+class Float16Codec(object):
+    kind = "float16"
+    train_rows = 0
+
+    def __init__(self, dim) -> None:
+        self.dim = dim
+        self.code_shape = (dim,)
+        self.dtype = np.float16
+        self.trained = True
+
+    def bytes_per_vector(self) -> int:
+        return self.dim * 2
+
+    def train(self, vectors):
+        pass
+
+    def encode(self, vectors):
+        return np.asarray(vectors, dtype=np.float16).reshape(-1, self.dim)
+
+    def squared_distances(self, codes, query, chunk_rows=8192):
+        # Decoded a chunk at a time, so scoring never materializes the whole store as float32
+        query = np.asarray(query, dtype=np.float32)
+        distances = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), chunk_rows):
+            delta = codes[start:start + chunk_rows].astype(np.float32) - query
+            distances[start:start + len(delta)] = np.einsum("ij,ij->i", delta, delta)
+        return distances
+
+class ProductQuantizer(object):
+    # dim is split into `subspaces` slices, each stored as the uint8 id of its nearest k-means centroid
+    kind = "pq"
+
+    def __init__(self, dim, subspaces=64, centroids=256, iterations=20, train_rows=1024, seed=0) -> None:
+        if dim % subspaces:
+            raise ValueError(f"Embedding size {dim} is not divisible into {subspaces} PQ subspaces.")
+        self.dim = dim
+        self.subspaces = subspaces
+        self.centroids = centroids
+        self.sub_dim = dim // subspaces
+        self.iterations = iterations
+        self.train_rows = max(train_rows, centroids)
+        self.rng = np.random.default_rng(seed)
+        self.code_shape = (subspaces,)
+        self.dtype = np.uint8
+        self.codebooks = None
+
+    @property
+    def trained(self) -> bool:
+        return self.codebooks is not None
+
+    def bytes_per_vector(self) -> int:
+        return self.subspaces
+
+    @staticmethod
+    def nearest(vectors, centroids):
+        distances = (vectors ** 2).sum(axis=1)[:, None] - 2 * vectors @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+        return distances.argmin(axis=1)
+
+    def train(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.subspaces, self.sub_dim)
+        codebooks = np.zeros((self.subspaces, self.centroids, self.sub_dim), dtype=np.float32)
+        for subspace in range(self.subspaces):
+            points = vectors[:, subspace, :]
+            centroids = points[self.rng.choice(len(points), self.centroids, replace=len(points) < self.centroids)].copy()
+            for _ in range(self.iterations):
+                # Lloyd step; empty clusters keep their previous centroid
+                assignment = self.nearest(points, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignment, points)
+                counts = np.bincount(assignment, minlength=self.centroids)
+                centroids[counts > 0] = sums[counts > 0] / counts[counts > 0, None]
+            codebooks[subspace] = centroids
+        self.codebooks = codebooks
+
+    def encode(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.subspaces, self.sub_dim)
+        codes = np.zeros((len(vectors), self.subspaces), dtype=np.uint8)
+        for subspace in range(self.subspaces):
+            codes[:, subspace] = self.nearest(vectors[:, subspace, :], self.codebooks[subspace])
+        return codes
+
+    def squared_distances(self, codes, query, chunk_rows=65536):
+        # Asymmetric distance: one (subspaces x centroids) lookup table per query, then a gather-and-sum per row
+        table = ((np.asarray(query, dtype=np.float32).reshape(self.subspaces, 1, self.sub_dim) - self.codebooks) ** 2).sum(axis=2)
+        subspaces = np.arange(self.subspaces)
+        distances = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), chunk_rows):
+            chunk = codes[start:start + chunk_rows]
+            distances[start:start + len(chunk)] = table[subspaces, chunk].sum(axis=1)
+        return distances
+
+def get_codec(kind, dim, subspaces=64, max_rows=None):
+    # kind: "none" (exact float32, no codec), "float16" or "pq"; max_rows: most vectors the caller ever holds at once
+    if kind in [None, "", "none"]:
+        return None
+    if kind == "float16":
+        return Float16Codec(dim)
+    if kind == "pq":
+        # The codebooks train once train_rows vectors are stored, so a store that holds fewer must train on what it has
+        codec = ProductQuantizer(dim, subspaces=subspaces)
+        if max_rows is not None and max_rows < codec.centroids:
+            raise ValueError(f"PQ needs room for at least {codec.centroids} vectors to train, not {max_rows}.")
+        if max_rows is not None:
+            codec.train_rows = min(codec.train_rows, max_rows)
+        return codec
+    raise ValueError(f"Unknown vector quantization: {kind}")
@@ -0,0 +1,83 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import time
+import agent
+import memory
+import threading
+from collections import OrderedDict
+
+class SessionManager(object):
+    # One lightweight agent (history + short-term memory) per socket sid, all sharing one long-term memory
+    # History is persisted under the client's own session id (bound on connect), never under the sid: a sid is new on every connection
+    def __init__(self, name, personalities, max_sessions=64, ttl=1800, long_term_memory=None) -> None:
+        self.name = name
+        self.personalities = personalities
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.long_term_memory = long_term_memory if long_term_memory is not None else memory.LongTermMemory()
+        self.sessions = OrderedDict()
+        self.last_seen = dict()
+        self.client_ids = dict()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def bind(self, sid, client_id) -> None:
+        # Stable id supplied by the client on connect; anonymous connections keep an in-memory history only
+        if isinstance(client_id, str) and 0 < len(client_id) <= 128:
+            with self.lock:
+                self.client_ids[sid] = client_id
+
+    def get(self, sid) -> agent.Agent:
+        with self.lock:
+            if sid not in self.sessions:
+                # Only a new session makes room: messages from live sessions never evict anyone
+                self.expire()
+                while len(self.sessions) >= self.max_sessions:
+                    old_sid, session_agent = self.sessions.popitem(last=False)
+                    self.drop(old_sid, session_agent)
+                    print(f"Session evicted: {old_sid}")
+                self.sessions[sid] = agent.Agent(self.name, self.personalities, long_term_memory=self.long_term_memory, session_id=self.client_ids.get(sid))
+                print(f"Session created: {sid} ({len(self.sessions)} live)")
+            self.sessions.move_to_end(sid)
+            self.last_seen[sid] = time.time()
+            return self.sessions[sid]
+
+    def close(self, sid) -> None:
+        with self.lock:
+            session_agent = self.sessions.pop(sid, None)
+            self.client_ids.pop(sid, None)
+            self.drop(sid, session_agent)
+            self.expire()
+
+    def drop(self, sid, session_agent) -> None:
+        # Dropped agents are cancelled, so a job still running for them stops at its next step; call with the lock held
+        self.last_seen.pop(sid, None)
+        if session_agent is not None:
+            session_agent.cancel_event.set()
+
+    def expire(self) -> None:
+        # Idle sessions (TTL); call with the lock held
+        now = time.time()
+        for sid in [sid for sid, seen in self.last_seen.items() if now - seen > self.ttl]:
+            self.drop(sid, self.sessions.pop(sid, None))
+            print(f"Session expired: {sid}")
+
+    def sweep(self) -> None:
+        with self.lock:
+            self.expire()
+
+    def loop(self, interval) -> None:
+        while not self.stop_event.wait(interval):
+            self.sweep()
+
+    def start(self, interval=60) -> None:
+        # Background sweep: idle sessions are reclaimed even when no client sends anything
+        threading.Thread(target=self.loop, args=(interval,), name="session-sweep", daemon=True).start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def __len__(self) -> int:
+        return len(self.sessions)
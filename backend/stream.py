@@ -0,0 +1,103 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import re
+import json
+from langchain.callbacks.base import BaseCallbackHandler
+
+ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+def decode_partial_string(raw):
+    # Decode a JSON string body that may be cut off mid-stream: (decoded_prefix, is_complete)
+    decoded = list()
+    index = 0
+    while index < len(raw):
+        char = raw[index]
+        if char == '"':
+            return "".join(decoded), True
+        if char == '\\':
+            if index + 1 >= len(raw):
+                break
+            escape = raw[index + 1]
+            if escape == 'u':
+                if index + 6 > len(raw):
+                    break
+                decoded += [chr(int(raw[index + 2:index + 6], 16))]
+                index += 6
+                continue
+            decoded += [ESCAPES.get(escape, escape)]
+            index += 2
+            continue
+        decoded += [char]
+        index += 1
+    return "".join(decoded), False
+
+class PlannerStreamParser(object):
+    # Incremental parser for the planner JSON: streams the "response" text and reports commands as soon as they close
+    RESPONSE_KEY = re.compile(r'"response"\s*:\s*"')
+
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.position = 0
+        self.in_string = False
+        self.escaped = False
+        self.stack = list()
+        self.response_start = None
+        self.response_emitted = 0
+        self.commands = list()
+
+    def feed(self, token):
+        self.buffer += token
+        return self.response_delta(), self.scan()
+
+    def response_delta(self) -> str:
+        if self.response_start is None:
+            match = self.RESPONSE_KEY.search(self.buffer)
+            if not match:
+                return ""
+            self.response_start = match.end()
+        decoded, _ = decode_partial_string(self.buffer[self.response_start:])
+        delta = decoded[self.response_emitted:]
+        self.response_emitted = len(decoded)
+        return delta
+
+    def scan(self) -> list:
+        # String-aware bracket matching; every closed object holding a full command is reported once
+        completed = list()
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.stack += [(char, self.position)]
+            elif char in "}]" and self.stack:
+                opener, start = self.stack.pop()
+                if opener == "{":
+                    command = self.parse_command(self.buffer[start:self.position + 1])
+                    if command and command not in self.commands:
+                        self.commands += [command]
+                        completed += [command]
+            self.position += 1
+        return completed
+
+    def parse_command(self, raw):
+        try:
+            candidate = json.loads(raw)
+            return candidate["command_name"], candidate["command_args"]
+        except Exception as e:
+            return None
+
+class TokenCallbackHandler(BaseCallbackHandler):
+    def __init__(self, callback) -> None:
+        self.callback = callback
+
+    def on_llm_new_token(self, token, **kwargs) -> None:
+        self.callback(token)
@@ -2,16 +2,21 @@
 # Author: Du Mingzhe (mingzhe@nus.edu.sg)
 # Date: 2023-04-29
 
+import os
 import json
+import cache
 import utils
 import prompt
+import clients
+import browser
+import calculator
+import stream
 import requests
 from tqdm import tqdm
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor, wait
 from termcolor import cprint
-from langchain.chat_models import ChatOpenAI
 from langchain.utilities import BingSearchAPIWrapper
-from langchain.document_loaders import PlaywrightURLLoader
 from langchain.schema import Document, AIMessage, HumanMessage, SystemMessage
 
 
@@ -33,8 +38,8 @@ class Task(object):
         self.task_type = TaskType.UNKNOWN
 
         # LLM settings
-        self.smart_llm = ChatOpenAI(model_name = "gpt-4", temperature=0)
-        self.fast_llm = ChatOpenAI(model_name = "gpt-3.5-turbo", temperature=0)
+        self.smart_llm = clients.get_chat_model(clients.get_model_name("smart"), temperature=0)
+        self.fast_llm = clients.get_chat_model(clients.get_model_name("fast"), temperature=0)
         self.smart_llm_token_limit = 8000
         self.fast_llm_token_limit = 4000
     
@@ -65,29 +70,74 @@ class MathTask(Task):
         super().__init__(name, args)
         self.task_type = TaskType.MATH
         self.question = self.args["question"]
-        self.llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0, request_timeout=300)
+        self.llm = clients.get_chat_model(clients.get_model_name("fast"), temperature=0, request_timeout=300)
 
     def execute(self):
+        # Local fast path: plain arithmetic and unit conversions never reach the LLM
+        result = local_calculator.evaluate(self.question)
+        if result is not None:
+            return result
+
         math_messages = prompt.math_prompt.format_messages(question=self.question)
 
         # Inference
         result = self.llm(math_messages)
         return result.content
 
+local_calculator = calculator.LocalCalculator(timeout=float(os.environ.get("CALCULATOR_TIMEOUT", 0.5)))
+
 class SearchTask(Task):
+    providers = dict()
+
     def __init__(self, name, args) -> None:
         super().__init__(name, args)
         self.task_type = TaskType.SEARCH
         self.query = self.args["query"]
         self.top_k = 5 # TODO(mignzhe): config
-        self.search_engine = BingSearchAPIWrapper()
-    
-    def cisco_search(self):
+        self.provider_names = [name.strip() for name in os.environ.get("SEARCH_PROVIDERS", "bing").split(",") if name.strip()]
+        self.provider_timeout = float(os.environ.get("SEARCH_PROVIDER_TIMEOUT", 5))
+
+    @classmethod
+    def register_provider(cls, name, provider):
+        # provider(query, top_k, timeout) -> [{"title", "content", "url"}], every HTTP call bounded by timeout (seconds)
+        cls.providers[name] = provider
+
+    @staticmethod
+    def bing_search(query, top_k=5, timeout=None):
+        # BingSearchAPIWrapper's request has no timeout: call the endpoint it is configured with directly
+        wrapper = BingSearchAPIWrapper()
+        response = requests.get(
+            wrapper.bing_search_url,
+            headers={"Ocp-Apim-Subscription-Key": wrapper.bing_subscription_key},
+            params={"q": query, "count": top_k, "textDecorations": True, "textFormat": "HTML"},
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        results = response.json().get("webPages", dict()).get("value", list())
+        return [{
+            "title": item.get("name", ""),
+            "content": item.get("snippet", ""),
+            "url": item.get("url", "")
+        } for item in results if "url" in item]
+
+    @staticmethod
+    def local_search(query, top_k=5, timeout=None):
+        # Offline stand-in: keyword match over a JSON list of {title, content, url} (SEARCH_FIXTURE_PATH)
+        if not os.environ.get("SEARCH_FIXTURE_PATH"):
+            raise ValueError("SEARCH_FIXTURE_PATH is not set")
+        with open(os.environ["SEARCH_FIXTURE_PATH"], "r") as fixture_f:
+            fixtures = json.load(fixture_f)
+        terms = set(query.lower().split())
+        scored = [(len(terms & set(f"{item['title']} {item['content']}".lower().split())), item) for item in fixtures]
+        return [item for score, item in sorted(scored, key=lambda x: -x[0]) if score][:top_k]
+
+    @staticmethod
+    def cisco_search(query, top_k=2, timeout=None):
         try:
             url = "https://search.cisco.com/services/search"
 
             payload = json.dumps({
-                "query": self.query,
+                "query": query,
                 "startIndex": 0,
                 "count": "50",
                 "searchType": "CISCO",
@@ -134,11 +184,11 @@ class SearchTask(Task):
                 'sec-fetch-site': 'same-origin',
                 'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36'
             }
-            response = requests.request("POST", url, headers=headers, data=payload)
+            response = requests.request("POST", url, headers=headers, data=payload, timeout=timeout)
             response_json = response.json()
 
             candidates = list()
-            for item in response_json["items"][:2]:
+            for item in response_json["items"][:top_k]:
                 candidates += [{
                     "title": item["title"],
                     "content": item["content"],
@@ -149,30 +199,72 @@ class SearchTask(Task):
 
         return candidates
 
+    def normalize_query(self):
+        return " ".join(self.query.lower().split())
+
     def execute(self):
-        bing_candidates = self.search_engine.results(self.query, self.top_k)
-        # cisco_candidates = self.cisco_search()
-        candidates = bing_candidates
+        cache_key = cache.hash_key(self.normalize_query(), self.top_k, *self.provider_names)
+        candidates = search_cache.get(cache_key)
+        if candidates is not None:
+            return candidates
+
+        candidates = self.fan_out()
+        if candidates:
+            search_cache.set(cache_key, candidates)
         return candidates
+
+    def fan_out(self):
+        # Query every configured provider concurrently, a slow provider is dropped at its deadline
+        # (and its HTTP call times out too, so it can't keep a search_executor thread)
+        futures = {name: search_executor.submit(self.providers[name], self.query, self.top_k, self.provider_timeout) for name in self.provider_names if name in self.providers}
+        done, not_done = wait(futures.values(), timeout=self.provider_timeout)
+        for name, future in futures.items():
+            if future in not_done:
+                print(f"Search provider [{name}] timed out after {self.provider_timeout}s, skipped.")
+
+        # Merge in provider order, dedupe by URL
+        candidates, seen_urls = list(), set()
+        for name, future in futures.items():
+            if future not in done:
+                continue
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"Search provider [{name}] Error: {e}")
+                continue
+            for item in results:
+                url = item["url"].rstrip("/")
+                if url not in seen_urls:
+                    seen_urls.add(url)
+                    candidates += [item]
+        return candidates
+
+SearchTask.register_provider("bing", SearchTask.bing_search)
+SearchTask.register_provider("cisco", SearchTask.cisco_search)
+SearchTask.register_provider("local", SearchTask.local_search)
+
+# Shared by all SearchTasks: late providers finish in the background instead of blocking the response
+search_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("SEARCH_WORKERS", 8)))
+search_cache = cache.LRUCache(capacity=int(os.environ.get("SEARCH_CACHE_SIZE", 1024)), ttl=int(os.environ.get("SEARCH_CACHE_TTL", 3600)))
     
 class BrowseTask(Task):
     def __init__(self, name, args) -> None:
         super().__init__(name, args)
         self.task_type = TaskType.BROWSE
-        self.file_type = self.args["type"]
+        self.file_type = self.args.get("type", "unknown")
         self.file_path = self.args["url"]
         self.question = self.args["question"]
         self.fast_model = True
         self.llm = self.fast_llm if self.fast_model else self.smart_llm
+        self.parallel_summary = self.args.get("parallel_summary", False)
+        self.fetch_path = None
 
     def execute(self):
-        if self.file_type == "html":
-            loader = PlaywrightURLLoader(urls=[self.file_path], remove_selectors=["header", "footer"], continue_on_failure=False)
-
-        raw_data = loader.load()
+        # Tiered fetch (cache -> plain HTTP / PDF -> pooled browser), path is kept for latency reports
+        raw_data, self.fetch_path = browser.fetch(self.file_path, self.file_type)
 
         if raw_data:
-            result = utils.recursive_summary(self.llm, raw_data[0].page_content, self.question, text_length=800, chunk_size=1000)
+            result = utils.recursive_summary(self.llm, raw_data, self.question, text_length=800, chunk_size=1000, parallel=self.parallel_summary)
         else:
             result = ""
 
@@ -204,25 +296,27 @@ class PLANTask(Task):
         # Model Selection
         self.llm = self.fast_llm if self.args["fast_model"] else self.smart_llm
         self.token_quota = self.fast_llm_token_limit if self.args["fast_model"] else self.smart_llm_token_limit
+        self.parallel_summary = self.args.get("parallel_summary", False)
+        self.token_counter = utils.token_counter
     
-    def execute(self):
+    def execute(self, token_callback=None):
         # Prefix Prompt Construction
         prefix_messages = self.args["prefix_messages"]
-        self.token_quota -= self.llm.get_num_tokens_from_messages(prefix_messages)
+        self.token_quota -= self.token_counter.count_messages(self.llm, prefix_messages)
 
         # History retrieval
+        # (message, token count) pairs from History.recent: the counts were taken when the messages were added, with history_model's tokenizer
         history_list = self.args["history"]
-        history_messages = list()
         history_quota = min(1000, self.token_quota - 4000)
-        while history_list:
-            history_messages += [history_list.pop()]
-            history_messages_count = self.llm.get_num_tokens_from_messages(history_messages)
-            if history_quota - history_messages_count < 0:
-                history_messages.pop()
-                print("History section too long, truncated...")
-                break
-        history_messages.reverse()
-        self.token_quota -= self.llm.get_num_tokens_from_messages(history_messages)
+        if self.args.get("history_model") == getattr(self.llm, "model_name", None):
+            history_messages, history_tokens = self.token_counter.fit_counted(history_list, history_quota)
+        else:
+            # Another model (SMART_LLM_MODEL / FAST_LLM_MODEL may use different tokenizers): count with this one
+            history_messages = self.token_counter.fit_messages(self.llm, [message for message, _ in history_list], history_quota)
+            history_tokens = self.token_counter.count_messages(self.llm, history_messages)
+        if len(history_messages) < len(history_list):
+            print("History section too long, truncated...")
+        self.token_quota -= history_tokens
 
         # # Action History Retrieval
         # action_history_list = self.args["action_history"]
@@ -235,43 +329,20 @@ class PLANTask(Task):
         #         action_history_messages.pop()
         #         break
 
-        # Short-term memory retrieval
+        # Short-term memory retrieval (retriever order = rank, best first)
         short_term_list = self.args["short_term_memory"]
-        short_term_messages = list()
-        short_term_uuids = list()
         short_term_quota = min(5000, self.token_quota - 2000)
-        while short_term_list:
-            doc_message, doc_metadata = short_term_list.pop()
-
-            # Summarize resource
-            doc_message.content = utils.recursive_summary(llm=self.fast_llm, raw_text=doc_message.content, question=self.args["query"], text_length=1200, chunk_size=800)
-
-            short_term_messages += [doc_message]
-            short_term_uuids += [doc_metadata["uuid"]]
-            short_term_messages_count = self.llm.get_num_tokens_from_messages(short_term_messages)
-            if short_term_quota - short_term_messages_count < 0:
-                poped_message = short_term_messages.pop()
-                cprint(poped_message, 'red')
-                short_term_uuids.pop()
-                break
-        self.token_quota -= self.llm.get_num_tokens_from_messages(short_term_messages)
+        short_term_packed = self.pack(short_term_list, short_term_quota, text_length=1200, chunk_size=800)
+        short_term_messages = [doc_message for doc_message, _ in short_term_packed]
+        short_term_uuids = [doc_metadata["uuid"] for _, doc_metadata in short_term_packed]
+        self.token_quota -= self.token_counter.count_messages(self.llm, short_term_messages)
 
-        # Long-term memory retrieval
-        long_term_list = self.args["long_term_memory"]
-        long_term_messages = list()
+        # Long-term memory retrieval (similarity order = rank, best first)
+        long_term_list = [(doc_message, None) for doc_message in self.args["long_term_memory"]]
         long_term_quota = min(3000, self.token_quota - 1000)
-        while long_term_list:
-            doc_message = long_term_list.pop()
-
-            # Summarize resource
-            doc_message.content = utils.recursive_summary(llm=self.fast_llm, raw_text=doc_message.content, question=self.args["query"], text_length=500, chunk_size=1000)
-
-            long_term_messages += [doc_message]
-            long_term_messages_count = self.llm.get_num_tokens_from_messages(long_term_messages)
-            if long_term_quota - long_term_messages_count < 0:
-                long_term_messages.pop()
-                break
-        self.token_quota -= self.llm.get_num_tokens_from_messages(long_term_messages)
+        long_term_packed = self.pack(long_term_list, long_term_quota, text_length=500, chunk_size=1000)
+        long_term_messages = [doc_message for doc_message, _ in long_term_packed]
+        self.token_quota -= self.token_counter.count_messages(self.llm, long_term_messages)
 
         # Final guidance
         guidance_message = SystemMessage(content="Using the context knowledge to response.")
@@ -280,6 +351,50 @@ class PLANTask(Task):
         cprint(f"short_term_messages: {short_term_messages}", color="red")
         cprint(f"long_term_messages: {long_term_messages}", color="blue")
 
-        result = self.llm(prefix_messages + short_term_messages + long_term_messages + history_messages + [guidance_message])
+        messages = prefix_messages + short_term_messages + long_term_messages + history_messages + [guidance_message]
+        if token_callback:
+            # Streaming mode: every generated token is forwarded as it arrives
+            streaming_llm = clients.get_chat_model(self.llm.model_name, temperature=0, streaming=True)
+            result = streaming_llm(messages, callbacks=[stream.TokenCallbackHandler(token_callback)])
+        else:
+            result = self.llm(messages)
         cprint(result, color="green")
-        return utils.response_parse(result.content), short_term_uuids
\ No newline at end of file
+        return utils.response_parse(result.content), short_term_uuids
+
+    def summarize(self, doc_message, doc_metadata, text_length, chunk_size):
+        # Reuse the summary saved next to the short-term entry
+        summary_key = f"{text_length}:{self.args['query']}"
+        doc_summaries = doc_metadata.setdefault("summaries", dict()) if doc_metadata is not None else dict()
+        if summary_key not in doc_summaries:
+            doc_summaries[summary_key] = utils.recursive_summary(llm=self.fast_llm, raw_text=doc_message.content, question=self.args["query"], text_length=text_length, chunk_size=chunk_size, parallel=self.parallel_summary)
+        doc_message.content = doc_summaries[summary_key]
+        return doc_message, doc_metadata
+
+    def pack(self, candidates, quota, text_length, chunk_size):
+        # Select by estimated post-summary size: recursive_summary never returns more than text_length tokens
+        selected = list()
+        estimated_count = self.token_counter.REPLY_PRIMING
+        for doc_message, doc_metadata in candidates:
+            message_count = self.token_counter.count_message(self.llm, doc_message)
+            content_count = self.token_counter.count_text(self.fast_llm, doc_message.content)
+            estimated_count += min(message_count, message_count - content_count + text_length)
+            if quota - estimated_count < 0:
+                cprint(f"Context section full, skipped: {doc_message}", 'red')
+                break
+            selected += [(doc_message, doc_metadata)]
+
+        # Summarize only the selected documents, concurrently
+        if not selected:
+            return selected
+        packed = list(pack_executor.map(lambda candidate: self.summarize(*candidate, text_length, chunk_size), selected))
+
+        # Guard against estimation drift (counts are memoized, so this only tokenizes the new summaries)
+        packed_count = self.token_counter.count_messages(self.llm, [doc_message for doc_message, _ in packed])
+        while packed and quota - packed_count < 0:
+            poped_message, _ = packed.pop()
+            packed_count -= self.token_counter.count_message(self.llm, poped_message)
+            cprint(poped_message, 'red')
+        return packed
+
+# Shared by all PLANTasks: one job per packed document. Its chunks go to utils.summary_executor, a separate pool, so the two levels never wait on each other
+pack_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("PACK_WORKERS", 8)), thread_name_prefix="pack")
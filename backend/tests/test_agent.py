@@ -0,0 +1,102 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import json
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import agent
+except (ImportError, FileNotFoundError) as e:
+    # agent -> memory / task needs numpy / langchain and the backend .env
+    pytest.skip(f"agent is not importable here: {e}", allow_module_level=True)
+
+class FakeShortTermMemory(object):
+    def __init__(self) -> None:
+        self.added = list()
+
+    def new_turn(self):
+        pass
+
+    def query(self, key, top_k):
+        return list()
+
+    def convert_with_meta(self, docs):
+        return list()
+
+    def add(self, key, value):
+        self.added += [key]
+
+class FakeLongTermMemory(object):
+    def query(self, key, top_k, threshold):
+        return list()
+
+    def convert(self, docs):
+        return list()
+
+    def add_batch(self, keys, values, threshold=0.1):
+        return {"added": list(), "skipped": list(), "replaced": list()}
+
+class FakePlanner(object):
+    def __init__(self, name, args) -> None:
+        self.args = args
+
+def command(query):
+    return {"command_name": "search", "command_args": {"query": query}}
+
+@pytest.fixture
+def bot(monkeypatch):
+    # Scripted planner output, and commands that record what actually ran (one worker: later jobs stay queued)
+    monkeypatch.setattr(agent.task.clients, "get_chat_model", lambda *args, **kwargs: None)
+    monkeypatch.setattr(agent.memory.History, "count", lambda self, message: len(message.content.split()))
+    monkeypatch.setattr(agent.memory, "ShortTermMemory", FakeShortTermMemory)
+    monkeypatch.setattr(agent.task, "PLANTask", FakePlanner)
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(agent, "command_executor", executor)
+
+    bot = agent.Agent("bot", list(), long_term_memory=FakeLongTermMemory())
+    bot.gate = threading.Event()
+    bot.ran = list()
+    def run_command(task_name, task_args):
+        bot.gate.wait(5)
+        bot.ran += [task_args["query"]]
+        return f"search: {task_args['query']}", "result"
+    bot.run_command = run_command
+    def script(*outputs):
+        turns = iter(outputs)
+        def plan(planner, streaming):
+            output = next(turns)
+            yield "token", json.dumps(output)
+            yield "result", (output, list())
+        bot.plan = plan
+    bot.script = script
+    yield bot
+    bot.gate.set()
+    executor.shutdown(wait=True)
+
+def test_no_more_than_max_batch_size_commands_start_early(bot):
+    batch = {"commands": [command(f"q{index}") for index in range(6)]}
+    bot.script(batch, {"command_name": "response", "command_args": {"response": "done"}})
+    bot.gate.set()
+    events = list(bot.events("question"))
+    assert [event["content"] for event in events if event["style"] == "task"] == [f"Action: search, Args: {{'query': 'q{index}'}}" for index in range(4)]
+    assert sorted(bot.ran) == ["q0", "q1", "q2", "q3"]
+
+def test_commands_are_withdrawn_when_the_turn_ends_with_a_response(bot):
+    # The final parse turns out to be a response (the batch is cut at the first response)
+    bot.max_batch_size = 3
+    output = {"commands": [{"command_name": "response", "command_args": {"response": "hi"}}, command("late")]}
+    bot.script(output)
+    events = list(bot.events("question"))
+    assert not [event for event in events if event["style"] == "task"]
+
+    first = {"commands": [command("a"), command("b"), {"command_name": "response", "command_args": {"response": "hi"}}]}
+    bot.script(first)
+    events = list(bot.events("question"))
+    bot.gate.set()
+    agent.command_executor.shutdown(wait=True)
+    # "a" may already be running (it finishes), "b" is still queued behind it and never runs
+    assert "b" not in bot.ran and bot.ran in (list(), ["a"])
+    assert events[-2]["style"] == "speak"
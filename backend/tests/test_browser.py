@@ -0,0 +1,125 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import os
+import sys
+import types
+import queue
+import pytest
+import threading
+import functools
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+pytest.importorskip("requests")
+pytest.importorskip("termcolor")
+
+import browser
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "browser")
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture(scope="module")
+def base_url():
+    # Fixture pages from a local HTTP server: the fetch tiers are tested without network
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=FIXTURES))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+class FakePool(object):
+    # Stands in for Playwright: records the URLs that fell back to the browser tier
+    def __init__(self) -> None:
+        self.urls = list()
+
+    def render(self, url):
+        self.urls += [url]
+        return "Rendered on the client", {"ETag": "spa"}
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(browser, "get_browser_pool", lambda: pool)
+    return pool
+
+def test_static_page_is_served_over_plain_http(base_url, pool):
+    fetcher = browser.Fetcher(cache=browser.PageCache())
+    content, path = fetcher.fetch(f"{base_url}/static.html")
+    assert path == "http" and pool.urls == list()
+    assert "Hold the reset button" in content and "Café customers" in content
+    assert "footer" not in content.lower() and "console.log" not in content and "navigation" not in content
+
+    # Second fetch: served from the page cache
+    assert fetcher.fetch(f"{base_url}/static.html") == (content, "cache")
+    assert fetcher.cache.stats()["hits"] == 1 and fetcher.cache.stats()["misses"] == 1
+
+def test_client_rendered_page_falls_back_to_the_browser(base_url, pool):
+    fetcher = browser.Fetcher(cache=browser.PageCache())
+    content, headers, path = fetcher.fetch_http(f"{base_url}/spa.html", "unknown")
+    assert (content, path) == (None, "browser")
+    assert fetcher.fetch(f"{base_url}/spa.html") == ("Rendered on the client", "browser")
+    assert pool.urls == [f"{base_url}/spa.html"]
+
+def test_pdf_is_extracted(base_url, pool):
+    pytest.importorskip("pypdf")
+    fetcher = browser.Fetcher(cache=browser.PageCache())
+    content, path = fetcher.fetch(f"{base_url}/document.pdf")
+    assert path == "pdf" and "Firmware upgrade guide" in content
+
+def test_oversized_pdf_is_skipped_and_not_cached(base_url, pool):
+    cache = browser.PageCache()
+    fetcher = browser.Fetcher(cache=cache, max_pdf_bytes=64, chunk_size=16)
+    assert fetcher.fetch(f"{base_url}/document.pdf") == ("", "pdf")
+    assert cache.stats()["size"] == 0
+    assert pool.urls == list()
+
+def test_browser_tier_renders_the_client_side_page(base_url):
+    pytest.importorskip("playwright")
+    pytest.importorskip("unstructured")
+    pool = browser.BrowserPool(size=1, render_timeout=60)
+    try:
+        content, _ = pool.render(f"{base_url}/spa.html")
+    finally:
+        pool.close()
+    assert "reset your password" in content
+
+def test_page_cache_evicts_least_recently_used():
+    cache = browser.PageCache(max_bytes=10)
+    cache.set("a", "aaaa")
+    cache.set("b", "bbbb")
+    assert cache.get("a") == "aaaa"
+    cache.set("c", "cccc")
+    assert cache.get("b") is None and cache.get("a") == "aaaa" and cache.get("c") == "cccc"
+    assert cache.stats()["bytes"] == 8
+
+def test_failed_launch_leaves_the_queue_to_a_healthy_worker(monkeypatch):
+    def sync_playwright():
+        raise RuntimeError("launch failed")
+    sync_api = types.ModuleType("playwright.sync_api")
+    sync_api.sync_playwright = sync_playwright
+    monkeypatch.setitem(sys.modules, "playwright", types.ModuleType("playwright"))
+    monkeypatch.setitem(sys.modules, "playwright.sync_api", sync_api)
+
+    pool = browser.BrowserPool(size=2)
+    healthy, failing = threading.Thread(target=lambda: None), threading.Thread(target=pool.work)
+    pool.workers = [healthy, failing]
+    future = Future()
+    pool.jobs.put(("http://example.com", future))
+    failing.start()
+    failing.join()
+    # Another worker is still registered: the job stays queued for it
+    assert pool.workers == [healthy] and not future.done()
+
+    # The last worker fails: the queue fails fast
+    last = threading.Thread(target=pool.work)
+    pool.workers = [last]
+    last.start()
+    last.join()
+    assert pool.workers == list()
+    assert str(future.exception()) == "launch failed"
+    with pytest.raises(queue.Empty):
+        pool.jobs.get_nowait()
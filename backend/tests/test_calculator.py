@@ -0,0 +1,62 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import pytest
+import calculator
+
+@pytest.mark.parametrize("question, answer", [
+    ("what is 2+3*4?", "2+3*4 = 14"),
+    ("0.1+0.2", "0.1+0.2 = 0.3"),
+    ("1/3", "1/3 = 1/3 ≈ 0.3333333333"),
+    ("2^10", "2**10 = 1024"),
+    ("-(3 - 5) * 2", "-(3 - 5) * 2 = 4"),
+    ("7 // 2 + 7 % 2", "7 // 2 + 7 % 2 = 4"),
+    ("sqrt(16)", "sqrt(16) = 4"),
+    ("15% of 200", "15/100*200 = 30"),
+    ("1,000 * 3", "1000 * 3 = 3000"),
+    ("6 × 7", "6 * 7 = 42"),
+])
+def test_arithmetic(question, answer):
+    assert calculator.evaluate(question) == answer
+
+@pytest.mark.parametrize("question, answer", [
+    ("10 km to miles", "10 km = 78125/12573 ≈ 6.213711922 miles"),
+    ("convert 2 kg to lb", "2 kg = 200000000/45359237 ≈ 4.409245244 lb"),
+    ("100 F to C", "100 F = 340/9 ≈ 37.77777778 C"),
+    ("0 celsius in kelvin", "0 celsius = 273.15 kelvin"),
+    ("1 gb to mb", "1 gb = 1024 mb"),
+])
+def test_conversion(question, answer):
+    assert calculator.evaluate(question) == answer
+
+@pytest.mark.parametrize("question", [
+    "hello",
+    "1/0",
+    "0 ** -1",
+    "__import__('os').system('ls')",
+    "(1).__class__",
+    "x + 1",
+    "2 ** 100000",
+    "10 ** 10 ** 10",
+    "5 kg to m",
+    "1" * (calculator.MAX_LENGTH + 1),
+])
+def test_rejected(question):
+    # Anything that isn't a bounded plain expression falls through to the LLM
+    assert calculator.evaluate(question) is None
+
+def test_literals_are_exact():
+    assert calculator.eval_node(calculator.ast.parse("0.1 * 3", mode="eval")) == calculator.Fraction(3, 10)
+
+def test_intermediate_size_is_bounded():
+    with pytest.raises(calculator.CalculatorError):
+        calculator.check_size(calculator.Fraction(2) ** (calculator.MAX_BITS + 1))
+
+def test_local_calculator_stats():
+    local_calculator = calculator.LocalCalculator(timeout=5)
+    assert local_calculator.evaluate("1 + 1") == "1 + 1 = 2"
+    assert local_calculator.evaluate("tell me a joke") is None
+    stats = local_calculator.stats()
+    assert (stats["hits"], stats["misses"], stats["timeouts"]) == (1, 1, 0)
+    assert stats["hit_rate"] == 0.5
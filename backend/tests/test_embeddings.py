@@ -0,0 +1,50 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import pytest
+
+try:
+    import embeddings
+except ImportError as e:
+    # embeddings needs numpy / langchain
+    pytest.skip(f"embeddings is not importable here: {e}", allow_module_level=True)
+
+class CountingEmbeddings(object):
+    # Stands in for the API client: one distinct vector per text, records every call
+    def __init__(self) -> None:
+        self.calls = list()
+
+    def vector(self, text):
+        return [float(len(text)), 1.0, 0.0, 0.0]
+
+    def embed_query(self, text):
+        self.calls += [text]
+        return self.vector(text)
+
+    def embed_documents(self, texts):
+        self.calls += list(texts)
+        return [self.vector(text) for text in texts]
+
+@pytest.fixture
+def cached(tmp_path):
+    store = embeddings.EmbeddingStore(str(tmp_path / "embeddings"), dim=4, grow_rows=8)
+    return embeddings.CachedEmbeddings(CountingEmbeddings(), store, model_name="test")
+
+def test_queries_are_cached_on_disk(cached, tmp_path):
+    assert cached.embed_query("reset the router") == cached.embed_query("reset the router")
+    assert cached.embeddings.calls == ["reset the router"]
+    reopened = embeddings.EmbeddingStore(str(tmp_path / "embeddings"), dim=4, grow_rows=8)
+    assert len(reopened) == 1 and reopened.get(cached.key("reset the router")) is not None
+
+def test_documents_are_not_stored(cached):
+    cached.embed_documents(["first memory entry", "second memory entry"])
+    cached.embed_documents(["first memory entry"])
+    assert len(cached.store) == 0
+    assert cached.embeddings.calls == ["first memory entry", "second memory entry", "first memory entry"]
+
+    # A document that was asked as a query before is still served from the store
+    cached.embed_query("reset the router")
+    assert cached.embed_documents(["reset the router"]) == [cached.embeddings.vector("reset the router")]
+    assert cached.embeddings.calls.count("reset the router") == 1
+    assert cached.stats()["hits"] == 1
@@ -0,0 +1,86 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import time
+import pytest
+
+try:
+    import memory
+except (ImportError, FileNotFoundError) as e:
+    # memory needs numpy / langchain and the backend .env
+    pytest.skip(f"memory is not importable here: {e}", allow_module_level=True)
+
+@pytest.fixture(autouse=True)
+def word_counts(monkeypatch):
+    # One token per word, no tokenizer or API key needed; counts how often a message is (re)counted
+    calls = list()
+    def count(self, message):
+        calls.append((self.count_model, message.content))
+        return len(message.content.split())
+    monkeypatch.setattr(memory.History, "count", count)
+    monkeypatch.setenv("SMART_LLM_MODEL", "model-a")
+    return calls
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "history.sqlite")
+
+def test_archive_and_restore(path):
+    history = memory.History(capacity=2, session_id="client-1", path=path)
+    for turn in range(5):
+        history.add("user", f"question {turn}")
+    assert [message.content for message in history.query(top_k=5)] == ["question 3", "question 4"]
+    assert [message.content for message in history.archived()] == ["question 0", "question 1", "question 2"]
+
+    restored = memory.History(capacity=2, session_id="client-1", path=path)
+    assert restored.recent(top_k=5) == history.recent(top_k=5)
+    assert restored.history_length == 5
+    restored.add("assistant", "answer")
+    assert [message.content for message in restored.archived(limit=1)] == ["question 3"]
+
+def test_anonymous_history_is_not_archived(path):
+    history = memory.History(session_id=None, path=path)
+    history.add("user", "hello")
+    assert history.store is None and history.archived() == list()
+    assert memory.History(session_id="client-1", path=path).recent(top_k=5) == list()
+
+def test_two_writers_of_one_session_do_not_overwrite(path):
+    # Two tabs of one browser share the client session id
+    first = memory.History(session_id="client-1", path=path)
+    second = memory.History(session_id="client-1", path=path)
+    first.add("user", "from the first tab")
+    second.add("user", "from the second tab")
+    first.add("user", "first tab again")
+    restored = memory.History(session_id="client-1", path=path)
+    assert [message.content for message in restored.query(top_k=5)] == ["from the first tab", "from the second tab", "first tab again"]
+
+def test_prune_drops_expired_messages(path):
+    history = memory.History(session_id="client-1", path=path)
+    history.add("user", "old")
+    history.add("user", "new")
+    store = history.store
+    store.db.execute("UPDATE messages SET created_at = ? WHERE content = 'old'", (time.time() - 3600,))
+    store.retention, store.last_pruned = 60, 0.0
+    assert store.prune() == 1
+    # Throttled: a second call within prune_interval does nothing
+    assert store.prune() == 0
+    assert [message.content for message in memory.History(session_id="client-1", path=path).query(top_k=5)] == ["new"]
+
+def test_restore_recounts_rows_counted_with_another_model(path, monkeypatch, word_counts):
+    memory.History(session_id="client-1", path=path).add("user", "three word message")
+    word_counts.clear()
+    assert memory.History(session_id="client-1", path=path).recent(top_k=1)[0][1] == 3
+    assert word_counts == list()
+
+    monkeypatch.setenv("SMART_LLM_MODEL", "model-b")
+    restored = memory.History(session_id="client-1", path=path)
+    assert restored.count_model == "model-b"
+    assert word_counts == [("model-b", "three word message")]
+
+def test_clear_deletes_the_archive(path):
+    history = memory.History(session_id="client-1", path=path)
+    history.add("user", "hello")
+    history.clear()
+    assert len(history) == 0
+    assert memory.History(session_id="client-1", path=path).recent(top_k=5) == list()
@@ -0,0 +1,45 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import os
+import journal
+
+def add(doc_id):
+    return {"op": "add", "ids": [doc_id]}
+
+def test_replay_returns_uncommitted_operations_in_order(tmp_path):
+    log = journal.Journal(str(tmp_path / "db" / "long_term.journal"))
+    log.append(add("a"))
+    log.append({"op": "delete", "ids": ["a"]})
+    log.close()
+    assert journal.Journal(log.path).replay() == [add("a"), {"op": "delete", "ids": ["a"]}]
+
+def test_commit_done_drops_the_rotated_segment_only(tmp_path):
+    log = journal.Journal(str(tmp_path / "long_term.journal"))
+    log.append(add("a"))
+    log.rotate()
+    log.append(add("b"))
+    assert log.replay() == [add("a"), add("b")]
+    log.commit_done()
+    assert not os.path.exists(log.committing_path)
+    assert log.replay() == [add("b")]
+
+def test_rotate_after_failed_commit_keeps_older_operations_first(tmp_path):
+    log = journal.Journal(str(tmp_path / "long_term.journal"))
+    log.append(add("a"))
+    log.rotate()
+    # The commit of "a" failed (no commit_done), "b" arrives, the retry rotates again
+    log.append(add("b"))
+    log.rotate()
+    log.append(add("c"))
+    with open(log.committing_path, "r") as committing_f:
+        assert len(committing_f.readlines()) == 2
+    assert log.replay() == [add("a"), add("b"), add("c")]
+
+def test_replay_stops_at_torn_write(tmp_path):
+    log = journal.Journal(str(tmp_path / "long_term.journal"))
+    log.append(add("a"))
+    log.journal_f.write('{"op": "add", "ids": ["b"')
+    log.close()
+    assert journal.Journal(log.path).replay() == [add("a")]
@@ -0,0 +1,98 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import pytest
+import lexical
+
+KEYS = {
+    "a": "How to reset the router",
+    "b": "Configure VLAN on the switch",
+    "c": "Reset password for the support portal",
+    "d": "Upgrade firmware on a wireless access point",
+}
+
+@pytest.fixture
+def index():
+    index = lexical.BM25Index()
+    index.add(list(KEYS), list(KEYS.values()))
+    return index
+
+def test_tokenize_normalizes_case_and_punctuation():
+    assert lexical.tokenize("Reset, the ROUTER?") == ["reset", "the", "router"]
+
+def test_same_key_is_fully_confident(index):
+    doc_id, _, confidence = index.search("how to reset, the ROUTER?", top_k=1)[0]
+    assert (doc_id, confidence) == ("a", 1.0)
+
+def test_partial_key_is_not_confident(index):
+    results = index.search("reset", top_k=5)
+    assert {doc_id for doc_id, _, _ in results} == {"a", "c"}
+    assert all(confidence < 0.5 for _, _, confidence in results)
+
+def test_extra_query_terms_damp_confidence(index):
+    doc_id, _, confidence = index.search("how to reset the router after a firmware upgrade", top_k=1)[0]
+    assert doc_id == "a"
+    assert 0.0 < confidence < 1.0
+
+def test_unknown_terms_and_empty_index():
+    assert lexical.BM25Index().search("anything") == list()
+    index = lexical.BM25Index()
+    index.add(["a"], ["router"])
+    assert index.search("???") == list()
+    assert index.search("switch") == list()
+
+def test_delete_and_reindex(index):
+    index.delete(["a"])
+    assert "a" not in index and len(index) == 3
+    assert all(doc_id != "a" for doc_id, _, _ in index.search(KEYS["a"]))
+    index.add(["c"], ["Reset the router"])
+    assert index.search("reset the router", top_k=1)[0][0] == "c"
+
+def test_log_replays_to_the_same_index(tmp_path, index):
+    path = str(tmp_path / "keys.jsonl")
+    logged = lexical.BM25Index(path)
+    logged.add(list(KEYS), list(KEYS.values()))
+    logged.delete(["b"])
+    logged.close()
+    with open(path, "a") as log_f:
+        log_f.write('{"op": "add", "id": "torn"')
+    replayed = lexical.BM25Index(path)
+    assert len(replayed) == 3 and "b" not in replayed and "torn" not in replayed
+    assert replayed.search("reset the router") == logged.search("reset the router")
+
+def test_log_is_compacted_once_mostly_dead_lines(tmp_path):
+    path = str(tmp_path / "keys.jsonl")
+    logged = lexical.BM25Index(path)
+    for turn in range(1200):
+        logged.add(["a"], [f"key {turn}"])
+    logged.close()
+    with open(path, "r") as log_f:
+        assert len(log_f.readlines()) <= 1024
+    replayed = lexical.BM25Index(path)
+    assert len(replayed) == 1 and replayed.search("key 1199", top_k=1)[0][2] == 1.0
+
+def test_common_terms_do_not_scan_every_key():
+    index = lexical.BM25Index(common_min=8, max_candidates=16)
+    index.add([str(row) for row in range(1000)], [f"search: topic{row}" for row in range(1000)])
+    # The rare term picks the candidate; "search" (in every key) only re-scores it
+    doc_id, _, confidence = index.search("search: topic777", top_k=1)[0]
+    assert (doc_id, confidence) == ("777", 1.0)
+    # A query made only of common terms scans a bounded sample
+    assert len(index.search("search", top_k=1000)) == 16
+
+def test_cached_lengths_follow_deletes(index):
+    index.delete(["a", "b"])
+    index.add(["b"], ["switch"])
+    assert index.total_length == sum(index.doc_lengths.values()) == sum(sum(terms.values()) for terms in index.doc_terms.values())
+
+def test_fuse_rewards_agreement():
+    assert lexical.fuse([["a", "b", "c"], ["c", "a"]]) == ["a", "c", "b"]
+    assert lexical.fuse([["x"], list()]) == ["x"]
+    assert lexical.fuse(list()) == list()
+
+def test_hybrid_stats():
+    stats = lexical.HybridStats()
+    stats.record(True, 0.001)
+    stats.record(False, 0.003)
+    assert stats.stats() == {"lookups": 2, "embedding_calls_saved": 1, "fused": 1, "lexical_ms_per_lookup": pytest.approx(2.0)}
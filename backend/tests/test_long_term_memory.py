@@ -0,0 +1,114 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import json
+import bulk
+import pytest
+import journal
+
+try:
+    import memory
+    import minhash
+    import vector_store
+except (ImportError, FileNotFoundError) as e:
+    # memory needs numpy / langchain and the backend .env
+    pytest.skip(f"memory is not importable here: {e}", allow_module_level=True)
+
+class FlakyBackend(vector_store.VectorBackend):
+    # In-memory store with the FAISS backend's UNIQUE doc_id behaviour; the add call numbered fail_on raises once
+    def __init__(self, fail_on=None) -> None:
+        self.entries = dict()
+        self.fail_on = fail_on
+        self.adds = 0
+
+    def count(self) -> int:
+        return len(self.entries)
+
+    def add(self, ids, embeddings, documents, keys=None):
+        self.adds += 1
+        if self.adds == self.fail_on:
+            raise IOError("injected failure")
+        for doc_id in ids:
+            if doc_id in self.entries:
+                raise ValueError(f"UNIQUE constraint failed: {doc_id}")
+        self.entries.update(zip(ids, documents))
+
+    def delete(self, ids):
+        for doc_id in ids:
+            self.entries.pop(doc_id, None)
+
+    def existing_ids(self, ids) -> set:
+        return {doc_id for doc_id in ids if doc_id in self.entries}
+
+    def iter_documents(self, batch_size=1000):
+        yield list(self.entries.items())
+
+    def persist(self):
+        pass
+
+def open_memory(tmp_path, backend):
+    long_term_memory = memory.LongTermMemory(write_behind=True, persist_directory=str(tmp_path))
+    long_term_memory.hybrid, long_term_memory.dedup = False, False
+    long_term_memory._index = backend
+    long_term_memory.journal = journal.Journal(str(tmp_path / "long_term.journal"))
+    long_term_memory.load_id_map()
+    return long_term_memory
+
+def add(doc_id):
+    return {"op": "add", "ids": [doc_id], "embeddings": [[0.0, 1.0]], "documents": [f"document {doc_id}"], "keys": [f"key {doc_id}"]}
+
+def test_commit_after_partial_failure_is_idempotent(tmp_path):
+    backend = FlakyBackend(fail_on=2)
+    long_term_memory = open_memory(tmp_path, backend)
+    long_term_memory.write(add("a"))
+    long_term_memory.write(add("b"))
+
+    # "a" lands in the index, then "b" fails: the whole batch stays pending
+    with pytest.raises(IOError):
+        long_term_memory.commit()
+    assert set(backend.entries) == {"a"}
+    assert len(long_term_memory.pending) == 2
+
+    # The retry skips "a" instead of hitting the unique constraint, and the write path is usable again
+    long_term_memory.write(add("c"))
+    assert long_term_memory.commit() == 3
+    assert backend.entries == {doc_id: f"document {doc_id}" for doc_id in "abc"}
+    assert long_term_memory.pending == list()
+    assert long_term_memory.journal.replay() == list()
+
+    long_term_memory.write({"op": "delete", "ids": ["a"]})
+    assert long_term_memory.commit() == 1
+    assert set(backend.entries) == {"b", "c"}
+
+def test_bulk_import_writes_straight_to_the_index(tmp_path):
+    backend = FlakyBackend()
+    long_term_memory = open_memory(tmp_path, backend)
+    source = tmp_path / "source.jsonl"
+    with open(source, "w") as source_f:
+        for index in range(10):
+            source_f.write(json.dumps({"key": f"key {index}", "value": f"value {index}", "embedding": [float(index), 1.0]}) + "\n")
+
+    stats = bulk.bulk_import(long_term_memory, str(source), batch_size=3, chunk_size=4, workers=2)
+    assert stats["imported"] == 10 and len(backend.entries) == 10
+    # Nothing went through the journal or the write-behind queue
+    assert long_term_memory.pending == list()
+    assert long_term_memory.journal.replay() == list()
+
+    # Content-addressed: a re-run finds every entry already stored
+    stats = bulk.bulk_import(long_term_memory, str(source), batch_size=3, chunk_size=4)
+    assert (stats["imported"], stats["skipped"]) == (0, 10)
+
+def test_stale_fingerprints_are_rebuilt_from_the_documents(tmp_path):
+    backend = FlakyBackend()
+    backend.entries = {"a": "the router reboots every night because the firmware watchdog times out", "b": "   "}
+    long_term_memory = open_memory(tmp_path, backend)
+    # A fingerprint log from before the current hashing scheme
+    with open(tmp_path / "long_term.minhash.jsonl", "w") as log_f:
+        log_f.write(json.dumps({"op": "add", "id": "a", "signature": [1] * 128}) + "\n")
+    long_term_memory.fingerprints = minhash.MinHashIndex(str(tmp_path / "long_term.minhash.jsonl"))
+    assert long_term_memory.fingerprints.stale
+    long_term_memory.refingerprint()
+    fingerprints = minhash.MinHashIndex(str(tmp_path / "long_term.minhash.jsonl"))
+    assert not fingerprints.stale and "b" not in fingerprints
+    assert [doc_id for doc_id, _ in fingerprints.query(fingerprints.signature(backend.entries["a"]))] == ["a"]
@@ -0,0 +1,83 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import json
+import time
+import pytest
+
+np = pytest.importorskip("numpy")
+minhash = pytest.importorskip("minhash")
+
+TEXT = "the router reboots every night at two because the firmware watchdog times out while the backup job holds the flash lock"
+
+@pytest.mark.parametrize("threshold, num_perm", [(0.5, 128), (0.8, 128), (0.9, 64), (0.3, 100)])
+def test_lsh_params_cover_num_perm_with_midpoint_below_threshold(threshold, num_perm):
+    bands, rows = minhash.MinHashIndex.lsh_params(threshold, num_perm)
+    assert bands * rows == num_perm
+    midpoint = (1 / bands) ** (1 / rows)
+    assert midpoint <= threshold
+    # No other split puts the midpoint closer below the threshold
+    for other_rows in range(1, num_perm + 1):
+        if num_perm % other_rows == 0:
+            other = (1 / (num_perm // other_rows)) ** (1 / other_rows)
+            assert not midpoint < other <= threshold
+
+def test_signature_is_deterministic_and_normalized():
+    index = minhash.MinHashIndex(num_perm=64)
+    signature = index.signature(TEXT)
+    assert signature.shape == (64,) and signature.dtype == np.uint64
+    assert np.array_equal(signature, minhash.MinHashIndex(num_perm=64).signature(TEXT.upper() + "!"))
+    assert index.signature("  ...  ") is None
+
+def test_query_finds_near_duplicates_only():
+    index = minhash.MinHashIndex(threshold=0.5)
+    index.add(["same", "other"], [index.signature(TEXT), index.signature("configure a vlan trunk between the core switch and the access layer")])
+    near = TEXT.replace("two", "three")
+    matches = index.query(index.signature(near))
+    assert [doc_id for doc_id, _ in matches] == ["same"]
+    assert 0.5 <= matches[0][1] < 1.0
+    assert index.query(index.signature("completely unrelated words about cooking pasta tonight")) == list()
+    assert index.query(None) == list()
+
+def test_delete_reset_and_log_replay(tmp_path):
+    path = str(tmp_path / "minhash.jsonl")
+    index = minhash.MinHashIndex(path, threshold=0.5)
+    signature = index.signature(TEXT)
+    index.add(["a", "b"], [signature, None])
+    assert "a" in index and "b" not in index
+    index.delete(["a", "missing"])
+    assert index.query(signature) == list()
+    index.add(["c"], [signature])
+
+    replayed = minhash.MinHashIndex(path, threshold=0.5)
+    assert [doc_id for doc_id, _ in replayed.query(signature)] == ["c"]
+
+    replayed.reset({"d": signature})
+    with open(path, "r") as log_f:
+        # Scheme header plus one add
+        assert len(log_f.readlines()) == 2
+    assert [doc_id for doc_id, _ in minhash.MinHashIndex(path, threshold=0.5).query(signature)] == ["d"]
+
+def test_log_of_another_scheme_is_dropped_as_stale(tmp_path):
+    path = str(tmp_path / "minhash.jsonl")
+    with open(path, "w") as log_f:
+        log_f.write(json.dumps({"op": "add", "id": "a", "signature": [1] * 128}) + "\n")
+    index = minhash.MinHashIndex(path)
+    assert index.stale and "a" not in index
+    index.add(["b"], [index.signature(TEXT)])
+    assert not minhash.MinHashIndex(path).stale and "b" in minhash.MinHashIndex(path)
+
+def test_admission_is_sub_millisecond_at_document_size():
+    # A realistic memory entry: 300 words from a large vocabulary, checked against 1000 stored documents
+    rng = np.random.default_rng(0)
+    vocabulary = [f"word{index}" for index in range(20000)]
+    documents = [" ".join(rng.choice(vocabulary, 300)) for _ in range(1000)]
+    index = minhash.MinHashIndex()
+    index.add([str(number) for number in range(len(documents))], [index.signature(document) for document in documents])
+    timings = list()
+    for document in documents[:200]:
+        start = time.perf_counter()
+        index.query(index.signature(document))
+        timings += [time.perf_counter() - start]
+    assert sorted(timings)[len(timings) // 2] < 1e-3
@@ -0,0 +1,75 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import os
+import time
+import cache
+import pytest
+
+try:
+    import task
+except (ImportError, FileNotFoundError) as e:
+    # task needs langchain / requests and the backend .env
+    pytest.skip(f"task is not importable here: {e}", allow_module_level=True)
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "search.json")
+
+def slow_search(query, top_k=5, timeout=None):
+    time.sleep(2)
+    return [{"title": "late", "content": "late", "url": "https://example.com/late"}]
+
+def mirror_search(query, top_k=5, timeout=None):
+    # Same pages as the local fixture, one with a trailing slash difference
+    return [
+        {"title": "Reset (mirror)", "content": "mirror", "url": "https://example.com/router/reset"},
+        {"title": "Mirror only", "content": "mirror", "url": "https://example.com/mirror"},
+    ]
+
+def broken_search(query, top_k=5, timeout=None):
+    raise IOError("provider down")
+
+@pytest.fixture
+def search(monkeypatch):
+    # No network and no API key: the local provider reads the JSON fixture, the others are registered here
+    monkeypatch.setattr(task.clients, "get_chat_model", lambda *args, **kwargs: None)
+    monkeypatch.setattr(task, "search_cache", cache.LRUCache(capacity=16))
+    monkeypatch.setenv("SEARCH_FIXTURE_PATH", FIXTURE)
+    monkeypatch.setenv("SEARCH_PROVIDER_TIMEOUT", "0.5")
+    for name, provider in [("slow", slow_search), ("mirror", mirror_search), ("broken", broken_search)]:
+        monkeypatch.setitem(task.SearchTask.providers, name, provider)
+
+    def search(query, providers):
+        monkeypatch.setenv("SEARCH_PROVIDERS", providers)
+        return task.SearchTask("search", {"query": query})
+    return search
+
+def test_local_provider_ranks_fixture_entries(search):
+    results = search("reset router", "local").execute()
+    assert [item["url"] for item in results] == ["https://example.com/router/reset/", "https://example.com/router/firmware"]
+
+def test_local_provider_needs_its_fixture(monkeypatch):
+    monkeypatch.delenv("SEARCH_FIXTURE_PATH", raising=False)
+    with pytest.raises(ValueError):
+        task.SearchTask.local_search("router")
+
+def test_fan_out_merges_in_provider_order_and_dedupes_urls(search):
+    results = search("reset router", "local, mirror, broken").execute()
+    assert [item["url"] for item in results] == [
+        "https://example.com/router/reset/",
+        "https://example.com/router/firmware",
+        "https://example.com/mirror",
+    ]
+
+def test_slow_provider_is_dropped_at_the_shared_deadline(search):
+    start = time.perf_counter()
+    results = search("switch vlan", "slow, local, mirror").execute()
+    # One deadline for all providers, not one per provider
+    assert time.perf_counter() - start < 1.5
+    assert "https://example.com/late" not in [item["url"] for item in results]
+    assert [item["url"] for item in results][0] == "https://example.com/switch/vlan"
+
+def test_results_are_cached_per_normalized_query(search, monkeypatch):
+    first = search("Reset   Router", "local").execute()
+    monkeypatch.setitem(task.SearchTask.providers, "local", broken_search)
+    assert search("reset router", "local").execute() == first
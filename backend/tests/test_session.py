@@ -0,0 +1,60 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import time
+import pytest
+import threading
+
+try:
+    import session
+except (ImportError, FileNotFoundError) as e:
+    # session -> agent -> memory needs numpy / langchain and the backend .env
+    pytest.skip(f"session is not importable here: {e}", allow_module_level=True)
+
+class FakeAgent(object):
+    def __init__(self, name, personalities, long_term_memory=None, session_id=None) -> None:
+        self.session_id = session_id
+        self.cancel_event = threading.Event()
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(session.agent, "Agent", FakeAgent)
+    return session.SessionManager("bot", [], max_sessions=2, ttl=1800, long_term_memory=object())
+
+def test_live_sessions_are_not_evicted_at_capacity(manager):
+    a, b = manager.get("a"), manager.get("b")
+    assert manager.get("a") is a
+    assert manager.get("b") is b
+    assert not a.cancel_event.is_set() and not b.cancel_event.is_set()
+    assert len(manager) == 2
+
+def test_new_session_evicts_least_recently_used(manager):
+    a, b = manager.get("a"), manager.get("b")
+    manager.get("a")
+    manager.get("c")
+    assert b.cancel_event.is_set()
+    assert not a.cancel_event.is_set()
+    assert "b" not in manager.sessions and "a" in manager.sessions
+
+def test_sweep_expires_idle_sessions_without_traffic(manager):
+    a, b = manager.get("a"), manager.get("b")
+    manager.last_seen["a"] = time.time() - 3600
+    manager.sweep()
+    assert a.cancel_event.is_set()
+    assert list(manager.sessions) == ["b"]
+
+def test_close_cancels_and_forgets_the_client_id(manager):
+    manager.bind("a", "client-1")
+    a = manager.get("a")
+    assert a.session_id == "client-1"
+    manager.close("a")
+    assert a.cancel_event.is_set()
+    assert "a" not in manager.client_ids and len(manager) == 0
+
+def test_bind_rejects_invalid_ids(manager):
+    manager.bind("a", "")
+    manager.bind("b", "x" * 200)
+    manager.bind("c", 42)
+    assert manager.client_ids == dict()
+    assert manager.get("a").session_id is None
@@ -0,0 +1,38 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import uuid
+import pytest
+from datetime import datetime
+
+try:
+    import numpy as np
+    import memory
+except (ImportError, FileNotFoundError) as e:
+    # memory needs numpy / langchain and the backend .env
+    pytest.skip(f"memory is not importable here: {e}", allow_module_level=True)
+
+def add(short_term_memory, vector, key="key"):
+    doc = memory.Document(page_content=key, metadata={"last_accessed_at": datetime.now(), "uuid": str(uuid.uuid4()), "key": key, "summaries": dict()})
+    short_term_memory.add_vector(doc, vector)
+
+def test_pq_codec_trains_within_capacity(monkeypatch):
+    monkeypatch.setenv("SHORT_TERM_PQ_SUBSPACES", "8")
+    capacity = 300
+    short_term_memory = memory.ShortTermMemory(capacity=capacity, embedding_size=32, embeddings_model=object(), quantization_kind="pq")
+    vectors = np.random.default_rng(0).normal(size=(capacity, 32)).astype(np.float32)
+    for vector in vectors[:-1]:
+        add(short_term_memory, vector)
+    assert not short_term_memory.codec.trained
+    add(short_term_memory, vectors[-1])
+    assert short_term_memory.codec.trained
+
+    # Codes rank the candidates, the exact vectors re-rank them: a stored vector is its own nearest neighbour
+    hits = short_term_memory.search(vectors[7], top_k=1)
+    assert hits[0].metadata["uuid"] == short_term_memory.docs[7].metadata["uuid"]
+
+def test_pq_rejects_capacity_below_codebook_size(monkeypatch):
+    monkeypatch.setenv("SHORT_TERM_PQ_SUBSPACES", "8")
+    with pytest.raises(ValueError):
+        memory.ShortTermMemory(capacity=100, embedding_size=32, embeddings_model=object(), quantization_kind="pq")
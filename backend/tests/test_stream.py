@@ -0,0 +1,56 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import json
+import pytest
+
+stream = pytest.importorskip("stream", exc_type=ImportError)
+
+def feed_all(parser, text, step):
+    response, commands = "", list()
+    for start in range(0, len(text), step):
+        delta, completed = parser.feed(text[start:start + step])
+        response += delta
+        commands += completed
+    return response, commands
+
+@pytest.mark.parametrize("raw, expected", [
+    ('hello"', ("hello", True)),
+    ('hello', ("hello", False)),
+    ('a\\"b" tail', ('a"b', True)),
+    ('line\\nbreak', ("line\nbreak", False)),
+    ('cut \\', ("cut ", False)),
+    ('\\u00e9t\\u00e9"', ("été", True)),
+    ('\\u00e', ("", False)),
+])
+def test_decode_partial_string(raw, expected):
+    assert stream.decode_partial_string(raw) == expected
+
+@pytest.mark.parametrize("step", [1, 3, 7, 1000])
+def test_response_streams_at_any_chunking(step):
+    text = json.dumps({"command_name": "response", "command_args": {"response": "Hi \"there\"\nété {not a brace}"}})
+    response, commands = feed_all(stream.PlannerStreamParser(), text, step)
+    assert response == "Hi \"there\"\nété {not a brace}"
+    assert commands == [("response", {"response": "Hi \"there\"\nété {not a brace}"})]
+
+@pytest.mark.parametrize("step", [1, 5, 1000])
+def test_batched_commands_reported_once_in_order(step):
+    text = json.dumps({"commands": [
+        {"command_name": "search", "command_args": {"query": "a } b"}},
+        {"command_name": "math", "command_args": {"question": "1 + 1"}},
+        {"command_name": "search", "command_args": {"query": "a } b"}},
+    ]})
+    _, commands = feed_all(stream.PlannerStreamParser(), text, step)
+    assert commands == [("search", {"query": "a } b"}), ("math", {"question": "1 + 1"})]
+
+def test_command_reported_when_its_object_closes():
+    parser = stream.PlannerStreamParser()
+    _, completed = parser.feed('{"commands": [{"command_name": "search", "command_args": {"query": "x"}')
+    assert completed == list()
+    _, completed = parser.feed('}, {"command_name": "math"')
+    assert completed == [("search", {"query": "x"})]
+
+def test_non_command_objects_ignored():
+    _, commands = feed_all(stream.PlannerStreamParser(), '{"thoughts": {"text": "plan"}, "other": [1, {"a": 2}]}', 4)
+    assert commands == list()
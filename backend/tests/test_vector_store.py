@@ -0,0 +1,40 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+
+import vector_store
+
+DIM = 16
+
+def make_backend(directory, index_type):
+    # Small enough that IVF trains (nlist * 39 rows) within the first batch
+    return vector_store.FaissBackend(str(directory), dim=DIM, index_type=index_type, nlist=4, nprobe=4, hnsw_m=8, grow_rows=256)
+
+def batch(start, count):
+    embeddings = np.random.default_rng(start).standard_normal((count, DIM)).astype(np.float32)
+    ids = [f"doc-{index}" for index in range(start, start + count)]
+    return ids, embeddings, [f"document {index}" for index in range(start, start + count)]
+
+@pytest.mark.parametrize("index_type", ["hnsw", "ivf"])
+def test_persist_reopen_then_add(tmp_path, index_type):
+    backend = make_backend(tmp_path, index_type)
+    ids, embeddings, documents = batch(0, 200)
+    backend.add(ids, embeddings, documents)
+    assert backend.index.is_trained
+    backend.persist()
+
+    # A restarted process must still accept writes (group commits would otherwise fail forever)
+    reopened = make_backend(tmp_path, index_type)
+    assert reopened.count() == 200
+    ids, embeddings, documents = batch(200, 20)
+    reopened.add(ids, embeddings, documents)
+    reopened.persist()
+    assert reopened.count() == 220
+    assert reopened.search(embeddings[:1], 1)[0][0][0] == "doc-200"
+
+    assert make_backend(tmp_path, index_type).count() == 220
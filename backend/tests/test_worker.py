@@ -0,0 +1,121 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import time
+import pytest
+import worker
+import threading
+
+@pytest.fixture
+def jobs():
+    jobs = worker.JobQueue(max_workers=4, max_pending=16)
+    yield jobs
+    jobs.shutdown(timeout=5)
+
+def test_jobs_of_one_session_run_in_order_one_at_a_time(jobs):
+    order, active, overlap = list(), set(), list()
+    def job(turn):
+        overlap.append(bool(active))
+        active.add(turn)
+        time.sleep(0.01)
+        order.append(turn)
+        active.discard(turn)
+    for turn in range(5):
+        assert jobs.submit("a", job, turn)
+    assert jobs.shutdown(timeout=5)
+    assert order == list(range(5))
+    assert not any(overlap)
+
+def test_sessions_run_concurrently(jobs):
+    # Both jobs must be inside the barrier at once, or it times out
+    barrier = threading.Barrier(2, timeout=5)
+    results = list()
+    def job(sid):
+        barrier.wait()
+        results.append(sid)
+    assert jobs.submit("a", job, "a") and jobs.submit("b", job, "b")
+    assert jobs.shutdown(timeout=5)
+    assert sorted(results) == ["a", "b"]
+
+def test_full_queue_rejects():
+    jobs = worker.JobQueue(max_workers=1, max_pending=2)
+    release = threading.Event()
+    assert jobs.submit("a", release.wait)
+    assert jobs.submit("a", release.wait)
+    assert not jobs.submit("b", release.wait)
+    release.set()
+    assert jobs.shutdown(timeout=5)
+
+def test_cancel_drops_queued_jobs_and_cancel_event_stops_the_running_one(jobs):
+    cancel_event, started, ran = threading.Event(), threading.Event(), list()
+    def turn(name):
+        # An agent turn: checks its cancel_event between steps
+        started.set()
+        for _ in range(500):
+            if cancel_event.is_set():
+                ran.append(f"{name} cancelled")
+                return
+            time.sleep(0.01)
+        ran.append(f"{name} finished")
+    jobs.submit("a", turn, "first")
+    jobs.submit("a", turn, "second")
+    assert started.wait(5)
+    assert jobs.cancel("a") == 1
+    cancel_event.set()
+    assert jobs.shutdown(timeout=5)
+    assert ran == ["first cancelled"]
+    assert jobs.stats() == {"pending": 0, "running": 0}
+
+def test_shutdown_drains_queued_jobs_and_closes(jobs):
+    done = list()
+    for turn in range(3):
+        jobs.submit("a", lambda turn: (time.sleep(0.02), done.append(turn)), turn)
+    assert jobs.shutdown(timeout=5)
+    assert done == [0, 1, 2]
+    assert not jobs.submit("a", done.append, 3)
+
+def test_shutdown_timeout():
+    jobs = worker.JobQueue(max_workers=1)
+    release = threading.Event()
+    jobs.submit("a", release.wait)
+    assert not jobs.shutdown(timeout=0.05)
+    release.set()
+
+def test_failing_job_does_not_block_the_session(jobs):
+    done = list()
+    def fail():
+        raise ValueError("boom")
+    jobs.submit("a", fail)
+    jobs.submit("a", done.append, "next")
+    assert jobs.shutdown(timeout=5)
+    assert done == ["next"]
+
+class FakeSocket(object):
+    # Background task on a real thread, like eventlet's green one
+    def __init__(self) -> None:
+        self.emitted = list()
+
+    def start_background_task(self, target):
+        threading.Thread(target=target, daemon=True).start()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def emit(self, event, data, room=None):
+        self.emitted.append((event, data, room))
+
+def test_emitter_forwards_in_order_from_worker_threads():
+    sio = FakeSocket()
+    emitter = worker.Emitter(sio, interval=0.01)
+    emitter.emit("message", {"content": "before start"}, room="a")
+    emitter.start()
+    emitter.start()
+    threads = [threading.Thread(target=emitter.emit, args=("message", {"content": index}, "b")) for index in range(3)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    deadline = time.time() + 5
+    while len(sio.emitted) < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    assert sio.emitted == [("message", {"content": "before start"}, "a")] + [("message", {"content": index}, "b") for index in range(3)]
@@ -6,7 +6,10 @@ import os
 import time
 import json
 import task
+import cache
+import threading
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from langchain.text_splitter import TokenTextSplitter
 
 def get_envs(path=".env") -> dict:
@@ -35,21 +38,108 @@ def response_parse(response_raw):
         return response_raw
     return response_json
 
-def recursive_summary(llm, raw_text, question, text_length=800, chunk_size=800):
-    while llm.get_num_tokens(raw_text) > text_length:
-        text_splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
-        texts = text_splitter.split_text(raw_text)
-    
-        summarization_list = list()
-        for text in tqdm(texts, desc="Recursive Summary"):
-            summarization = task.SummaryTask("summary", {
-                "text": text,
-                "question": question,
-                "fast_model": True
-            }).execute()
-            summarization_list += [summarization]
-        raw_text = " ".join(summarization_list)
-    return raw_text
+def get_summary_cache():
+    global summary_cache
+    if summary_cache is None:
+        summary_cache = cache.LRUCache(
+            capacity=int(os.environ.get("SUMMARY_CACHE_SIZE", 4096)),
+            path=os.environ.get("SUMMARY_CACHE_PATH"),
+        )
+    return summary_cache
+
+def summary_cache_stats() -> dict:
+    return get_summary_cache().stats()
+
+def summarize_chunk(text, question, chunk_size, model_name, summaries=None, retries=0):
+    # Chunk hit: overlapping documents share chunks (e.g. the same page browsed for another question)
+    chunk_key = cache.hash_key("chunk", text, question, chunk_size, model_name)
+    summarization = summaries.get(chunk_key) if summaries is not None else None
+    if summarization is not None:
+        return summarization
+
+    for attempt in range(retries + 1):
+        try:
+            # Process-wide bound on summary LLM calls, whatever pool (or thread) the chunk runs on
+            with summary_slots:
+                summarization = task.SummaryTask("summary", {
+                    "text": text,
+                    "question": question,
+                    "fast_model": True
+                }).execute()
+            break
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f"Summary Error (attempt {attempt + 1}/{retries + 1}): {e}")
+            time.sleep(2 ** attempt)
+
+    if summaries is not None:
+        summaries.set(chunk_key, summarization)
+    return summarization
+
+def group_adjacent(llm, texts, chunk_size):
+    # Pack neighbouring summaries into groups that fit into one chunk
+    groups, group, group_length = list(), list(), 0
+    for text in texts:
+        text_length = token_counter.count_text(llm, text)
+        if group and group_length + text_length > chunk_size:
+            groups += [" ".join(group)]
+            group, group_length = list(), 0
+        group += [text]
+        group_length += text_length
+    if group:
+        groups += [" ".join(group)]
+    return groups
+
+def recursive_summary(llm, raw_text, question, text_length=800, chunk_size=800, use_cache=True, parallel=False, retries=2):
+    summaries = get_summary_cache() if use_cache else None
+    model_name = getattr(llm, "model_name", "unknown")
+
+    # Whole-text hit: the same document was already summarized for this question
+    text_key = cache.hash_key("text", raw_text, question, text_length, chunk_size, model_name)
+    if summaries is not None:
+        cached = summaries.get(text_key)
+        if cached is not None:
+            return cached
+
+    if parallel:
+        summary_text = parallel_summary(llm, raw_text, question, text_length, chunk_size, summaries, retries)
+    else:
+        summary_text = raw_text
+        while token_counter.count_text(llm, summary_text) > text_length:
+            text_splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
+            texts = text_splitter.split_text(summary_text)
+        
+            summarization_list = list()
+            for text in tqdm(texts, desc="Recursive Summary"):
+                summarization_list += [summarize_chunk(text, question, chunk_size, model_name, summaries, retries)]
+            summary_text = " ".join(summarization_list)
+
+    if summaries is not None:
+        summaries.set(text_key, summary_text)
+    return summary_text
+
+def parallel_summary(llm, raw_text, question, text_length, chunk_size, summaries=None, retries=2):
+    model_name = getattr(llm, "model_name", "unknown")
+    if token_counter.count_text(llm, raw_text) <= text_length:
+        return raw_text
+
+    # Map: split once, summarize every chunk concurrently (map keeps the chunk order)
+    text_splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
+    texts = text_splitter.split_text(raw_text)
+
+    # Chunks only ever run on the shared summary_executor: chunk jobs never wait on other jobs, so callers can't deadlock it
+    def summarize_round(texts):
+        return list(tqdm(summary_executor.map(lambda text: summarize_chunk(text, question, chunk_size, model_name, summaries, retries), texts), total=len(texts), desc="Parallel Summary"))
+
+    summarization_list = summarize_round(texts)
+
+    # Reduce: merge adjacent summaries in a tree until the result fits (summed from memoized per-summary counts)
+    while sum(token_counter.count_text(llm, text) for text in summarization_list) > text_length:
+        groups = group_adjacent(llm, summarization_list, chunk_size)
+        summarization_list = summarize_round(groups)
+
+    return " ".join(summarization_list)
 
 def get_history_str(msg_list):
     history = list()
@@ -75,3 +165,13 @@ def send_message(message, style="system", socket_config=None):
 
 # Load Environment Variables in advance
 load_envs(get_envs())
+
+# Summary cache shared by all tasks (created lazily, see get_summary_cache)
+summary_cache = None
+
+# Chunk summaries of every parallel recursive_summary, and the bound on summary LLM calls in flight
+summary_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("SUMMARY_WORKERS", 8)), thread_name_prefix="summary")
+summary_slots = threading.BoundedSemaphore(int(os.environ.get("SUMMARY_MAX_CONCURRENCY", 8)))
+
+# Token counts shared by PLANTask, recursive_summary and KuiBu
+token_counter = cache.TokenCounter()
@@ -0,0 +1,421 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import os
+import sqlite3
+import threading
+import numpy as np
+
+class VectorBackend(object):
+    # Storage behind LongTermMemory.add / query / delete. Distances are squared L2 (Chroma's default space).
+    def count(self) -> int:
+        raise NotImplementedError("Don't call the interface.")
+
+    def add(self, ids, embeddings, documents, keys=None):
+        # keys: the texts that were embedded, kept for export
+        raise NotImplementedError("Don't call the interface.")
+
+    def delete(self, ids):
+        raise NotImplementedError("Don't call the interface.")
+
+    def existing_ids(self, ids) -> set:
+        raise NotImplementedError("Don't call the interface.")
+
+    def documents(self, ids) -> dict:
+        # doc_id -> document for the ids that exist
+        raise NotImplementedError("Don't call the interface.")
+
+    def iter_documents(self, batch_size=1000):
+        # Every live (doc_id, document), a batch (list) at a time
+        raise NotImplementedError("Don't call the interface.")
+
+    def iter_embeddings(self, batch_size=1000):
+        # Every live (doc_id, document, embedding), a batch (list) at a time
+        raise NotImplementedError("Don't call the interface.")
+
+    def iter_entries(self, batch_size=1000, embeddings=False):
+        # Every live entry as {"id", "key", "value"[, "embedding"]}, a batch (list) at a time; key is None for entries stored without one
+        raise NotImplementedError("Don't call the interface.")
+
+    def search(self, query_embeddings, k) -> list:
+        # One list of (doc_id, document, distance) per query, nearest first
+        raise NotImplementedError("Don't call the interface.")
+
+    def persist(self):
+        raise NotImplementedError("Don't call the interface.")
+
+class ChromaBackend(VectorBackend):
+    def __init__(self, persist_directory="db", embedding_function=None, collection_name="langchain") -> None:
+        from langchain.vectorstores import Chroma
+
+        self.index = Chroma(collection_name=collection_name, embedding_function=embedding_function, persist_directory=persist_directory)
+        self.collection = self.index._collection
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def add(self, ids, embeddings, documents, keys=None):
+        metadatas = [{"key": key} for key in keys] if keys else None
+        self.collection.add(embeddings=[list(map(float, embedding)) for embedding in embeddings], documents=list(documents), metadatas=metadatas, ids=list(ids))
+
+    def delete(self, ids):
+        self.collection.delete(ids=list(ids))
+
+    def existing_ids(self, ids) -> set:
+        return set(self.collection.get(ids=list(ids))["ids"])
+
+    def documents(self, ids) -> dict:
+        result = self.collection.get(ids=list(ids), include=["documents"])
+        return dict(zip(result["ids"], result["documents"]))
+
+    def iter_documents(self, batch_size=1000):
+        offset = 0
+        while True:
+            result = self.collection.get(limit=batch_size, offset=offset, include=["documents"])
+            if not result["ids"]:
+                return
+            yield list(zip(result["ids"], result["documents"]))
+            offset += len(result["ids"])
+
+    def iter_embeddings(self, batch_size=1000):
+        offset = 0
+        while True:
+            result = self.collection.get(limit=batch_size, offset=offset, include=["documents", "embeddings"])
+            if not result["ids"]:
+                return
+            yield list(zip(result["ids"], result["documents"], result["embeddings"]))
+            offset += len(result["ids"])
+
+    def iter_entries(self, batch_size=1000, embeddings=False):
+        offset = 0
+        while True:
+            result = self.collection.get(limit=batch_size, offset=offset, include=["documents", "metadatas"] + (["embeddings"] if embeddings else []))
+            if not result["ids"]:
+                return
+            entries = [{"id": doc_id, "key": (metadata or dict()).get("key"), "value": document} for doc_id, document, metadata in zip(result["ids"], result["documents"], result["metadatas"])]
+            if embeddings:
+                for entry, embedding in zip(entries, result["embeddings"]):
+                    entry["embedding"] = list(map(float, embedding))
+            yield entries
+            offset += len(result["ids"])
+
+    def search(self, query_embeddings, k) -> list:
+        k = min(k, self.count())
+        if not k:
+            return [list() for _ in query_embeddings]
+        result = self.collection.query(query_embeddings=[list(map(float, embedding)) for embedding in query_embeddings], n_results=k, include=["documents", "distances"])
+        return [list(zip(ids, documents, distances)) for ids, documents, distances in zip(result["ids"], result["documents"], result["distances"])]
+
+    def persist(self):
+        self.index.persist()
+
+class FaissBackend(VectorBackend):
+    # FAISS IVF / HNSW index over vectors kept memory-mapped on disk, documents in SQLite, deletes as tombstones
+    def __init__(self, directory, dim=1536, index_type="hnsw", nlist=1024, nprobe=16, hnsw_m=32, ef_construction=80, ef_search=64, quantization="none", pq_subspaces=64, rerank_factor=4, grow_rows=65536, compact_ratio=0.2, compact_min=1024) -> None:
+        import faiss
+
+        self.faiss = faiss
+        self.directory = directory
+        self.dim = dim
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        # "float16" / "pq" store compact codes in the index; candidates are re-ranked against the exact vector file
+        self.quantization = quantization
+        self.pq_subspaces = pq_subspaces
+        self.rerank_factor = rerank_factor
+        self.index_name = index_type if quantization == "none" else f"{index_type}-{quantization}"
+        self.grow_rows = grow_rows
+        # persist() compacts the rows and rebuilds the index once this share of them (and at least compact_min) are tombstones
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.max_variables = 900
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Documents and row <-> id mapping (row = position in the vector file = FAISS id)
+        self.db = sqlite3.connect(os.path.join(directory, "documents.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS documents (row INTEGER PRIMARY KEY, doc_id TEXT UNIQUE, document TEXT, deleted INTEGER DEFAULT 0, key TEXT)")
+        if "key" not in [column[1] for column in self.db.execute("PRAGMA table_info(documents)")]:
+            self.db.execute("ALTER TABLE documents ADD COLUMN key TEXT")
+        self.rows = self.db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        self.tombstones = np.zeros(self.rows, dtype=bool)
+        for (row,) in self.db.execute("SELECT row FROM documents WHERE deleted = 1"):
+            self.tombstones[row] = True
+
+        self.vectors = None
+        self.capacity = 0
+        # An interrupted compaction is finished (renumbering committed) or rolled back (not committed) before mapping
+        self.db.execute("CREATE TABLE IF NOT EXISTS compaction (pending INTEGER)")
+        if self.db.execute("SELECT COUNT(*) FROM compaction").fetchone()[0]:
+            self.finish_compaction()
+        elif os.path.exists(os.path.join(directory, "vectors.f32.compact")):
+            # Crashed before the renumbering committed: the old rows are still the valid ones
+            os.remove(os.path.join(directory, "vectors.f32.compact"))
+        self.map_vectors(max(self.rows, 1))
+        self.index = self.load_index()
+
+    def map_vectors(self, rows) -> None:
+        path = os.path.join(self.directory, "vectors.f32")
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        with open(path, "ab") as vector_f:
+            vector_f.truncate(max(os.path.getsize(path), rows * self.dim * 4))
+        self.capacity = os.path.getsize(path) // (self.dim * 4)
+        self.vectors = np.memmap(path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim))
+
+    def new_index(self):
+        fp16 = self.faiss.ScalarQuantizer.QT_fp16
+        if self.index_type == "ivf":
+            # The coarse quantizer must outlive the Python wrapper of the IVF index
+            self.coarse_quantizer = self.faiss.IndexFlatL2(self.dim)
+            if self.quantization == "float16":
+                return self.faiss.IndexIVFScalarQuantizer(self.coarse_quantizer, self.dim, self.nlist, fp16)
+            if self.quantization == "pq":
+                return self.faiss.IndexIVFPQ(self.coarse_quantizer, self.dim, self.nlist, self.pq_subspaces, 8)
+            return self.faiss.IndexIVFFlat(self.coarse_quantizer, self.dim, self.nlist)
+        if self.quantization == "float16":
+            index = self.faiss.IndexHNSWSQ(self.dim, fp16, self.hnsw_m)
+        elif self.quantization == "pq":
+            index = self.faiss.IndexHNSWPQ(self.dim, self.pq_subspaces, self.hnsw_m)
+        else:
+            index = self.faiss.IndexHNSWFlat(self.dim, self.hnsw_m)
+        index.hnsw.efConstruction = self.ef_construction
+        return index
+
+    def load_index(self):
+        path = os.path.join(self.directory, f"{self.index_name}.index")
+        if os.path.exists(path):
+            # Loaded writable (no IO_FLAG_MMAP): a mapped IVF index gets read-only on-disk inverted lists and rejects every later add
+            index = self.faiss.read_index(path)
+            # Rows written after the last persist are re-indexed from the vector file
+            if index.ntotal < self.rows and (index.is_trained or self.train(index)):
+                index.add(np.ascontiguousarray(self.vectors[index.ntotal:self.rows]))
+            return index
+        index = self.new_index()
+        if self.rows and self.train(index):
+            index.add(np.ascontiguousarray(self.vectors[:self.rows]))
+        return index
+
+    def train(self, index) -> bool:
+        # IVF / PQ need enough vectors to train their codebooks; until then search falls back to exact scan
+        if index.is_trained:
+            return True
+        train_rows = max(self.nlist * 39 if self.index_type == "ivf" else 0, 256 * 4 if self.quantization == "pq" else 0)
+        if self.rows < train_rows:
+            return False
+        sample = np.random.default_rng(0).choice(self.rows, size=min(self.rows, max(self.nlist * 256, 65536)), replace=False)
+        index.train(np.ascontiguousarray(self.vectors[np.sort(sample)]))
+        return True
+
+    def count(self) -> int:
+        return int(self.rows - self.tombstones.sum())
+
+    def add(self, ids, embeddings, documents, keys=None):
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        keys = keys if keys else [None] * len(embeddings)
+        with self.lock:
+            start = self.rows
+            if start + len(embeddings) > self.capacity:
+                self.map_vectors(max(start + len(embeddings), self.capacity + self.grow_rows))
+            self.vectors[start:start + len(embeddings)] = embeddings
+            self.db.executemany("INSERT INTO documents (row, doc_id, document, key) VALUES (?, ?, ?, ?)", [(start + offset, doc_id, document, key) for offset, (doc_id, document, key) in enumerate(zip(ids, documents, keys))])
+            self.rows += len(embeddings)
+            self.tombstones = np.concatenate([self.tombstones, np.zeros(len(embeddings), dtype=bool)])
+
+            # Incremental add (untrained IVF: index everything once it can be trained)
+            if self.index.is_trained:
+                self.index.add(embeddings)
+            elif self.train(self.index):
+                self.index.add(np.ascontiguousarray(self.vectors[:self.rows]))
+
+    def delete(self, ids):
+        with self.lock:
+            rows = [row for (row,) in self.select_in("SELECT row FROM documents WHERE doc_id IN ({})", ids)]
+            # The id is released so an update (delete + add) can reuse it
+            self.select_in("UPDATE documents SET deleted = 1, doc_id = NULL WHERE doc_id IN ({})", ids)
+            self.tombstones[rows] = True
+
+    def select_in(self, query, values) -> list:
+        # IN (...) statements in chunks: older SQLite builds allow at most 999 bound variables
+        values, results = list(values), list()
+        for start in range(0, len(values), self.max_variables):
+            chunk = values[start:start + self.max_variables]
+            results += self.db.execute(query.format(",".join("?" * len(chunk))), chunk).fetchall()
+        return results
+
+    # Readers hold the lock too: the commit thread re-maps self.vectors (map_vectors) and renumbers rows (compact)
+    def existing_ids(self, ids) -> set:
+        with self.lock:
+            return {doc_id for (doc_id,) in self.select_in("SELECT doc_id FROM documents WHERE deleted = 0 AND doc_id IN ({})", ids)}
+
+    def documents(self, ids) -> dict:
+        with self.lock:
+            return dict(self.select_in("SELECT doc_id, document FROM documents WHERE deleted = 0 AND doc_id IN ({})", ids))
+
+    def iter_documents(self, batch_size=1000):
+        last_row = -1
+        while True:
+            with self.lock:
+                rows = self.db.execute("SELECT row, doc_id, document FROM documents WHERE deleted = 0 AND row > ? ORDER BY row LIMIT ?", (last_row, batch_size)).fetchall()
+            if not rows:
+                return
+            yield [(doc_id, document) for _, doc_id, document in rows]
+            last_row = rows[-1][0]
+
+    def iter_embeddings(self, batch_size=1000):
+        last_row = -1
+        while True:
+            with self.lock:
+                rows = self.db.execute("SELECT row, doc_id, document FROM documents WHERE deleted = 0 AND row > ? ORDER BY row LIMIT ?", (last_row, batch_size)).fetchall()
+                vectors = np.asarray(self.vectors[[row for row, _, _ in rows]]) if rows else None
+            if not rows:
+                return
+            yield [(doc_id, document, vector) for (_, doc_id, document), vector in zip(rows, vectors)]
+            last_row = rows[-1][0]
+
+    def iter_entries(self, batch_size=1000, embeddings=False):
+        last_row = -1
+        while True:
+            with self.lock:
+                rows = self.db.execute("SELECT row, doc_id, key, document FROM documents WHERE deleted = 0 AND row > ? ORDER BY row LIMIT ?", (last_row, batch_size)).fetchall()
+                vectors = np.asarray(self.vectors[[row for row, _, _, _ in rows]]) if rows and embeddings else None
+            if not rows:
+                return
+            entries = [{"id": doc_id, "key": key, "value": document} for _, doc_id, key, document in rows]
+            if embeddings:
+                for entry, vector in zip(entries, vectors):
+                    entry["embedding"] = vector.tolist()
+            yield entries
+            last_row = rows[-1][0]
+
+    def search(self, query_embeddings, k) -> list:
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dim)
+        with self.lock:
+            live = self.count()
+            if not live or not k:
+                return [list() for _ in query_embeddings]
+
+            # Over-fetch by the tombstoned share so dropping them still leaves k results; widen and re-query while some
+            # query comes up short (compaction keeps that share, and so the fetch size, bounded)
+            fetch_k = int(np.ceil(k * self.rows / live)) + (k if self.tombstones.any() else 0)
+            while True:
+                candidate_k = min(self.rows, fetch_k * self.rerank_factor if self.quantization != "none" else fetch_k)
+                if self.index.is_trained and self.index.ntotal:
+                    self.set_search_params()
+                    distances, rows = self.index.search(query_embeddings, candidate_k)
+                else:
+                    distances, rows = self.exact_search(query_embeddings, candidate_k)
+                hits = [[(int(row), float(distance)) for row, distance in zip(query_rows, query_distances) if row >= 0 and not self.tombstones[row]] for query_distances, query_rows in zip(distances, rows)]
+                if candidate_k >= self.rows or all(len(query_hits) >= min(k, live) for query_hits in hits):
+                    break
+                fetch_k *= 4
+
+            results = list()
+            for query_embedding, query_hits in zip(query_embeddings, hits):
+                if self.quantization != "none":
+                    query_hits = self.rerank(query_embedding, [row for row, _ in query_hits])
+                results += [self.lookup(query_hits[:k])]
+            return results
+
+    def exact_search(self, query_embeddings, k):
+        vectors = self.vectors[:self.rows]
+        distances = (query_embeddings ** 2).sum(axis=1)[:, None] + (vectors ** 2).sum(axis=1)[None, :] - 2 * query_embeddings @ vectors.T
+        rows = np.argsort(distances, axis=1)[:, :k]
+        return np.take_along_axis(distances, rows, axis=1), rows
+
+    def rerank(self, query_embedding, rows) -> list:
+        # Exact distances for the candidates only; rows are read from the memory-mapped file in file order
+        if not rows:
+            return list()
+        rows = np.sort(np.asarray(rows))
+        delta = np.asarray(self.vectors[rows]) - query_embedding
+        distances = np.einsum("ij,ij->i", delta, delta)
+        order = np.argsort(distances)
+        return [(int(rows[index]), float(distances[index])) for index in order]
+
+    def set_search_params(self):
+        # Recall / speed knobs, applied per search so they can be tuned at runtime
+        if self.index_type == "ivf":
+            self.index.nprobe = self.nprobe
+        else:
+            self.index.hnsw.efSearch = self.ef_search
+
+    def lookup(self, hits) -> list:
+        if not hits:
+            return list()
+        documents = {row: (doc_id, document) for row, doc_id, document in self.select_in("SELECT row, doc_id, document FROM documents WHERE row IN ({})", [row for row, _ in hits])}
+        return [(documents[row][0], documents[row][1], distance) for row, distance in hits if row in documents]
+
+    def compact(self) -> None:
+        # Drop tombstoned rows: live vectors are copied in order to a new file, SQLite renumbers the rows in the same
+        # transaction that marks the compaction, then the new file replaces the old one and the index is rebuilt
+        live = np.flatnonzero(~self.tombstones[:self.rows])
+        print(f"Compacting the FAISS store: {self.rows - len(live)} of {self.rows} rows are deleted...")
+        path = os.path.join(self.directory, "vectors.f32")
+        compacted = np.memmap(f"{path}.compact", dtype=np.float32, mode="w+", shape=(max(len(live), 1), self.dim))
+        for start in range(0, len(live), self.grow_rows):
+            compacted[start:start + self.grow_rows] = self.vectors[live[start:start + self.grow_rows]]
+        compacted.flush()
+        del compacted
+
+        # The index file maps old rows: gone before the renumbering commits, so a crash from here on rebuilds it on load
+        index_path = os.path.join(self.directory, f"{self.index_name}.index")
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        self.db.execute("DELETE FROM documents WHERE deleted = 1")
+        self.db.executemany("UPDATE documents SET row = ? WHERE row = ?", [(new_row, int(old_row)) for new_row, old_row in enumerate(live) if new_row != old_row])
+        self.db.execute("INSERT INTO compaction (pending) VALUES (1)")
+        self.db.commit()
+        self.finish_compaction()
+
+        self.rows = len(live)
+        self.tombstones = np.zeros(self.rows, dtype=bool)
+        self.map_vectors(max(self.rows, 1))
+        self.index = self.new_index()
+        if self.rows and self.train(self.index):
+            self.index.add(np.ascontiguousarray(self.vectors[:self.rows]))
+
+    def finish_compaction(self) -> None:
+        # Second half of compact(); also run on startup when a crash interrupted it after the renumbering committed
+        path = os.path.join(self.directory, "vectors.f32")
+        if os.path.exists(f"{path}.compact"):
+            if self.vectors is not None:
+                del self.vectors
+                self.vectors = None
+            os.replace(f"{path}.compact", path)
+        self.db.execute("DELETE FROM compaction")
+        self.db.commit()
+
+    def persist(self):
+        with self.lock:
+            tombstones = int(self.tombstones.sum())
+            if tombstones >= max(self.compact_min, self.compact_ratio * self.rows):
+                self.compact()
+            self.vectors.flush()
+            self.db.commit()
+            self.faiss.write_index(self.index, os.path.join(self.directory, f"{self.index_name}.index"))
+
+def get_backend(kind, persist_directory="db", embedding_function=None, dim=1536, quantization="none") -> VectorBackend:
+    # kind: "chroma" (default) or "faiss"; FAISS settings come from .env
+    if kind != "faiss" and quantization != "none":
+        raise ValueError(f"Vector quantization ({quantization}) needs the faiss backend, not {kind}.")
+    if kind == "faiss":
+        return FaissBackend(
+            os.path.join(persist_directory, "faiss"),
+            dim=dim,
+            index_type=os.environ.get("FAISS_INDEX_TYPE", "hnsw"),
+            nlist=int(os.environ.get("FAISS_NLIST", 1024)),
+            nprobe=int(os.environ.get("FAISS_NPROBE", 16)),
+            hnsw_m=int(os.environ.get("FAISS_HNSW_M", 32)),
+            ef_search=int(os.environ.get("FAISS_EF_SEARCH", 64)),
+            quantization=quantization,
+            pq_subspaces=int(os.environ.get("FAISS_PQ_SUBSPACES", 64)),
+            compact_ratio=float(os.environ.get("FAISS_COMPACT_RATIO", 0.2)),
+        )
+    return ChromaBackend(persist_directory=persist_directory, embedding_function=embedding_function)
@@ -0,0 +1,98 @@
+# coding: utf-8
+# Author: Du Mingzhe (mingzhe@nus.edu.sg)
+# Date: 2023-04-29
+
+import queue
+import threading
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+class Emitter(object):
+    # Drop-in for sio in socket_config: worker threads enqueue, a background task on the server loop emits
+    def __init__(self, sio, interval=0.05) -> None:
+        self.sio = sio
+        self.interval = interval
+        self.messages = queue.Queue()
+        self.started = False
+
+    def emit(self, event, data, room=None):
+        self.messages.put((event, data, room))
+
+    def start(self) -> None:
+        if not self.started:
+            self.started = True
+            self.sio.start_background_task(self.pump)
+
+    def pump(self) -> None:
+        while True:
+            while True:
+                try:
+                    event, data, room = self.messages.get_nowait()
+                except queue.Empty:
+                    break
+                self.sio.emit(event, data, room=room)
+            self.sio.sleep(self.interval)
+
+class JobQueue(object):
+    # Bounded worker pool: one job at a time per session, max_workers jobs overall, fast rejection when full
+    def __init__(self, max_workers=4, max_pending=16) -> None:
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent")
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.closed = False
+        self.pending = 0
+        self.running = set()
+        self.waiting = defaultdict(deque)
+
+    def submit(self, sid, fn, *args) -> bool:
+        with self.lock:
+            if self.closed or self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+            if sid in self.running:
+                self.waiting[sid].append((fn, args))
+            else:
+                self.start(sid, fn, args)
+            return True
+
+    def start(self, sid, fn, args) -> None:
+        self.running.add(sid)
+        self.executor.submit(self.run, sid, fn, args)
+
+    def run(self, sid, fn, args) -> None:
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"Job Error [{sid}]: {e}")
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.running.discard(sid)
+                if self.waiting[sid]:
+                    self.start(sid, *self.waiting[sid].popleft())
+                else:
+                    self.waiting.pop(sid, None)
+                if not self.pending:
+                    self.idle.notify_all()
+
+    def cancel(self, sid) -> int:
+        # Drop the session's queued jobs (the running one is stopped through its agent's cancel_event)
+        with self.lock:
+            dropped = len(self.waiting.pop(sid, deque()))
+            self.pending -= dropped
+            if not self.pending:
+                self.idle.notify_all()
+            return dropped
+
+    def shutdown(self, timeout=None) -> bool:
+        # Stop accepting jobs and drain: queued jobs still run, in order, before the pool closes. False if timed out.
+        with self.lock:
+            self.closed = True
+            drained = self.idle.wait_for(lambda: not self.pending, timeout)
+        self.executor.shutdown(wait=drained)
+        return drained
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"pending": self.pending, "running": len(self.running)}
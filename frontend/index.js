@@ -1,7 +1,14 @@
 // Author: Du Mingzhe (mingzhe@nus.edu.sg)
 // Date: 2023-04-29
 
-const socket = io("http://34.142.201.79:8443");
+// Stable across reconnects and reloads, so the server can restore this conversation's history
+var session_id = localStorage.getItem("session_id");
+if (session_id == null) {
+    session_id = crypto.randomUUID();
+    localStorage.setItem("session_id", session_id);
+}
+
+const socket = io("http://34.142.201.79:8443", {auth: {"session_id": session_id}});
 
 const submit_button = document.getElementById("submit-button");
 const submit_input  = document.getElementById("submit-input");
@@ -13,14 +20,42 @@ const token_save_button = document.getElementById("token-save-btn");
 
 var token = null;
 var last_system_msg = null;
+var partial_msg = null;
 
 token_save_button.onclick = function() {
     token = token_input.value;
     token_modal.hide();
 }
 
+function remove_system_msg() {
+    // The status line may already be gone (e.g. replaced by a streamed reply earlier in the turn)
+    if (last_system_msg != null && last_system_msg.parentNode == message_container) {
+        message_container.removeChild(last_system_msg);
+    }
+    last_system_msg = null;
+}
+
+function append_partial(data) {
+    // Streamed tokens are appended to the current reply bubble
+    if (partial_msg == null) {
+        remove_system_msg();
+        add_message({"content": "🗣️ ", "style": "partial"});
+    }
+    partial_msg.textContent += data.content;
+    partial_msg.scrollIntoView();
+}
+
 function add_message(data) {
     const m_style = data.style
+
+    // The final reply replaces the streamed bubble instead of adding a second one
+    if (m_style == "speak" && partial_msg != null) {
+        partial_msg.textContent = data.content;
+        partial_msg.classList.remove("alert-light");
+        partial_msg.classList.add("alert-success");
+        partial_msg = null;
+        return;
+    }
     const message_div = document.createElement("div");
     if (m_style == "human"){
         message_div.classList.add("d-flex", "flex-row-reverse");
@@ -34,13 +69,16 @@ function add_message(data) {
         message_el.classList.add("alert", "alert-primary");
     } else if (m_style == "speak") {
         message_el.classList.add("alert", "alert-success");
-        message_container.removeChild(last_system_msg);
+        remove_system_msg();
+    } else if (m_style == "partial") {
+        message_el.classList.add("alert", "alert-light");
+        partial_msg = message_el;
     } else if (m_style == "system") {
         message_el.classList.add("alert", "alert-light");
         last_system_msg = message_div;
     } else if (m_style == "task") {
         message_el.classList.add("alert", "alert-light");
-        message_container.removeChild(last_system_msg);
+        remove_system_msg();
     } else {
         message_el.classList.add("alert", "alert-secondary");
     }
@@ -55,6 +93,10 @@ function add_message(data) {
 }
 
 socket.on("message", function(data) {
+    if (data.style == "partial") {
+        append_partial(data);
+        return;
+    }
     console.log(data);
     add_message(data);
 });